@@ -1,22 +1,102 @@
 # Documentation: http://gagnatorg.ja.is/docs/skra/v1/
 # Usage: https://api.ja.is/usage/[key]/
+#
+# Every lookup in the national registry costs money (see
+# `settings.NATIONAL_REGISTRY_LOOKUP_COST`), so responses are kept in the
+# database for `settings.NATIONAL_REGISTRY_EXPIRATION_DAYS` days and shared by
+# everything that looks people up, whether it's the processing of
+# registrations, the JSON API or an admin in the web interface. Expired
+# responses are deleted, since they contain personal data of people who may
+# not even be members.
+import datetime
 import json
 import requests
+import threading
 
 from django.conf import settings
+from django.utils import timezone
+
+from core.models import NationalRegistryResponse
 
 BASE_URL = 'https://api.ja.is/skra/v1/'
 
 class PersonNotFoundException(Exception):
     pass
 
+# Lookups made by the same thread share a session, so that connections to the
+# API are reused instead of connecting anew for every lookup. Sessions are not
+# safe to share between threads, so each thread gets its own.
+sessions = threading.local()
+
+def get_session():
+    if not hasattr(sessions, 'session'):
+        sessions.session = requests.Session()
+    return sessions.session
+
+# Counts of lookups that were answered from the database (hits) and by the
+# API (misses), along with the cost of the latter, since the process started.
+stats = {
+    'hits': 0,
+    'misses': 0,
+    'cost': 0,
+}
+stats_lock = threading.Lock()
+
+def count(name, amount=1):
+    with stats_lock:
+        stats[name] += amount
+
+def get_stats():
+    with stats_lock:
+        return dict(stats)
+
+def get_expiration():
+    return timezone.now() - datetime.timedelta(days=settings.NATIONAL_REGISTRY_EXPIRATION_DAYS)
+
 def parse_json(url):
-    response = requests.get(url, headers={ 'Authorization': settings.NATIONAL_REGISTRY_KEY })
+    response = get_session().get(
+        url,
+        headers={ 'Authorization': settings.NATIONAL_REGISTRY_KEY },
+        timeout=getattr(settings, 'NATIONAL_REGISTRY_TIMEOUT', 10)
+    )
+
+    # Failures of the API itself, as opposed to the person not being found,
+    # should neither be cached nor taken to mean that the person doesn't
+    # exist.
+    if not response.ok and response.status_code != 404:
+        response.raise_for_status()
+
     return json.loads(response.text)
 
-def get_person(kt):
-    url = '%s%s/%s' % (BASE_URL, 'people', kt)
-    result = parse_json(url)
+'''
+Returns the national registry's data on the person with the given SSN
+(kennitala), and when it was retrieved from the API, which is earlier than
+now if it was found in the database.
+'''
+def lookup_person(kt):
+    cached = NationalRegistryResponse.objects.filter(ssn=kt, fetched__gte=get_expiration()).first()
+    if cached is not None:
+        count('hits')
+        result = json.loads(cached.response)
+        fetched = cached.fetched
+    else:
+        url = '%s%s/%s' % (getattr(settings, 'NATIONAL_REGISTRY_URL', BASE_URL), 'people', kt)
+        result = parse_json(url)
+        fetched = timezone.now()
+
+        count('misses')
+        count('cost', settings.NATIONAL_REGISTRY_LOOKUP_COST)
+
+        NationalRegistryResponse.objects.filter(fetched__lt=get_expiration()).delete()
+        NationalRegistryResponse.objects.update_or_create(
+            ssn=kt,
+            defaults={ 'response': json.dumps(result), 'fetched': fetched }
+        )
+
     if 'type' not in result or result['type'] != 'person':
         raise PersonNotFoundException()
+    return result, fetched
+
+def get_person(kt):
+    result, fetched = lookup_person(kt)
     return result
@@ -1,6 +1,12 @@
 from django.conf import settings
+from django.db.models import QuerySet
 from django.utils import timezone
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import threading
 
 #################
 # Logger setup. #
@@ -8,7 +14,43 @@ import logging
 
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
-# Set up action logging.
+class QueuedHandler(logging.handlers.QueueHandler):
+    '''
+    Puts records in a queue, from which a separate thread writes them with the
+    given handler, so that logging doesn't wait for the disk. Whatever is still
+    in the queue is written when the process exits.
+
+    The thread is started by the first record in each process, rather than on
+    import, since threads don't survive forking, which servers may do after
+    loading the application.
+    '''
+
+    def __init__(self, handler):
+        logging.handlers.QueueHandler.__init__(self, None)
+        self.handler = handler
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+
+            # Anything left in the parent process's queue is its own to write.
+            self.queue = queue.SimpleQueue()
+            self.listener = logging.handlers.QueueListener(self.queue, self.handler)
+            self.listener.start()
+            atexit.register(self.listener.stop)
+            self.pid = os.getpid()
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put_nowait(record)
+
+# Set up action logging. Written right away, since it's for auditing, and
+# must not be lost if the process is killed.
 action_logger_handler = logging.FileHandler(
     '%s/actions.log' % settings.LOG_DIR
 )
@@ -26,7 +68,7 @@ mail_logger_handler = logging.handlers.RotatingFileHandler(
 mail_logger_handler.setFormatter(formatter)
 mail_logger = logging.getLogger('mailing')
 mail_logger.setLevel(logging.INFO)
-mail_logger.addHandler(mail_logger_handler)
+mail_logger.addHandler(QueuedHandler(mail_logger_handler))
 
 ######################
 # Logging functions. #
@@ -69,10 +111,35 @@ def log_mail(email, message, exception=None, testsend=False):
             exception.__str__()
         ))
 
-# Logging of user actions, for auditing purposes.
+# Writes the given IDs as a comma-separated list, in order, with runs of
+# consecutive IDs written as ranges, for example "1-4,7,9-10". Returns the
+# list along with the number of IDs.
+def encode_ids(ids):
+    ranges = []
+    count = 0
+    for id in ids:
+        # Repeated IDs are only written and counted once.
+        if len(ranges) > 0 and ranges[-1][1] == id:
+            continue
+
+        count += 1
+        if len(ranges) > 0 and ranges[-1][1] + 1 == id:
+            ranges[-1][1] = id
+        else:
+            ranges.append([id, id])
+
+    return ','.join([
+        str(first) if first == last else '%d-%d' % (first, last)
+        for first, last in ranges
+    ]), count
+
+# Logging of user actions, for auditing purposes. The affected members may be
+# given as a list of members or as a queryset, in which case only their IDs
+# are fetched, unless the queryset has already been evaluated.
 def log_action(user, action, action_details=None, affected_members=None):
     # A comma-separated list of member row IDs that were affected by the
-    # action. Information on the affected members is preserved in this manner
+    # action, with consecutive IDs written as ranges (see `encode_ids`).
+    # Information on the affected members is preserved in this manner
     # to retain the IDs of those who were affected, even after they've been
     # deleted from the database. That way, the data is in some sense more
     # accurate, even though no information on the deleted member's information
@@ -88,8 +155,11 @@ def log_action(user, action, action_details=None, affected_members=None):
     affected_member_count = 0
 
     if affected_members is not None:
-        affected_member_ids = ','.join([str(m.id) for m in affected_members])
-        affected_member_count = len(affected_members)
+        if isinstance(affected_members, QuerySet) and affected_members._result_cache is None:
+            ids = affected_members.order_by('id').values_list('id', flat=True).iterator()
+        else:
+            ids = sorted([m.id for m in affected_members])
+        affected_member_ids, affected_member_count = encode_ids(ids)
 
     # Only one user is ever deleted at a time, so we'll know that the number
     # of affected users was 1, even though we can't store information on the
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.15 on 2026-10-18 14:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_cacheversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NationalRegistryResponse',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ssn', models.CharField(max_length=30, unique=True)),
+                ('response', models.TextField()),
+                ('fetched', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
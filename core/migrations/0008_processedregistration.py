@@ -0,0 +1,25 @@
+# Generated by Django 4.2.15 on 2026-10-18 14:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_mailboxsyncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedRegistration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.CharField(max_length=255, unique=True)),
+                ('ssn', models.CharField(db_index=True, max_length=30)),
+                ('email', models.CharField(db_index=True, max_length=255)),
+                ('outcome', models.CharField(choices=[('processing', 'Processing'), ('registered', 'Registered'), ('updated', 'Updated'), ('ignored', 'Ignored'), ('failed', 'Failed')], default='processing', max_length=20)),
+                ('started', models.DateTimeField()),
+                ('admins_notified', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,135 @@
+from datetime import timedelta
+
+from django.db import IntegrityError
+from django.db import models
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+
+class CacheVersion(models.Model):
+    '''
+    The version of some data that processes keep in memory, which is bumped
+    whenever the data changes, so that every process can tell when its copy
+    is out of date by comparing version numbers, without loading the data.
+    '''
+    name = models.CharField(max_length=100, unique=True)
+    version = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '%s: %d' % (self.name, self.version)
+
+    # Returns the current version of the named data, which is 0 until it has
+    # first been changed.
+    @staticmethod
+    def get(name):
+        return CacheVersion.objects.filter(name=name).values_list('version', flat=True).first() or 0
+
+    @staticmethod
+    def bump(name):
+        CacheVersion.objects.get_or_create(name=name)
+        # Counted by the database, so that simultaneous bumps both count.
+        CacheVersion.objects.filter(name=name).update(version=F('version') + 1)
+
+
+class NationalRegistryResponse(models.Model):
+    '''
+    A response from the national registry's API about a person, kept so that
+    the same person isn't paid for twice within the expiration period (see
+    `core.jaapi`).
+    '''
+    ssn = models.CharField(max_length=30, unique=True)
+    response = models.TextField()
+    fetched = models.DateTimeField(db_index=True)
+
+
+class MailboxSyncState(models.Model):
+    '''
+    How far a mailbox has been read, so that only newer messages need to be
+    fetched the next time. IMAP messages are identified by UIDs, which only
+    ever grow within a mailbox as long as its `uidvalidity` stays the same.
+    If it changes, the UIDs are no longer comparable and the mailbox must be
+    read anew.
+    '''
+    # Identifies the mailbox, for example by server, username and mailbox name.
+    mailbox = models.CharField(max_length=255, unique=True)
+    uidvalidity = models.BigIntegerField()
+    last_uid = models.BigIntegerField()
+    updated = models.DateTimeField(auto_now=True)
+
+
+class ProcessedRegistration(models.Model):
+    '''
+    A registration received by email (see the `process_registrations`
+    command), recorded when its processing starts so that it is processed
+    only once, even if it is read again or by two runs at the same time.
+    '''
+    PROCESSING = 'processing'
+    REGISTERED = 'registered'
+    UPDATED = 'updated'
+    IGNORED = 'ignored'
+    FAILED = 'failed'
+    OUTCOME_CHOICES = (
+        (PROCESSING, 'Processing'),
+        (REGISTERED, 'Registered'),
+        (UPDATED, 'Updated'),
+        (IGNORED, 'Ignored'),
+        (FAILED, 'Failed'),
+    )
+
+    # A registration still being processed after this many seconds is assumed
+    # to have been abandoned, for example by a run that crashed, and may be
+    # processed again.
+    ABANDONED_SECONDS = 3600
+
+    # The email's Message-ID.
+    message_id = models.CharField(max_length=255, unique=True)
+    ssn = models.CharField(max_length=30, db_index=True)
+    # Lower-case.
+    email = models.CharField(max_length=255, db_index=True)
+    outcome = models.CharField(max_length=20, choices=OUTCOME_CHOICES, default=PROCESSING)
+    started = models.DateTimeField()
+    admins_notified = models.DateTimeField(null=True)
+
+    # Records that the registration's processing has started and returns it,
+    # or None if it has already been processed or is being processed by
+    # another run.
+    @staticmethod
+    def claim(message_id, ssn, email):
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                return ProcessedRegistration.objects.create(
+                    message_id=message_id,
+                    ssn=ssn,
+                    email=email.lower(),
+                    started=now
+                )
+        except IntegrityError:
+            pass
+
+        # Only one run can take over an abandoned registration.
+        abandoned = now - timedelta(seconds=ProcessedRegistration.ABANDONED_SECONDS)
+        if ProcessedRegistration.objects.filter(
+            message_id=message_id,
+            outcome=ProcessedRegistration.PROCESSING,
+            started__lt=abandoned
+        ).update(started=now) == 0:
+            return None
+
+        return ProcessedRegistration.objects.get(message_id=message_id)
+
+    def finish(self, outcome):
+        self.outcome = outcome
+        self.save(update_fields=['outcome'])
+
+    # Records that the admins are being notified about this registration,
+    # unless they have already been notified about a registration with the
+    # same email address, in which case False is returned.
+    def notify_admins(self):
+        if ProcessedRegistration.objects.filter(email=self.email).exclude(admins_notified=None).exists():
+            return False
+
+        self.admins_notified = timezone.now()
+        self.save(update_fields=['admins_notified'])
+        return True
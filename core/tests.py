@@ -1,6 +1,170 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import atexit
+import datetime
+import http.server
+import json
+import logging
+import logging.handlers
+import threading
+
+from unittest import mock
+
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
+
+from core import jaapi
+from core.loggers import QueuedHandler
+from core.loggers import encode_ids
+from core.loggers import log_action
+from core.models import NationalRegistryResponse
+from member.models import Member
+
+
+class NationalRegistryStandInHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Answers lookups of people like the national registry's API does, for the
+    SSNs in the server's `people`, and keeps count of requests and
+    connections.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        self.server.connection_count += 1
+
+    def do_GET(self):
+        self.server.request_count += 1
+
+        ssn = self.path.rstrip('/').split('/')[-1]
+        if ssn in self.server.people:
+            status, result = 200, dict(self.server.people[ssn], type='person')
+        else:
+            status, result = 404, { 'error': 'Not found' }
+
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class NationalRegistryStandIn(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, people):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), NationalRegistryStandInHandler)
+        self.people = people
+        self.request_count = 0
+        self.connection_count = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/skra/v1/' % self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+@override_settings(NATIONAL_REGISTRY_LOOKUP_COST=11, NATIONAL_REGISTRY_EXPIRATION_DAYS=30)
+class NationalRegistryCacheTest(TestCase):
+
+    def test_cached_lookups(self):
+        people = {
+            '0101302989': { 'name': 'Jón Jónsson' },
+            '0101302979': { 'name': 'Jóna Jónsdóttir' },
+        }
+        before = jaapi.get_stats()
+
+        with NationalRegistryStandIn(people) as server:
+            with override_settings(NATIONAL_REGISTRY_URL=server.url):
+                for i in range(3):
+                    self.assertEqual(jaapi.get_person('0101302989')['name'], 'Jón Jónsson')
+                    self.assertEqual(jaapi.get_person('0101302979')['name'], 'Jóna Jónsdóttir')
+                    with self.assertRaises(jaapi.PersonNotFoundException):
+                        jaapi.get_person('0000000000')
+
+                self.assertEqual(server.request_count, 3)
+
+                # Expired responses are looked up again.
+                NationalRegistryResponse.objects.filter(ssn='0101302989').update(
+                    fetched=timezone.now() - datetime.timedelta(days=31)
+                )
+                person, fetched = jaapi.lookup_person('0101302989')
+
+                self.assertEqual(server.request_count, 4)
+                self.assertEqual(NationalRegistryResponse.objects.count(), 3)
+
+            # Connections are reused between lookups.
+            self.assertEqual(server.connection_count, 1)
+
+        after = jaapi.get_stats()
+        self.assertEqual(after['hits'] - before['hits'], 6)
+        self.assertEqual(after['misses'] - before['misses'], 4)
+        self.assertEqual(after['cost'] - before['cost'], 44)
+
+    def test_session_per_thread(self):
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(jaapi.get_session()))
+        thread.start()
+        thread.join()
+
+        self.assertIs(jaapi.get_session(), jaapi.get_session())
+        self.assertIsNot(sessions[0], jaapi.get_session())
+
+
+class LogActionTest(TestCase):
+
+    def test_affected_members(self):
+        self.assertEqual(encode_ids([1, 2, 3, 4, 7, 9, 10, 10]), ('1-4,7,9-10', 7))
+
+        user = User.objects.create(username='admin')
+        for i in range(4):
+            Member.objects.create(ssn='%010d' % i, name='Member %d' % i, email='member%d@example.com' % i)
+        ids = list(Member.objects.order_by('id').values_list('id', flat=True))
+
+        # Only the IDs are fetched from a queryset, in a single query.
+        with mock.patch('core.loggers.action_logger') as action_logger:
+            with self.assertNumQueries(1):
+                log_action(user, 'csv_export', affected_members=Member.objects.all())
+
+        self.assertEqual(
+            action_logger.info.call_args[0][0],
+            'User: admin - Action: csv_export - Affected user count: 4 - Affected user IDs: [%d-%d]' % (ids[0], ids[-1])
+        )
+
+
+class QueuedHandlerTest(TestCase):
+
+    def test_started_in_each_process(self):
+        written = logging.handlers.BufferingHandler(100)
+        handler = QueuedHandler(written)
+        logger = logging.getLogger('core.tests.queued')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        logger.warning('First')
+        first_listener = handler.listener
+
+        # As if the process had been forked, leaving the thread behind.
+        handler.pid = None
+        logger.warning('Second')
+        self.assertIsNot(handler.listener, first_listener)
 
-# Create your tests here.
+        for listener in (first_listener, handler.listener):
+            atexit.unregister(listener.stop)
+            listener.stop()
+        self.assertEqual([record.getMessage() for record in written.buffer], ['First', 'Second'])
@@ -0,0 +1,81 @@
+'''
+Benchmarks for processing registrations. These are not run along with the
+tests, since they only report numbers. Run them with:
+
+    ./manage.py test icepirate.benchmarks
+'''
+import locale
+import time
+
+from dateutil import parser as dateparser
+from django.test import SimpleTestCase
+
+from icepirate.utils import parse_email_date
+
+
+class EmailDateBenchmark(SimpleTestCase):
+    '''
+    Compares parsing the Date headers of registration emails with
+    `parse_email_date` to how `process_registrations` used to do it, by
+    switching the locale to US English and back around `dateutil`.
+    '''
+
+    # Date headers in the formats that mail servers and clients actually use.
+    CORPUS = [
+        'Mon, 12 Oct 2026 12:00:00 +0000',
+        'Mon, 12 Oct 2026 12:00:00 +0000 (UTC)',
+        'Mon, 5 Oct 2026 09:03:41 -0400',
+        'Tue, 06 Oct 2026 23:59:59 +0100 (BST)',
+        'Wed, 7 Oct 2026 01:02:03 GMT',
+        'Thu, 8 Oct 2026 14:15:16 UT',
+        'Fri, 9 Oct 2026 07:08:09 EST',
+        '10 Oct 2026 11:12:13 +0000',
+        'Sat, 10 Oct 26 11:12:13 +0000',
+        'Sun, 11 Oct 2026 11:12 +0000',
+        'Sun, 11 Oct 2026 11:12:13 -0000',
+    ]
+
+    ROUNDS = 2000
+
+    # The old way, with the header cut to 25 characters as it was.
+    def parse_with_locale(self, value):
+        old_locale = locale.setlocale(locale.LC_TIME, '')
+        locale.setlocale(locale.LC_TIME, 'en_US.UTF-8')
+        result = dateparser.parse(value[0:25])
+        locale.setlocale(locale.LC_TIME, old_locale)
+        return result
+
+    def parse_with_dateutil(self, value):
+        return dateparser.parse(value[0:25])
+
+    def measure(self, label, function):
+        failed = set()
+        start = time.time()
+        for i in range(self.ROUNDS):
+            for value in self.CORPUS:
+                try:
+                    function(value)
+                except ValueError:
+                    failed.add(value)
+        seconds = time.time() - start
+
+        count = self.ROUNDS * len(self.CORPUS)
+        print('\n%s: %d dates in %.2f seconds (%.1f microseconds each), %d of %d formats failed' % (
+            label,
+            count,
+            seconds,
+            seconds / count * 1000000,
+            len(failed),
+            len(self.CORPUS)
+        ))
+        for value in sorted(failed):
+            print('- %s' % value)
+
+    def test_parse(self):
+        try:
+            self.parse_with_locale(self.CORPUS[0])
+            self.measure('setlocale and dateutil', self.parse_with_locale)
+        except locale.Error:
+            print('\nThe en_US.UTF-8 locale is not installed, measuring dateutil without it.')
+        self.measure('dateutil', self.parse_with_dateutil)
+        self.measure('parse_email_date', parse_email_date)
@@ -1,3 +1,5 @@
+import signal
+import threading
 import time
 import traceback
 from sys import stdout, stderr
@@ -5,22 +7,92 @@ from sys import stdout, stderr
 from core.loggers import log_mail
 
 from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db import connection
 from django.utils import timezone
 
 from icepirate.utils import quick_mail
 
+from message.exceptions import MailServerUnavailableException
 from message.exceptions import MessageBeingProcessedException
 from message.models import Message
 from message.models import MessageDelivery
+from message.sending import get_sender
+from message.sending import get_last_notification
 
 
 class Command(BaseCommand):
 
+    # Set when the script has been asked to stop, which happens between
+    # recipients, so that deliveries are recorded before stopping.
+    stopping = False
+
+    # Senders of email, one for each worker, whose connections to the mail
+    # server are kept open for as long as the script runs.
+    senders = None
+
+    def add_arguments(self, parser):
+        # Several workers send the same message at the same time, each to
+        # their own recipients. More workers can also be added by running
+        # this script in several processes at once.
+        parser.add_argument('--workers', type=int, default=1)
+
+        # Instead of processing the messages ready to send and then exiting,
+        # keep running and process messages as they become ready to send.
+        # Messages are looked for every `--poll-interval` seconds, or right
+        # away when the web interface notifies of a message being ready.
+        parser.add_argument('--daemon', action='store_true')
+        parser.add_argument('--poll-interval', type=int, default=60)
+
     def handle(self, *args, **options):
         print("--- Script started at %s ---" % timezone.now().strftime(
             '%Y-%m-%d %H:%M:%S')
         )
 
+        self.senders = {}
+
+        # Stop gracefully when asked to, for example by a service manager. When
+        # running as a daemon, Ctrl-C does the same, unless pressed twice.
+        # Otherwise it interrupts right away, as usual.
+        signal.signal(signal.SIGTERM, self.stop)
+        if options['daemon']:
+            signal.signal(signal.SIGINT, self.stop)
+
+        try:
+            self.process(options['workers'])
+
+            while options['daemon'] and not self.stopping:
+                self.wait(options['poll_interval'])
+                if not self.stopping:
+                    self.process(options['workers'])
+
+        finally:
+            for sender in self.senders.values():
+                sender.close()
+
+        print('--- Script complete. ---')
+
+    def stop(self, signum, frame):
+        if self.stopping and signum == signal.SIGINT:
+            raise KeyboardInterrupt()
+
+        print('--- Stopping... ---')
+        self.stopping = True
+
+    # Waits until the poll interval has passed, a message has been marked as
+    # ready to send, or the script is asked to stop.
+    def wait(self, poll_interval):
+        last_notification = get_last_notification()
+        started = time.time()
+        while not self.stopping and time.time() - started < poll_interval:
+            time.sleep(1)
+            if get_last_notification() != last_notification:
+                break
+
+    def process(self, worker_count):
+        # The database connection may have gone stale while waiting.
+        close_old_connections()
+
         messages = Message.objects.filter(
             ready_to_send=True,
             sending_complete=None
@@ -30,19 +102,75 @@ class Command(BaseCommand):
         print("Messages to process: %d" % message_count)
 
         for i, message in enumerate(messages):
+            if self.stopping:
+                break
+
             print('Processing message %d/%d (ID %d)' % (i+1, message_count, message.id))
 
-            try:
-                for num, recipient_count, recipient, success in message.send_bulk():
-                    print('  %d/%d: %s sending to %s' % (
-                        num,
-                        recipient_count,
-                        'Success' if success else 'Failed',
-                        recipient
-                    ))
+            if worker_count > 1:
+                # Set up the leases before the workers start, so that they
+                # don't find the message in the middle of being set up.
+                message.setup_bulk()
+
+                threads = [
+                    threading.Thread(target=self.work, args=(message.id,), name='worker-%d' % worker)
+                    for worker in range(worker_count)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
 
                 print('Message %d/%d (ID %d) processed.' % (i+1, message_count, message.id))
-            except MessageBeingProcessedException:
-                print('- Already being processed - skipping.')
 
-        print('--- Script complete. ---')
+            elif self.send(message):
+                print('Message %d/%d (ID %d) processed.' % (i+1, message_count, message.id))
+
+    # Runs in a thread of its own, with its own database connection. The
+    # thread's name becomes a part of the worker's name (see
+    # `Message.send_bulk`).
+    def work(self, message_id):
+        try:
+            self.send(Message.objects.get(id=message_id), '[%s] ' % threading.current_thread().name)
+        finally:
+            connection.close()
+
+    def send(self, message, prefix=''):
+        # Each worker has its own sender, which is reused for every message.
+        # Workers with the same name never run at the same time.
+        worker_name = threading.current_thread().name
+
+        try:
+            if worker_name not in self.senders:
+                sender = get_sender()
+                try:
+                    sender.open()
+                except MailServerUnavailableException:
+                    sender.close()
+                    raise
+                self.senders[worker_name] = sender
+
+            sending = message.send_bulk(sender=self.senders[worker_name])
+            for num, recipient_count, recipient, success in sending:
+                print('  %s%d/%d: %s sending to %s' % (
+                    prefix,
+                    num,
+                    recipient_count,
+                    'Success' if success else 'Failed',
+                    recipient
+                ))
+
+                if self.stopping:
+                    # Records deliveries and releases leases.
+                    sending.close()
+                    return False
+
+            return True
+        except MessageBeingProcessedException:
+            print('- %sAlready being processed - skipping.' % prefix)
+            return False
+        except MailServerUnavailableException as ex:
+            # The message stays ready to send, so it is tried again the next
+            # time that messages are processed.
+            print('- %sMail server unavailable - skipping: %s' % (prefix, ex))
+            return False
@@ -44,24 +44,28 @@ from django.core.management.base import BaseCommand
 
 import imaplib
 import email
-import json
-import locale
-import os
 import pytz
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from core import jaapi
+from core.models import MailboxSyncState
+from core.models import ProcessedRegistration
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connection
+from django.db import transaction
 from django.utils import timezone
 from email.header import decode_header
 from sys import stderr
 from sys import stdout
 from datetime import datetime
 from datetime import timedelta
-from dateutil import parser as dateparser
 
+from icepirate.utils import imap_date
+from icepirate.utils import parse_email_date
 from icepirate.utils import quick_mail
 from icepirate.utils import generate_random_string
-from icepirate.utils import techify
 from icepirate.utils import validate_ssn
 from member.models import Member
 from member.models import MemberGroup
@@ -84,8 +88,30 @@ class Command(BaseCommand):
     }
 
 
+    def add_arguments(self, parser):
+        # Number of national registry lookups, and of emails being sent, in
+        # progress at the same time.
+        parser.add_argument('--concurrency', type=int, default=4)
+
+    # Registrations are processed in stages, each of which is done for every
+    # registration before the next one starts:
+    #
+    #     fetch -> parse -> validate -> lookup -> persist -> notify
+    #
+    # The lookup and notify stages wait on other servers, so they work on
+    # several registrations at a time. The others are done one registration
+    # at a time, in the order that they were received, since they are either
+    # quick or write to the database. A registration that fails in one stage
+    # is skipped by the following ones, without affecting the others. Failing
+    # to send its emails doesn't make it fail, since it has been persisted by
+    # then.
     def handle(self, *args, **options):
 
+        self.concurrency = options['concurrency']
+
+        # How long each stage took, as (stage, seconds) pairs.
+        self.timings = []
+
         # Observe Ctrl-C
         try:
             stdout.write('Processing started at %s\n' % timezone.now())
@@ -97,49 +123,233 @@ class Command(BaseCommand):
             except InteractiveMessage.DoesNotExist:
                 raise Exception('Interactive message "Registration received" must be configured before running this script.')
 
-            registration_requests = self.get_registration_requests()
-            for reg in registration_requests:
-                stdout.write('Processing registration (%s, %s, %s)\n' % (reg['ssn'], reg['name'], reg['email']))
+            messages = self.run_stage('fetch', self.fetch_registration_messages)
+            registrations = self.run_stage('parse', self.parse_registrations, messages)
+            registrations = self.run_stage('validate', self.validate_registrations, registrations)
+            self.run_stage('lookup', self.lookup_registrations, registrations)
+            self.run_stage('persist', self.persist_registrations, registrations)
+            self.run_stage('notify', self.notify_registrations, registrations)
 
-                try:
-                    if self.check_if_valid_ssn(reg):
-                        existing_member = self.is_already_member(reg)
-                        if existing_member:
-                            added_to_groups = self.process_groups(reg, existing_member)
+            for reg in registrations:
+                reg['record'].finish(reg['outcome'])
 
-                            emails_differ = self.check_if_emails_differ(reg)
+            # Registrations are only read once, even those that failed above.
+            self.save_sync_state()
 
-                            if not emails_differ:
-                                email_consent_changed = self.check_if_email_consent_changed(reg)
-                            else:
-                                email_consent_changed = False
+            stdout.write('Stage timings: %s\n' % ', '.join([
+                '%s %.2fs' % (stage, seconds) for stage, seconds in self.timings
+            ]))
 
-                            if not added_to_groups and not emails_differ and not email_consent_changed:
-                                stdout.write('* Registration ignored.\n')
-                        else:
-                            if self.check_national_registry(reg):
-                                if not self.check_names(reg):
-                                    if not self.recently_mailed_about(reg):
-                                        self.notify_name_mismatch(reg)
+            lookup_stats = jaapi.get_stats()
+            stdout.write('National registry lookups: %d cached, %d paid for (%d %s)\n' % (
+                lookup_stats['hits'],
+                lookup_stats['misses'],
+                lookup_stats['cost'],
+                settings.NATIONAL_REGISTRY_LOOKUP_CURRENCY
+            ))
 
-                                self.register_member(reg)
+        except KeyboardInterrupt:
+            quit(1)
+        except Exception as e:
+            stderr.write('Error: %s\n' % e)
 
-                            else:
-                                stdout.write('* Registration ignored.\n')
 
-                    else:
-                        stdout.write('* Registration ignored.\n')
-                except Exception as e:
-                    stdout.write('Error: %s\n' % e)
-                    stdout.write('THERE HAS BEEN AN ERROR. Continuing with registrations.\n')
+    def run_stage(self, stage, function, *args):
+        stdout.write('--- Stage: %s ---\n' % stage)
+        start = time.time()
+        result = function(*args)
+        self.timings.append((stage, time.time() - start))
+        stdout.write('\n')
+        return result
 
-                stdout.write('\n')
+    # Whether the registration still needs work, that is, it has neither
+    # failed nor been settled by an earlier stage.
+    def is_pending(self, reg):
+        return reg['outcome'] is None
 
-        except KeyboardInterrupt:
-            quit(1)
+    # Calls the function on behalf of a registration, and if it fails, marks
+    # the registration as failed, so that the following stages skip it.
+    # Returns whether the function succeeded.
+    def isolate(self, reg, stage, function, *args):
+        try:
+            function(*args)
+            return True
         except Exception as e:
-            stderr.write('Error: %s\n' % e)
+            stdout.write('Error in %s stage: %s\n' % (stage, e))
+            stdout.write('THERE HAS BEEN AN ERROR. Continuing with registrations.\n')
+            reg['outcome'] = ProcessedRegistration.FAILED
+            return False
+
+    # Claims the registrations (see `ProcessedRegistration`) and returns those
+    # that haven't been processed before, after checking their SSNs and
+    # whether they are already members.
+    def validate_registrations(self, registrations):
+        self.load_members_and_groups(registrations)
+
+        claimed = []
+        for reg in registrations:
+            stdout.write('Validating registration (%s, %s, %s)\n' % (reg['ssn'], reg['name'], reg['email']))
+
+            # Ensures that each registration is processed only once.
+            record = ProcessedRegistration.claim(reg['message_id'], reg['ssn'], reg['email'])
+            if record is None:
+                stdout.write('* Already processed, ignoring.\n')
+                continue
+
+            reg['record'] = record
+            reg['outcome'] = None
+            reg['member'] = None
+            reg['national'] = None
+            # Group memberships to add once every registration has been
+            # persisted (see `process_groups`).
+            reg['memberships'] = []
+            # Emails to send once the registration has been persisted, as
+            # (address, subject, body, interactive message) tuples. The
+            # interactive message is given when one is being sent.
+            reg['mails'] = []
+            claimed.append(reg)
+
+            self.isolate(reg, 'validate', self.validate_registration, reg)
+
+        return claimed
+
+    # Loads the members and groups that the registrations refer to, along
+    # with the members' memberships in those groups, with a query each.
+    def load_members_and_groups(self, registrations):
+        # Keyed by SSN.
+        self.members = Member.objects.in_bulk([reg['ssn'] for reg in registrations], field_name='ssn')
+
+        # Keyed by name.
+        group_names = set()
+        for reg in registrations:
+            group_names.update(reg['member_assoc'])
+        self.groups = MemberGroup.objects.in_bulk(group_names, field_name='name')
+
+        # As (member ID, group ID) pairs.
+        self.memberships = set(Member.membergroups.through.objects.filter(
+            member_id__in=[member.id for member in self.members.values()],
+            membergroup_id__in=[group.id for group in self.groups.values()]
+        ).values_list('member_id', 'membergroup_id'))
+
+    def validate_registration(self, reg):
+        if not self.check_if_valid_ssn(reg):
+            stdout.write('* Registration ignored.\n')
+            reg['outcome'] = ProcessedRegistration.IGNORED
+            return
+
+        reg['member'] = self.is_already_member(reg)
+
+    # Looks up those registering for the first time in the national
+    # registry, several at a time.
+    def lookup_registrations(self, registrations):
+        pending = [reg for reg in registrations if self.is_pending(reg) and reg['member'] is None]
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            futures = [(reg, executor.submit(self.lookup_person, reg['ssn'])) for reg in pending]
+
+            # The results are handled in order, regardless of which lookups
+            # finish first.
+            for reg, future in futures:
+                self.isolate(reg, 'lookup', self.check_national_registry, reg, future.result)
+
+    # Runs in the thread pool.
+    def lookup_person(self, ssn):
+        try:
+            return jaapi.get_person(ssn)
+        finally:
+            # Each thread has its own database connection.
+            connection.close()
+
+    def persist_registrations(self, registrations):
+        for reg in registrations:
+            if not self.is_pending(reg):
+                continue
+
+            stdout.write('Processing registration (%s, %s, %s)\n' % (reg['ssn'], reg['name'], reg['email']))
+            self.isolate(reg, 'persist', self.persist_registration, reg)
+
+        memberships = []
+        for reg in registrations:
+            if reg['outcome'] != ProcessedRegistration.FAILED:
+                memberships.extend(reg['memberships'])
+
+        if len(memberships) > 0:
+            stdout.write('Adding %d group memberships...' % len(memberships))
+            stdout.flush()
+            Member.membergroups.through.objects.bulk_create(memberships, ignore_conflicts=True)
+            stdout.write(' done\n')
+
+    def persist_registration(self, reg):
+        # Whatever a failed registration has written is undone.
+        with transaction.atomic():
+            self.persist_registration_changes(reg)
+
+        # Only once the changes have been committed are they known to the
+        # registrations that follow.
+        if reg['outcome'] == ProcessedRegistration.REGISTERED:
+            self.members[reg['member'].ssn] = reg['member']
+        self.memberships.update([(m.member_id, m.membergroup_id) for m in reg['memberships']])
+
+    def persist_registration_changes(self, reg):
+        # The same person may have registered more than once since the last
+        # run, in which case an earlier registration has made them a member.
+        if reg['member'] is None:
+            reg['member'] = self.is_already_member(reg)
 
+        existing_member = reg['member']
+        if existing_member:
+            added_to_groups = self.process_groups(reg, existing_member)
+
+            emails_differ = self.check_if_emails_differ(reg)
+
+            if not emails_differ:
+                email_consent_changed = self.check_if_email_consent_changed(reg)
+            else:
+                email_consent_changed = False
+
+            if not added_to_groups and not emails_differ and not email_consent_changed:
+                stdout.write('* Registration ignored.\n')
+                reg['outcome'] = ProcessedRegistration.IGNORED
+            else:
+                reg['outcome'] = ProcessedRegistration.UPDATED
+        else:
+            if not self.check_names(reg):
+                if reg['record'].notify_admins():
+                    self.notify_name_mismatch(reg)
+
+            self.register_member(reg)
+            reg['outcome'] = ProcessedRegistration.REGISTERED
+
+    # Sends the emails of the registrations that have been persisted, several
+    # at a time.
+    def notify_registrations(self, registrations):
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            futures = []
+            for reg in registrations:
+                if reg['outcome'] == ProcessedRegistration.FAILED:
+                    continue
+                for mail in reg['mails']:
+                    futures.append((reg, mail, executor.submit(self.send_mail, *mail)))
+
+            for reg, mail, future in futures:
+                stdout.write('- Emailing %s: %s...' % (mail[0], mail[1]))
+                stdout.flush()
+                try:
+                    future.result()
+                    stdout.write(' done\n')
+                except Exception as e:
+                    # The registration keeps its outcome, as the member has
+                    # been persisted regardless.
+                    stdout.write(' failed: %s\n' % e)
+
+    # Runs in the thread pool. Raises the error that sending failed with.
+    def send_mail(self, address, subject, body, interactive_message=None):
+        if interactive_message is not None:
+            error = interactive_message.deliver(address, body)
+            if error is not None:
+                raise error
+        else:
+            quick_mail(address, subject, body)
 
     def check_if_valid_ssn(self, reg):
         stdout.write('- Checking if SSN %s is valid...' % reg['ssn'])
@@ -183,33 +393,16 @@ class Command(BaseCommand):
 
         return names_match
 
-    def recently_mailed_about(self, reg):
-        email = reg['email'].lower()
-        filename = os.path.expanduser('~/recently-mailed-about.json')
-        try:
-            with open(filename, 'r') as fd:
-                recent = json.load(fd)
-        except (IOError, OSError, ValueError):
-            recent = []
-        if email in recent:
-            return True
-        else:
-            recent.append(email)
-            recent = recent[-100:]
-            with open(filename, 'w') as fd:
-                json.dump(recent, fd)
-            return False
-
     def check_if_emails_differ(self, reg):
 
-        member = Member.objects.get(ssn=reg['ssn'])
+        member = reg['member']
 
         stdout.write('- Checking if email addresses differ...')
         stdout.flush()
         if member.email.lower() != reg['email'].lower():
             stdout.write(' yes\n')
 
-            if self.recently_mailed_about(reg):
+            if not reg['record'].notify_admins():
                 stdout.write('* Already notified admins, ignoring.\n')
             else:
                 stdout.write('* Notifying admins...')
@@ -230,7 +423,7 @@ class Command(BaseCommand):
                         body += 'Name in database: %s\n' % member.name
                     body += '\n'
                     body += 'NOTE: The member has NOT been modified in the database. Please modify manually after investigating the matter.\n'
-                    quick_mail(admin.email, 'IMPORTANT! New email address in registration!', body)
+                    reg['mails'].append((admin.email, 'IMPORTANT! New email address in registration!', body))
 
                 stdout.write(' done\n')
 
@@ -241,7 +434,7 @@ class Command(BaseCommand):
 
     def check_if_email_consent_changed(self, reg):
 
-        member = Member.objects.get(ssn=reg['ssn'])
+        member = reg['member']
 
         stdout.write('- Checking if consent for email being sent has changed...')
         stdout.flush()
@@ -263,11 +456,13 @@ class Command(BaseCommand):
 
             return False
 
-    def check_national_registry(self, reg):
+    # Takes a function that returns the result of the national registry
+    # lookup, or raises its error.
+    def check_national_registry(self, reg, get_result):
         stdout.write('- Checking if %s is an individual in the national registry...' % reg['ssn'])
         stdout.flush()
 
-        national = jaapi.get_person(reg['ssn'])
+        national = get_result()
 
         if national['type'] == 'person':
             reg['national'] = national
@@ -277,6 +472,8 @@ class Command(BaseCommand):
             return True
         else:
             stdout.write(' no\n')
+            stdout.write('* Registration ignored.\n')
+            reg['outcome'] = ProcessedRegistration.IGNORED
 
             return False
 
@@ -285,12 +482,12 @@ class Command(BaseCommand):
         stdout.write('- Checking if registrant is already a member...')
         stdout.flush()
 
-        member_try = Member.objects.filter(ssn=reg['ssn'])
+        member = self.members.get(reg['ssn'])
 
-        if member_try.count() > 0:
+        if member is not None:
             stdout.write(' yes\n')
 
-            return member_try[0]
+            return member
         else:
             stdout.write(' no\n')
 
@@ -312,19 +509,29 @@ class Command(BaseCommand):
             body += 'The member was still registered as usual.\n'
             body += 'If no further action is needed, ignore this message.\n'
             body += 'Otherwise, act as considered appropriate.\n'
-            quick_mail(admin.email, u'Registration name inconsistent', body)
+            reg['mails'].append((admin.email, u'Registration name inconsistent', body))
 
         stdout.write(' done\n')
 
 
-    # Put member in appropriate groups
+    # Put member in appropriate groups. The memberships are added along with
+    # those of the other registrations (see `persist_registrations`).
     def process_groups(self, reg, member):
+        pending = set([(m.member_id, m.membergroup_id) for m in reg['memberships']])
+
         added_to_groups = False
-        for membergroup in MemberGroup.objects.filter(name__in=reg['member_assoc']).exclude(members=member):
-            stdout.write('* Adding member to group: %s...' % membergroup.name)
-            stdout.flush()
-            membergroup.members.add(member)
-            stdout.write(' done\n')
+        for group_name in reg['member_assoc']:
+            membergroup = self.groups.get(group_name)
+            if membergroup is None:
+                continue
+
+            membership = (member.id, membergroup.id)
+            if membership in self.memberships or membership in pending:
+                continue
+
+            stdout.write('* Adding member to group: %s\n' % membergroup.name)
+            pending.add(membership)
+            reg['memberships'].append(Member.membergroups.through(member_id=member.id, membergroup_id=membergroup.id))
 
             added_to_groups = True
 
@@ -349,7 +556,8 @@ class Command(BaseCommand):
         member.email_wanted = reg['email_ok']
         member.temporary_web_id = random_string
         member.temporary_web_id_timing = timezone.now()
-        member.update_from_national_registry(reg['national'])
+        # Answered from the response cached by `check_national_registry`.
+        member.update_from_national_registry()
 
         # Save member to database
         stdout.write('* Registering member...')
@@ -357,34 +565,18 @@ class Command(BaseCommand):
         member.save()
         stdout.write(' done\n')
 
+        reg['member'] = member
+
         self.process_groups(reg, member)
 
-        # Send confirmation message
-        stdout.write('* Sending confirmation email...')
+        # Send confirmation message, once everything has been persisted.
+        stdout.write('* Preparing confirmation email...')
         stdout.flush()
         message = InteractiveMessage.objects.get(interactive_type='registration_received')
-        message.send(member.email, member.temporary_web_id)
+        reg['mails'].append((member.email, message.subject, message.produce_links(member.temporary_web_id), message))
         stdout.write(' done\n')
 
 
-    # A bit of a hack to make sure we get US English formatted search date for the IMAP
-    def imap_dateformat(self, input_datetime):
-        old_locale = locale.setlocale(locale.LC_TIME, '')
-        locale.setlocale(locale.LC_TIME, 'en_US.UTF-8')
-        result = input_datetime.strftime('%d-%b-%Y')
-        locale.setlocale(locale.LC_TIME, old_locale)
-        return result
-
-
-    # A bit of a hack to make sure we get US English formatted search date for the IMAP
-    def imap_parse_datetime(self, input_string):
-        old_locale = locale.setlocale(locale.LC_TIME, '')
-        locale.setlocale(locale.LC_TIME, 'en_US.UTF-8')
-        result = dateparser.parse(input_string)
-        locale.setlocale(locale.LC_TIME, old_locale)
-        return result
-
-
     def parse_email_content(self, email_content):
         result = {
             'ssn': '',
@@ -393,7 +585,7 @@ class Command(BaseCommand):
             'email_ok': False,
         }
 
-        for line in email_content.split('\n'):
+        for line in email_content.splitlines():
             # This part is really ugly because we receive the email in a really ugly format
             if u'Nafn:' in line:
                 result['name'] = line.split(": ")[1]
@@ -416,10 +608,92 @@ class Command(BaseCommand):
 
         return result
 
-    def get_registration_requests(self):
+    # Identifies the configured mailbox in `MailboxSyncState`.
+    def get_mailbox_name(self):
+        return '%s:%s:%s' % (
+            settings.NEW_REGISTRATIONS_IMAP['server'],
+            settings.NEW_REGISTRATIONS_IMAP['username'],
+            settings.NEW_REGISTRATIONS_IMAP['inbox']
+        )
 
-        # Result variable
-        registrations = []
+    # Returns the UIDs of the messages that should be looked at, which are
+    # those newer than the last processed one if the mailbox has been read
+    # before. Otherwise, or if its UIDVALIDITY has changed, it falls back to
+    # searching for unread messages from the last few days.
+    def search_registrations(self, M, uidvalidity, sync_state):
+        filter_to_address = settings.NEW_REGISTRATIONS_IMAP['filter-to-address']
+
+        if sync_state is not None and sync_state.uidvalidity == uidvalidity:
+            stdout.write('UID filter: after %d\n' % sync_state.last_uid)
+            stdout.write('Searching by filter...')
+            stdout.flush()
+            result, data = M.uid(
+                'SEARCH',
+                'UID',
+                '%d:*' % (sync_state.last_uid + 1),
+                ('TO "%s"' % filter_to_address).encode('utf-8')
+            )
+
+            # The range "n:*" always includes the newest message, even if its
+            # UID is lower than n.
+            return [uid for uid in data[0].split() if int(uid) > sync_state.last_uid]
+
+        filter_since = timezone.now() - timedelta(days=settings.NEW_REGISTRATIONS_IMAP['filter-last-days'])
+        stdout.write('Date filter: since %s\n' % filter_since)
+        stdout.write('Searching by filter...')
+        stdout.flush()
+
+        # Construct IMAP search filter
+        search_string = u'(TO "%s" SINCE "%s")' % (
+            filter_to_address,
+            imap_date(filter_since)
+        )
+
+        # Search by previously constructed filter. Emails that are marked as
+        # unread will be processed, others ignored.
+        result, data = M.uid('SEARCH', search_string.encode('utf-8'), '(UNSEEN)')
+        return data[0].split()
+
+    # Fetches the messages with the given UIDs, in batches of `batch_size`,
+    # and yields each UID along with its message. Only the headers that we
+    # need and the body are fetched, and many messages are fetched with each
+    # command instead of one at a time.
+    def fetch_messages(self, M, uids, batch_size=100):
+        headers = 'SUBJECT DATE FROM MESSAGE-ID CONTENT-TYPE CONTENT-TRANSFER-ENCODING MIME-VERSION'
+
+        for start in range(0, len(uids), batch_size):
+            batch = uids[start:start+batch_size]
+            result, data = M.uid('FETCH', b','.join(batch), '(UID BODY[HEADER.FIELDS (%s)] BODY[TEXT])' % headers)
+
+            # The response consists of each message's parts, in the order
+            # that the server chooses, each followed by whatever comes after
+            # it, the last of which closes the message's parentheses.
+            uid = None
+            parts = {}
+            for item in data:
+                description = item[0] if isinstance(item, tuple) else item
+
+                match = re.search(rb'UID (\d+)', description)
+                if match:
+                    uid = match.group(1)
+
+                if isinstance(item, tuple):
+                    if b'HEADER' in description.rsplit(b'BODY[', 1)[-1]:
+                        parts['HEADER'] = item[1]
+                    else:
+                        parts['TEXT'] = item[1]
+                    continue
+
+                # Responses without any parts, such as flag updates, are not
+                # messages that we asked for.
+                if uid is not None and len(parts) > 0:
+                    yield uid, email.message_from_bytes(parts.get('HEADER', b'') + parts.get('TEXT', b''))
+                uid = None
+                parts = {}
+
+    # Returns the new messages in the registration mailbox, as (UID, message)
+    # pairs.
+    def fetch_registration_messages(self):
 
         # Make sure we have the registration configuration
         if hasattr(settings, 'NEW_REGISTRATIONS_IMAP'):
@@ -436,18 +710,19 @@ class Command(BaseCommand):
         imap_username = settings.NEW_REGISTRATIONS_IMAP['username']
         imap_password = settings.NEW_REGISTRATIONS_IMAP['password']
         imap_inbox = settings.NEW_REGISTRATIONS_IMAP['inbox']
- 
-        # Configurable filters
-        filter_to_address = settings.NEW_REGISTRATIONS_IMAP['filter-to-address']
-        filter_since = timezone.now() - timedelta(days=settings.NEW_REGISTRATIONS_IMAP['filter-last-days'])
 
-        stdout.write('Date filter: since %s\n' % filter_since)
+        # Optional, mostly for testing.
+        imap_port = settings.NEW_REGISTRATIONS_IMAP.get('port')
+        imap_ssl = settings.NEW_REGISTRATIONS_IMAP.get('ssl', True)
 
         # Connect to IMAP server
         stdout.write('Connecting to server %s...' % imap_server)
         stdout.flush()
         try:
-            M = imaplib.IMAP4_SSL(imap_server)
+            if imap_ssl:
+                M = imaplib.IMAP4_SSL(imap_server, imap_port or imaplib.IMAP4_SSL_PORT)
+            else:
+                M = imaplib.IMAP4(imap_server, imap_port or imaplib.IMAP4_PORT)
         except Exception as e:
             stdout.write(' failed: %s\n' % e)
             quit(1)
@@ -467,80 +742,112 @@ class Command(BaseCommand):
         stdout.write('Selecting inbox...')
         stdout.flush()
         M.select(imap_inbox)
+        uidvalidity = int(M.response('UIDVALIDITY')[1][0])
         stdout.write(' done\n')
 
-        # Construct IMAP search filter
-        search_string = u'(TO "%s" SINCE "%s")' % (
-            filter_to_address,
-            self.imap_dateformat(filter_since)
-        )
+        sync_state = MailboxSyncState.objects.filter(mailbox=self.get_mailbox_name()).first()
 
-        # Search by previously constructed filter. Emails that are marked as
-        # unread will be processed, others ignored.
-        stdout.write('Searching by filter...')
-        stdout.flush()
-        result, data = M.search(None, search_string.encode('utf-8'), '(UNSEEN)')
+        uids = self.search_registrations(M, uidvalidity, sync_state)
         stdout.write(' done\n')
 
-        # Iterate through received email messages
-        for num in data[0].split():
-            stdout.write('Parsing message %s: ' % num.decode('utf-8'))
+        if sync_state is not None and sync_state.uidvalidity == uidvalidity:
+            last_uid = sync_state.last_uid
+        else:
+            # The fallback search only finds recent unread messages, so the
+            # older ones are taken to have been dealt with already, instead
+            # of being read on the next run.
+            last_uid = self.get_newest_uid(M, imap_inbox)
+
+        messages = list(self.fetch_messages(M, uids))
+
+        # Close connection with IMAP server
+        M.close()
+        M.logout()
+
+        # Remember how far the mailbox has been read, once the registrations
+        # have been processed (see `save_sync_state`).
+        self.uidvalidity = uidvalidity
+        self.sync_state = (uidvalidity, max([int(uid) for uid in uids] + [last_uid]))
+
+        return messages
+
+    # Returns the UID of the newest message in the mailbox, or 0 if it's
+    # empty, according to the UID that the next message will get.
+    def get_newest_uid(self, M, inbox):
+        result, data = M.status(inbox, '(UIDNEXT)')
+        return int(re.search(rb'UIDNEXT (\d+)', data[0]).group(1)) - 1
+
+    # Returns the registrations in the given messages, skipping those that
+    # aren't registrations or can't be parsed.
+    def parse_registrations(self, messages):
+        registrations = []
+        for uid, email_message in messages:
+            stdout.write('Parsing message %s: ' % uid.decode('utf-8'))
             stdout.flush()
 
             try:
-                # Get the data in its basic form
-                result, data = M.fetch(num, '(RFC822)') #fetch message number num
-                raw_email = data[0][1].decode('utf-8')
-                email_message = email.message_from_string(raw_email)
+                registration = self.parse_registration(uid, email_message)
+                if registration is not None:
+                    registrations.append(registration)
+            except Exception as e:
+                stdout.write('\n')
+                stderr.write('Error: %s\n' % e)
 
-                if email_message.is_multipart(): # We have nothing to do with multipart messages
-                    stdout.write('[multipart garbage]\n')
-                    continue
+        return registrations
 
-                # This will contain the unprocessed information from the email
-                registration = {}
-
-                # Gather the email subject
-                subject = u''
-                for element in decode_header(email_message['subject']):
-                    try:
-                        subject = subject + ' ' + element[0].decode('utf-8')
-                    except UnicodeDecodeError:
-                        subject = subject + ' ' + element[0].decode('iso-8859-1')
-                    except AttributeError:
-                        subject = subject + ' ' + str(element[0])
-                    subject = subject.strip()
-
-                if subject[:19] != u'Skráning í Pírata: ':
-                    stdout.write('\n')
-                    continue
+    def parse_registration(self, uid, email_message):
+        if email_message.is_multipart(): # We have nothing to do with multipart messages
+            stdout.write('[multipart garbage]\n')
+            return None
 
-                # Get message timing
-                timing = self.imap_parse_datetime(email_message['Date'][0:25])
-                registration['date'] = timing.strftime("%Y-%m-%d %H:%M:%S")
-                stdout.write('%s: ' % registration['date'])
-                stdout.flush()
+        # This will contain the unprocessed information from the email
+        registration = {}
 
-                # Get email address
-                registration['email'] = email.utils.parseaddr(email_message['from'])[1]
-                stdout.write('%s' % registration['email'])
-                stdout.flush()
+        # Gather the email subject
+        subject = u''
+        for element in decode_header(email_message['subject']):
+            try:
+                subject = subject + ' ' + element[0].decode('utf-8')
+            except UnicodeDecodeError:
+                subject = subject + ' ' + element[0].decode('iso-8859-1')
+            except AttributeError:
+                subject = subject + ' ' + str(element[0])
+            subject = subject.strip()
+
+        if subject[:19] != u'Skráning í Pírata: ':
+            stdout.write('\n')
+            return None
 
-                # Parse the registration from the message
-                email_content = self.parse_email_content(email_message.get_payload(decode=True).decode('utf-8'))
-                registration.update(email_content)
+        # Get message timing
+        timing = parse_email_date(email_message['Date'])
+        registration['date'] = timing.strftime("%Y-%m-%d %H:%M:%S")
+        stdout.write('%s: ' % registration['date'])
+        stdout.flush()
 
-                registrations.append(registration)
+        # Identifies the registration (see `ProcessedRegistration`).
+        # Messages without a Message-ID are identified by their UID.
+        registration['message_id'] = (email_message['Message-ID'] or '').strip() or '%s:%d:%s' % (
+            self.get_mailbox_name(),
+            self.uidvalidity,
+            uid.decode('utf-8')
+        )
 
-                stdout.write('\n')
+        # Get email address
+        registration['email'] = email.utils.parseaddr(email_message['from'])[1]
+        stdout.write('%s' % registration['email'])
+        stdout.flush()
 
-            except Exception as e:
-                stderr.write('Error: %s\n' % e)
-                raise
+        # Parse the registration from the message
+        email_content = self.parse_email_content(email_message.get_payload(decode=True).decode('utf-8'))
+        registration.update(email_content)
 
-        # Close connection with IMAP server
-        M.close()
-        M.logout()
+        stdout.write('\n')
 
-        return registrations
+        return registration
 
+    def save_sync_state(self):
+        uidvalidity, last_uid = self.sync_state
+        MailboxSyncState.objects.update_or_create(
+            mailbox=self.get_mailbox_name(),
+            defaults={ 'uidvalidity': uidvalidity, 'last_uid': last_uid }
+        )
@@ -0,0 +1,84 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core import jaapi
+from core.jaapi import PersonNotFoundException
+from member.models import Member
+from member.models import NationalRegistryRefresh
+
+
+class Command(BaseCommand):
+    '''
+    Refreshes the national registry information of members that have been
+    queued for it (see `Member.request_national_registration_update`).
+    '''
+
+    # A refresh that keeps failing, for example because the national registry
+    # is unavailable, is given up on after this many attempts. It will be
+    # queued again the next time that the member's information is requested.
+    MAX_ATTEMPTS = 5
+
+    def add_arguments(self, parser):
+        # Keep running and process refreshes as they are queued, looking for
+        # them every `--poll-interval` seconds.
+        parser.add_argument('--daemon', action='store_true')
+        parser.add_argument('--poll-interval', type=int, default=10)
+
+    def handle(self, *args, **options):
+        print("--- Script started at %s ---" % timezone.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+        try:
+            self.process()
+            while options['daemon']:
+                time.sleep(options['poll_interval'])
+                self.process()
+        except KeyboardInterrupt:
+            pass
+
+        print('--- Script complete. ---')
+
+    def report(self):
+        stats = NationalRegistryRefresh.get_stats()
+        print('Refreshes queued: %d, longest wait: %s, most outdated information: %s' % (
+            stats['depth'],
+            stats['oldest_wait'] or '-',
+            stats['staleness'] or '-'
+        ))
+
+    def process(self):
+        refreshes = NationalRegistryRefresh.objects.select_related('member').order_by('requested')
+        if not refreshes.exists():
+            return
+
+        self.report()
+
+        for refresh in refreshes:
+            # Claim the refresh by removing it from the queue. If it's
+            # already gone, another process got to it first.
+            if NationalRegistryRefresh.objects.filter(id=refresh.id).delete()[0] == 0:
+                continue
+
+            member = refresh.member
+            try:
+                # The member was loaded along with the queue, so saving
+                # anything else could undo changes made since then.
+                if member.ensure_national_registration_updated():
+                    member.save(update_fields=Member.LEGAL_FIELDS)
+                print('- %s: refreshed' % member.ssn)
+            except PersonNotFoundException:
+                print('- %s: not found in the national registry' % member.ssn)
+            except Exception as e:
+                print('- %s: failed (%s: %s)' % (member.ssn, e.__class__.__name__, e))
+
+                # Put back in the queue for another attempt.
+                if refresh.attempts + 1 < self.MAX_ATTEMPTS:
+                    NationalRegistryRefresh.objects.get_or_create(
+                        member=member,
+                        defaults={ 'requested': refresh.requested, 'attempts': refresh.attempts + 1 }
+                    )
+
+        stats = jaapi.get_stats()
+        print('National registry lookups: %d cached, %d paid for' % (stats['hits'], stats['misses']))
+        self.report()
@@ -0,0 +1,166 @@
+import time
+
+from concurrent.futures import ALL_COMPLETED
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import F
+from django.db.models import Q
+from django.utils import timezone
+
+from core import jaapi
+from core.jaapi import PersonNotFoundException
+from member.models import Member
+
+
+class Command(BaseCommand):
+    '''
+    Refreshes the national registry information of every member whose
+    information is outdated (see `settings.NATIONAL_REGISTRY_EXPIRATION_DAYS`),
+    those who have never been looked up first, then the most outdated ones.
+
+    Since members are no longer outdated once refreshed, running the script
+    again after it has stopped, for example because the budget ran out,
+    continues where it stopped. People not found in the national registry
+    remain outdated, but their lookups are cached (see `core.jaapi`), so
+    looking them up again costs nothing.
+    '''
+
+    def add_arguments(self, parser):
+        # Number of lookups in progress at the same time.
+        parser.add_argument('--concurrency', type=int, default=4)
+
+        # The most that may be spent on lookups in this run, in
+        # `settings.NATIONAL_REGISTRY_LOOKUP_CURRENCY`. Unlimited by default.
+        parser.add_argument('--budget', type=int, default=getattr(settings, 'NATIONAL_REGISTRY_REFRESH_BUDGET', None))
+
+        # Number of attempts at a lookup that fails, for example because the
+        # national registry is unavailable, before giving up on the member
+        # for this run.
+        parser.add_argument('--attempts', type=int, default=3)
+
+        # Number of refreshed members written to the database at a time.
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        print("--- Script started at %s ---" % timezone.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+        self.batch_size = options['batch_size']
+        self.attempts = options['attempts']
+
+        # Refreshed members waiting to be written to the database.
+        self.pending = []
+
+        self.counts = {
+            'refreshed': 0,
+            'not_found': 0,
+            'failed': 0,
+        }
+
+        threshold = timezone.now() - timedelta(days=settings.NATIONAL_REGISTRY_EXPIRATION_DAYS)
+
+        # Only the IDs and SSNs are loaded, all at once, so that writing to
+        # the members doesn't interfere with iterating through them. Since
+        # only the legal fields are written, nothing else is needed.
+        outdated = list(Member.objects.filter(
+            Q(legal_lookup_timing=None) | Q(legal_lookup_timing__lt=threshold)
+        ).order_by(
+            F('legal_lookup_timing').asc(nulls_first=True),
+            'id'
+        ).values_list('id', 'ssn'))
+
+        print('Outdated members: %d' % len(outdated))
+
+        budget = options['budget']
+        cost = settings.NATIONAL_REGISTRY_LOOKUP_COST
+        start_cost = jaapi.get_stats()['cost']
+
+        in_flight = {}
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            try:
+                for member_id, ssn in outdated:
+                    # Every lookup in flight may turn out to cost money, so
+                    # the budget must cover all of them.
+                    spent = jaapi.get_stats()['cost'] - start_cost
+                    if budget is not None and spent + (len(in_flight) + 1) * cost > budget:
+                        print('Budget of %d %s reached.' % (budget, settings.NATIONAL_REGISTRY_LOOKUP_CURRENCY))
+                        break
+
+                    in_flight[executor.submit(self.lookup, ssn)] = Member(id=member_id, ssn=ssn)
+
+                    if len(in_flight) >= options['concurrency']:
+                        self.collect(in_flight, FIRST_COMPLETED)
+
+            finally:
+                # Whatever has been looked up, and paid for, gets written,
+                # even if the script is stopped.
+                self.collect(in_flight, ALL_COMPLETED)
+                self.write()
+
+        print('Refreshed: %d, not found: %d, failed: %d, cost: %d %s' % (
+            self.counts['refreshed'],
+            self.counts['not_found'],
+            self.counts['failed'],
+            jaapi.get_stats()['cost'] - start_cost,
+            settings.NATIONAL_REGISTRY_LOOKUP_CURRENCY
+        ))
+        print('--- Script complete. ---')
+
+    # Runs in the thread pool.
+    def lookup(self, ssn):
+        try:
+            attempt = 1
+            while True:
+                try:
+                    return jaapi.lookup_person(ssn)
+                except PersonNotFoundException:
+                    raise
+                except Exception:
+                    if attempt >= self.attempts:
+                        raise
+                    time.sleep(2 ** attempt)
+                    attempt += 1
+        finally:
+            # Each thread has its own database connection.
+            connection.close()
+
+    # Waits for lookups in flight to complete, either the first one or all of
+    # them, and applies the results to their members.
+    def collect(self, in_flight, return_when):
+        if len(in_flight) == 0:
+            return
+
+        done, not_done = wait(in_flight.keys(), return_when=return_when)
+        for future in done:
+            member = in_flight.pop(future)
+            try:
+                person_data, lookup_timing = future.result()
+            except PersonNotFoundException:
+                print('- %s: not found in the national registry' % member.ssn)
+                self.counts['not_found'] += 1
+                continue
+            except Exception as e:
+                print('- %s: failed (%s: %s)' % (member.ssn, e.__class__.__name__, e))
+                self.counts['failed'] += 1
+                continue
+
+            member.update_from_national_registry(person_data, lookup_timing)
+            self.pending.append(member)
+            self.counts['refreshed'] += 1
+
+            if len(self.pending) >= self.batch_size:
+                self.write()
+
+    def write(self):
+        if len(self.pending) == 0:
+            return
+
+        Member.objects.bulk_update(self.pending, Member.LEGAL_FIELDS)
+        print('- Refreshed %d members' % len(self.pending))
+        self.pending = []
@@ -24,14 +24,24 @@ class SafetyManager(Manager):
         if user.is_superuser:
             return self
         else:
+            from member.graph import get_graph
+
             Member = apps.get_model('member', 'Member')
             MemberGroup = apps.get_model('member', 'MemberGroup')
             Message = apps.get_model('message', 'Message')
+
+            # Which groups the user is an admin of is looked up in memory,
+            # instead of being joined into every query (see `member.graph`).
+            graph = get_graph()
+            administered_ids = graph.get_administered_ids(user)
+
             if self.model is Member:
-                return self.filter(membergroups__admins=user).distinct()
+                # Members of the automatic subgroups of a group, at any depth,
+                # are also members of that group (see `MemberGroupAncestry`).
+                return self.filter(membergroups__in=graph.get_descendant_ids(administered_ids)).distinct()
             elif self.model is MemberGroup:
-                return self.filter(admins=user).distinct()
+                return self.filter(id__in=administered_ids)
             elif self.model is Message:
-                return self.filter(Q(membergroups__admins=user) | Q(send_to_all=True)).distinct()
+                return self.filter(Q(membergroups__in=administered_ids) | Q(send_to_all=True)).distinct()
             else:
                 raise NotImplementedError()
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+import io
+import re
+import smtplib
+import socketserver
+import threading
+
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
+
+from core.models import MailboxSyncState
+from core.models import ProcessedRegistration
+from icepirate.management.commands.process_registrations import Command as ProcessRegistrationsCommand
+from icepirate.utils import imap_date
+from icepirate.utils import parse_email_date
+from member.models import Member
+from member.models import MemberGroup
+from message.models import InteractiveMessage
+
+
+class IMAPStandInHandler(socketserver.StreamRequestHandler):
+    '''
+    Speaks just enough IMAP for `process_registrations` to read the server's
+    `messages`, which are (UID, bytes) pairs, and keeps a log of the commands
+    that it receives. Messages are unread unless their UIDs are in `seen`.
+    '''
+
+    def send(self, line):
+        self.wfile.write(line + b'\r\n')
+
+    def handle(self):
+        self.send(b'* OK IMAP stand-in ready')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            tag, command = line.rstrip(b'\r\n').split(b' ', 1)
+            self.server.commands.append(command)
+            name = command.split(b' ')[0].upper()
+
+            if name == b'CAPABILITY':
+                self.send(b'* CAPABILITY IMAP4rev1')
+            elif name == b'SELECT':
+                self.send(b'* %d EXISTS' % len(self.server.messages))
+                self.send(b'* OK [UIDVALIDITY %d] UIDs valid' % self.server.uidvalidity)
+            elif name == b'STATUS':
+                uidnext = max([uid for uid, message in self.server.messages] + [0]) + 1
+                self.send(b'* STATUS %s (UIDNEXT %d)' % (command.split(b' ')[1], uidnext))
+            elif command.upper().startswith(b'UID SEARCH'):
+                uids = [uid for uid, message in self.server.messages]
+                if b'UNSEEN' in command.upper() and self.server.seen is not None:
+                    uids = [uid for uid in uids if uid not in self.server.seen]
+                match = re.search(rb'UID (\d+):\*', command)
+                if match:
+                    # Like real servers, the newest message is always in the
+                    # range, even when its UID is lower.
+                    uids = [uid for uid in uids if uid >= int(match.group(1))] or uids[-1:]
+                self.send(b' '.join([b'* SEARCH'] + [b'%d' % uid for uid in uids]))
+            elif command.upper().startswith(b'UID FETCH'):
+                wanted = [int(uid) for uid in command.split(b' ')[2].split(b',')]
+                for sequence, (uid, message) in enumerate(self.server.messages, 1):
+                    if uid not in wanted:
+                        continue
+                    header, text = message.split(b'\r\n\r\n', 1)
+                    header += b'\r\n\r\n'
+                    self.send(b'* %d FETCH (UID %d BODY[HEADER.FIELDS (SUBJECT DATE FROM)] {%d}' % (
+                        sequence,
+                        uid,
+                        len(header)
+                    ))
+                    self.wfile.write(header)
+                    self.send(b' BODY[TEXT] {%d}' % len(text))
+                    self.wfile.write(text)
+                    self.send(b')')
+            elif name == b'LOGOUT':
+                self.send(b'* BYE')
+                self.send(tag + b' OK LOGOUT completed')
+                return
+
+            self.send(tag + b' OK %s completed' % name)
+
+
+class IMAPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, uidvalidity, messages):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), IMAPStandInHandler)
+        self.uidvalidity = uidvalidity
+        self.messages = messages
+        self.commands = []
+        self.seen = None
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def registration_email(name, ssn, message_id=None, group='Ekkert'):
+    return (
+        'Subject: =?utf-8?q?Skr=C3=A1ning_=C3=AD_P=C3=ADrata=3A_%s?=\r\n'
+        'Date: Mon, 12 Oct 2026 12:00:00 +0000\r\n'
+        'Message-ID: <%s@example.com>\r\n'
+        'From: %s <%s@example.com>\r\n'
+        'Content-Type: text/plain; charset=utf-8\r\n'
+        'Content-Transfer-Encoding: 8bit\r\n'
+        '\r\n'
+        'Nafn: %s\r\n'
+        'Kennitala: %s\r\n'
+        'Svæðisbundið aðildarfélag: %s\r\n'
+    ) % (name, message_id or ssn, name, ssn, name, ssn, group)
+
+
+class DateTest(TestCase):
+
+    @override_settings(TIME_ZONE='Atlantic/Reykjavik')
+    def test_dates(self):
+        self.assertEqual(imap_date(datetime.date(2026, 3, 5)), '05-Mar-2026')
+
+        for value in (
+            'Mon, 12 Oct 2026 12:00:00 +0000',
+            '12 Oct 2026 13:00:00 +0100',
+            'Mon, 12 Oct 2026 08:00:00 -0400 (EDT)',
+            'Mon, 12 Oct 2026 12:00:00 GMT',
+        ):
+            self.assertEqual(
+                parse_email_date(value).strftime('%Y-%m-%d %H:%M:%S'),
+                '2026-10-12 12:00:00'
+            )
+
+
+class RegistrationMailboxTest(TestCase):
+
+    def get_imap_settings(self, server):
+        return {
+            'server': '127.0.0.1',
+            'port': server.server_address[1],
+            'ssl': False,
+            'username': 'username',
+            'password': 'password',
+            'inbox': 'inbox',
+            'filter-to-address': 'registrations@example.com',
+            'filter-last-days': 3,
+        }
+
+    def read_mailbox(self, server):
+        command = ProcessRegistrationsCommand()
+
+        with override_settings(NEW_REGISTRATIONS_IMAP=self.get_imap_settings(server)):
+            with mock.patch('icepirate.management.commands.process_registrations.stdout', io.StringIO()):
+                registrations = command.parse_registrations(command.fetch_registration_messages())
+                command.save_sync_state()
+
+        return [reg['ssn'] for reg in registrations]
+
+    # Configures what processing registrations needs, and returns what the
+    # national registry says about everyone registering.
+    def set_up_registrations(self):
+        User.objects.create(username='admin', email='admin@example.com', is_staff=True)
+        InteractiveMessage.objects.create(
+            interactive_type='registration_received',
+            subject='Registration received',
+            body='{{confirm}} {{reject}}',
+            author=User.objects.get()
+        )
+
+        return {
+            'type': 'person',
+            'name': 'Legal Name',
+            'permanent_address': {
+                'street': { 'dative': 'Street 1' },
+                'postal_code': '101',
+                'municipality': '0000',
+                'town': { 'dative': 'Town' },
+                'country': { 'code': 'IS' },
+            },
+        }
+
+    def test_incremental_sync(self):
+        messages = [
+            (uid, registration_email('Person', '%010d' % uid).encode('utf-8'))
+            for uid in (3, 5)
+        ]
+
+        with IMAPStandIn(7, messages) as server:
+            self.assertEqual(self.read_mailbox(server), ['0000000003', '0000000005'])
+
+            # Only newer messages are fetched, all at once.
+            server.messages.append((8, registration_email('Person', '0000000008').encode('utf-8')))
+            server.messages.append((9, registration_email('Person', '0000000009').encode('utf-8')))
+            server.commands = []
+            self.assertEqual(self.read_mailbox(server), ['0000000008', '0000000009'])
+            self.assertIn(b'UID FETCH 8,9 (UID BODY[HEADER.FIELDS', b' '.join(server.commands))
+
+            # Nothing new, nothing fetched.
+            server.commands = []
+            self.assertEqual(self.read_mailbox(server), [])
+            self.assertFalse([command for command in server.commands if b'FETCH' in command])
+
+            # A new UIDVALIDITY means that the UIDs can't be trusted, so the
+            # mailbox is read again.
+            server.uidvalidity = 8
+            self.assertEqual(len(self.read_mailbox(server)), 4)
+
+        self.assertEqual(MailboxSyncState.objects.get().last_uid, 9)
+
+    def test_old_mail_not_read(self):
+        messages = [
+            (uid, registration_email('Person', '%010d' % uid).encode('utf-8'))
+            for uid in (1, 2, 3)
+        ]
+
+        with IMAPStandIn(7, messages) as server:
+            # The first time, only unread messages are looked at, and those
+            # already read are left alone for good.
+            server.seen = set([1, 2, 3])
+            self.assertEqual(self.read_mailbox(server), [])
+            self.assertEqual(MailboxSyncState.objects.get().last_uid, 3)
+
+            server.messages.append((4, registration_email('Person', '0000000004').encode('utf-8')))
+            self.assertEqual(self.read_mailbox(server), ['0000000004'])
+
+            # So are those that were read when the UIDVALIDITY changes.
+            server.uidvalidity = 8
+            server.seen = set([1, 2, 3, 4])
+            self.assertEqual(self.read_mailbox(server), [])
+
+            server.messages.append((5, registration_email('Person', '0000000005').encode('utf-8')))
+            self.assertEqual(self.read_mailbox(server), ['0000000005'])
+
+    def test_processed_once(self):
+        person = self.set_up_registrations()
+        group = MemberGroup.objects.create(name='Group', techname='group', email='group@example.com')
+
+        # The same person registers twice, with a name that doesn't match the
+        # national registry, the second time also joining a group.
+        messages = [
+            (1, registration_email('Person', '0101302989', message_id='registration-1').encode('utf-8')),
+            (2, registration_email('Person', '0101302989', message_id='registration-2', group='Group').encode('utf-8')),
+        ]
+
+        with IMAPStandIn(1, messages) as server:
+            with override_settings(NEW_REGISTRATIONS_IMAP=self.get_imap_settings(server)), \
+                    mock.patch('core.jaapi.lookup_person', return_value=(person, timezone.now())), \
+                    mock.patch('icepirate.management.commands.process_registrations.stdout', io.StringIO()):
+                call_command('process_registrations')
+
+                # Reading the mailbox again from the start processes nothing.
+                MailboxSyncState.objects.all().delete()
+                call_command('process_registrations')
+
+        self.assertEqual(Member.objects.count(), 1)
+        self.assertEqual(
+            sorted(ProcessedRegistration.objects.values_list('message_id', 'outcome')),
+            [
+                ('<registration-1@example.com>', ProcessedRegistration.REGISTERED),
+                ('<registration-2@example.com>', ProcessedRegistration.UPDATED),
+            ]
+        )
+        self.assertEqual(list(Member.objects.get().membergroups.all()), [group])
+
+        # The admin was notified of the name mismatch, and the member was
+        # sent a confirmation, once each.
+        self.assertEqual(
+            sorted(message.subject.split('] ')[-1] for message in mail.outbox),
+            ['Registration name inconsistent', 'Registration received']
+        )
+
+    def test_failure_isolated(self):
+        person = self.set_up_registrations()
+
+        def lookup_person(ssn):
+            if ssn == '0101302129':
+                raise ConnectionError('National registry unavailable')
+            return person, timezone.now()
+
+        messages = [
+            (uid, registration_email('Legal Name', ssn).encode('utf-8'))
+            for uid, ssn in enumerate(['0101302049', '0101302129', '0101302209'], 1)
+        ]
+
+        with IMAPStandIn(1, messages) as server:
+            with override_settings(NEW_REGISTRATIONS_IMAP=self.get_imap_settings(server)), \
+                    mock.patch('core.jaapi.lookup_person', side_effect=lookup_person), \
+                    mock.patch('icepirate.management.commands.process_registrations.stdout', io.StringIO()):
+                call_command('process_registrations')
+
+        # The registration whose lookup failed doesn't keep the others in the
+        # same batch from being registered and sent their confirmations.
+        self.assertEqual(
+            sorted(ProcessedRegistration.objects.values_list('message_id', 'outcome')),
+            [
+                ('<0101302049@example.com>', ProcessedRegistration.REGISTERED),
+                ('<0101302129@example.com>', ProcessedRegistration.FAILED),
+                ('<0101302209@example.com>', ProcessedRegistration.REGISTERED),
+            ]
+        )
+        self.assertEqual(sorted(Member.objects.values_list('ssn', flat=True)), ['0101302049', '0101302209'])
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            ['0101302049@example.com', '0101302209@example.com']
+        )
+
+    def test_notify_failure(self):
+        person = self.set_up_registrations()
+        messages = [(1, registration_email('Person', '0101302989').encode('utf-8'))]
+
+        with IMAPStandIn(1, messages) as server:
+            with override_settings(NEW_REGISTRATIONS_IMAP=self.get_imap_settings(server)), \
+                    mock.patch('core.jaapi.lookup_person', return_value=(person, timezone.now())), \
+                    mock.patch('django.core.mail.EmailMessage.send', side_effect=smtplib.SMTPServerDisconnected()), \
+                    mock.patch('icepirate.management.commands.process_registrations.stdout', io.StringIO()) as output:
+                call_command('process_registrations')
+
+        # Neither the admins nor the member could be emailed, but the member
+        # was registered all the same.
+        self.assertEqual(output.getvalue().count(' failed: '), 2)
+        self.assertEqual(Member.objects.get().ssn, '0101302989')
+        self.assertEqual(ProcessedRegistration.objects.get().outcome, ProcessedRegistration.REGISTERED)
+
+    def test_failed_membership_not_assumed(self):
+        self.set_up_registrations()
+        group = MemberGroup.objects.create(name='Group', techname='group', email='group@example.com')
+        member = Member.objects.create(ssn='0101302989', name='Person', email='0101302989@example.com')
+
+        messages = [
+            (uid, registration_email('Person', '0101302989', message_id='registration-%d' % uid, group='Group').encode('utf-8'))
+            for uid in (1, 2)
+        ]
+
+        # The first registration fails after having been put in the group,
+        # which the second one must not take to mean that they are in it.
+        check_if_emails_differ = mock.Mock(side_effect=[Exception('Failed'), False])
+
+        with IMAPStandIn(1, messages) as server:
+            with override_settings(NEW_REGISTRATIONS_IMAP=self.get_imap_settings(server)), \
+                    mock.patch.object(ProcessRegistrationsCommand, 'check_if_emails_differ', check_if_emails_differ), \
+                    mock.patch('icepirate.management.commands.process_registrations.stdout', io.StringIO()):
+                call_command('process_registrations')
+
+        self.assertEqual(
+            sorted(ProcessedRegistration.objects.values_list('message_id', 'outcome')),
+            [
+                ('<registration-1@example.com>', ProcessedRegistration.FAILED),
+                ('<registration-2@example.com>', ProcessedRegistration.UPDATED),
+            ]
+        )
+        self.assertEqual(list(member.membergroups.all()), [group])
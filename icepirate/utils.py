@@ -4,8 +4,12 @@ import json
 import os
 import time
 from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
 from django.http import HttpResponse
-from django_mdmail import send_mail
+from django.utils import timezone
+from email.mime.image import MIMEImage
+from email.utils import parsedate_to_datetime
+from mdmail import EmailContent
 
 import re
 
@@ -51,25 +55,62 @@ def techify(input_string):
 
     return result
 
-def quick_mail(to, subject, body, from_email=None, subject_prefix=settings.EMAIL_SUBJECT_PREFIX):
+# Custom CSS to be used with email. Read from disk only once per process.
+_email_css = None
+def email_css():
+    global _email_css
+    if _email_css is None:
+        css_filename = os.path.join(str(settings.BASE_DIR), 'icepirate', 'static', 'icepirate', 'css', 'email.css')
+        with open(css_filename, 'r') as f:
+            _email_css = f.read()
+    return _email_css
+
+# Have `mdmail` turn a Markdown body into plain text and HTML with the CSS
+# inlined. Returns the text, the HTML and a list of inline images as
+# (filename, data) tuples.
+def render_mail(body):
+    content = EmailContent(body, css=email_css())
+    images = [(filename, data.read()) for filename, data in content.inline_images]
+    return content.text, content.html, images
+
+# Assembles an already rendered email. This is the same thing that
+# `django_mdmail.send_mail` does, except that we hand the email back instead
+# of sending it, so that the caller may decide on which connection it should
+# be sent.
+def assemble_mail(to, subject, text, html, images=[], from_email=None, subject_prefix=settings.EMAIL_SUBJECT_PREFIX, connection=None):
 
     real_subject = subject
     if subject_prefix:
         real_subject = u'[%s] %s' % (subject_prefix, real_subject)
 
-    # Custom CSS to be used with email.
-    css_filename = os.path.join(str(settings.BASE_DIR), 'icepirate', 'static', 'icepirate', 'css', 'email.css')
-    with open(css_filename, 'r') as f:
-        css = f.read()
-
-    return send_mail(
+    email = EmailMultiAlternatives(
         real_subject,
-        body,
-        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
-        recipient_list=[to,],
-        fail_silently=False,
-        css=css
+        text,
+        from_email or settings.DEFAULT_FROM_EMAIL,
+        [to,],
+        connection=connection
     )
+    email.attach_alternative(html, 'text/html')
+    email.mixed_subtype = 'related'
+
+    for filename, data in images:
+        image = MIMEImage(data)
+        image.add_header('Content-ID', '<%s>' % filename)
+        image.add_header('Content-Disposition', 'attachment; filename=%s' % filename)
+        email.attach(image)
+
+    return email
+
+def make_mail(to, subject, body, from_email=None, subject_prefix=settings.EMAIL_SUBJECT_PREFIX, connection=None):
+    text, html, images = render_mail(body)
+    return assemble_mail(to, subject, text, html, images, from_email, subject_prefix, connection)
+
+# When `connection` is given, the email is sent over it instead of a new
+# connection being opened just for this one email (see
+# `message.sending.PersistentConnection`).
+def quick_mail(to, subject, body, from_email=None, subject_prefix=settings.EMAIL_SUBJECT_PREFIX, connection=None):
+    email = make_mail(to, subject, body, from_email, subject_prefix, connection)
+    return email.send(fail_silently=False)
 
 def generate_random_string():
     some_random = hashlib.sha1(os.urandom(128)).hexdigest()[:40]
@@ -86,6 +127,22 @@ def generate_random_string():
         '%x%x%s' % (os.getpid(), now, some_random)
         ).replace('.', '')[:40]
 
+# Month names as used in IMAP and email dates, which are always in English.
+MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+# Formats a date for IMAP searches, for example "05-Oct-2026", regardless of
+# the locale.
+def imap_date(input_date):
+    return '%02d-%s-%04d' % (input_date.day, MONTH_NAMES[input_date.month - 1], input_date.year)
+
+# Parses the Date header of an email (RFC 2822) regardless of the locale, and
+# returns it in the local time zone, unless the header has no time zone.
+def parse_email_date(value):
+    result = parsedate_to_datetime(value)
+    if timezone.is_naive(result):
+        return result
+    return timezone.localtime(result)
+
 def json_error(exception):
     response_data = {
         'success': False,
@@ -0,0 +1,80 @@
+'''
+Benchmarks for members. These are not run along with the tests, since they
+take a while and only report numbers. Run them with:
+
+    ./manage.py test member.benchmarks
+'''
+import time
+import tracemalloc
+
+from django.test import TransactionTestCase
+
+from member.models import Member
+from member.models import MemberGroup
+from member.views_csv import COLUMNS
+from member.views_csv import generate_lines
+
+
+class CsvExportBenchmark(TransactionTestCase):
+    '''
+    Compares the memory used to export every member as CSV, and the time it
+    takes, to how `member.views_csv.list` used to do it, by building the whole
+    file as one string from fully loaded members.
+    '''
+
+    MEMBER_COUNT = 200000
+
+    def setUp(self):
+        group = MemberGroup.objects.create(name='Group', techname='group', email='group@example.com')
+
+        Member.objects.bulk_create([
+            Member(
+                ssn='%010d' % i,
+                name='Member %d' % i,
+                email='member%d@example.com' % i,
+                email_wanted=True
+            ) for i in range(self.MEMBER_COUNT)
+        ], batch_size=1000)
+
+        Membership = Member.membergroups.through
+        Membership.objects.bulk_create([
+            Membership(member_id=member_id, membergroup_id=group.id)
+            for member_id in Member.objects.values_list('id', flat=True)
+        ], batch_size=1000)
+
+    def export_old(self):
+        lines = []
+        lines.append('#%s' % ','.join(['"%s"' % field for field in ['SSN', 'Email']]))
+        for m in Member.objects.prefetch_related('membergroups'):
+            lines.append(','.join(['"%s"' % value for value in [m.ssn, m.email]]))
+        return len('\n'.join(lines))
+
+    def export_streaming(self, column_names):
+        columns = [column for column in COLUMNS if column[0] in column_names]
+
+        # Consumed the way that the response is sent, a line at a time.
+        size = 0
+        for line in generate_lines(Member.objects.all(), columns):
+            size += len(line)
+        return size
+
+    def measure(self, label, function, *args):
+        tracemalloc.start()
+        start = time.time()
+        size = function(*args)
+        seconds = time.time() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('\n%s: %d members, %.1f MB of CSV in %.2f seconds, peak memory %.1f MB' % (
+            label,
+            self.MEMBER_COUNT,
+            size / 1024.0 / 1024.0,
+            seconds,
+            peak / 1024.0 / 1024.0
+        ))
+
+    def test_export(self):
+        self.measure('Whole file at once', self.export_old)
+        self.measure('Streaming', self.export_streaming, ['ssn', 'email'])
+        self.measure('Streaming, with groups', self.export_streaming, ['ssn', 'email', 'groups'])
@@ -0,0 +1,124 @@
+'''
+An in-memory snapshot of every MemberGroup along with its automatic
+subgroups, the municipalities that make members eligible for it, and its
+admins. These change a few times a month at most, but are needed on nearly
+every request, so instead of querying them every time, each process loads
+them once and keeps them until they change.
+
+Every change to the groups bumps the version of the snapshot in the database
+(see `core.models.CacheVersion` and the signal receivers in `member.models`).
+The process making the change drops its snapshot right away, while other
+processes check the version every `settings.MEMBERGROUP_GRAPH_CHECK_SECONDS`
+seconds and reload when it has changed.
+
+Usage:
+    graph = get_graph()
+    membergroups = graph.get_groups(graph.get_administered_ids(request.user))
+'''
+import threading
+import time
+
+from django.conf import settings
+
+from core.models import CacheVersion
+from member.models import MemberGroup
+from member.models import MemberGroupAncestry
+
+VERSION_NAME = 'membergroup_graph'
+
+_graph = None
+_checked = 0
+_lock = threading.Lock()
+
+
+class MemberGroupGraph(object):
+
+    def __init__(self, version):
+        self.version = version
+
+        # In the groups' default order, by name.
+        self.groups = dict([(group.id, group) for group in MemberGroup.objects.all()])
+
+        self.subgroup_ids = {}
+        for parent_id, subgroup_id in MemberGroup.auto_subgroups.through.objects.values_list(
+            'from_membergroup_id',
+            'to_membergroup_id'
+        ):
+            self.subgroup_ids.setdefault(parent_id, set()).add(subgroup_id)
+
+        # Both include the group itself (see `MemberGroupAncestry`).
+        self.descendant_ids = {}
+        self.ancestor_ids = {}
+        for ancestor_id, descendant_id in MemberGroupAncestry.objects.values_list('ancestor_id', 'descendant_id'):
+            self.descendant_ids.setdefault(ancestor_id, set()).add(descendant_id)
+            self.ancestor_ids.setdefault(descendant_id, set()).add(ancestor_id)
+
+        self.admin_group_ids = {}
+        for group_id, user_id in MemberGroup.admins.through.objects.values_list('membergroup_id', 'user_id'):
+            self.admin_group_ids.setdefault(user_id, set()).add(group_id)
+
+        self.municipality_group_ids = {}
+        for group_id, municipality_id in MemberGroup.condition_municipalities.through.objects.values_list(
+            'membergroup_id',
+            'municipality_id'
+        ):
+            self.municipality_group_ids.setdefault(municipality_id, set()).add(group_id)
+
+    # Returns the groups with the given IDs, or all of them, ordered by name.
+    def get_groups(self, group_ids=None):
+        if group_ids is None:
+            return list(self.groups.values())
+        return [group for group_id, group in self.groups.items() if group_id in group_ids]
+
+    def get_subgroups(self, group_id):
+        return self.get_groups(self.subgroup_ids.get(group_id, set()))
+
+    # The IDs of the given groups and all of their subgroups, at any depth.
+    def get_descendant_ids(self, group_ids):
+        descendant_ids = set()
+        for group_id in group_ids:
+            descendant_ids |= self.descendant_ids.get(group_id, set([group_id]))
+        return descendant_ids
+
+    # The IDs of the given groups and all the groups that they are automatic
+    # subgroups of, at any depth.
+    def get_ancestor_ids(self, group_ids):
+        ancestor_ids = set()
+        for group_id in group_ids:
+            ancestor_ids |= self.ancestor_ids.get(group_id, set([group_id]))
+        return ancestor_ids
+
+    # The IDs of the groups that the given user is an admin of.
+    def get_administered_ids(self, user):
+        return self.admin_group_ids.get(user.id, set())
+
+    # The IDs of the groups that members in the given municipality are
+    # eligible for.
+    def get_eligible_ids(self, municipality_id):
+        return self.municipality_group_ids.get(municipality_id, set())
+
+
+# Returns the current snapshot of the groups, loading it if needed.
+def get_graph():
+    global _graph, _checked
+
+    check_seconds = getattr(settings, 'MEMBERGROUP_GRAPH_CHECK_SECONDS', 5)
+
+    with _lock:
+        if _graph is None or time.time() - _checked >= check_seconds:
+            version = CacheVersion.get(VERSION_NAME)
+            if _graph is None or _graph.version != version:
+                _graph = MemberGroupGraph(version)
+            _checked = time.time()
+
+        return _graph
+
+
+# Marks every snapshot out of date, including those of other processes.
+def invalidate_graph():
+    global _graph
+
+    CacheVersion.bump(VERSION_NAME)
+
+    with _lock:
+        _graph = None
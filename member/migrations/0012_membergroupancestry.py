@@ -0,0 +1,59 @@
+# Generated by Django 4.2.15 on 2026-10-18 14:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Fills the table with the ancestry of the groups that already exist, the same
+# way as `MemberGroupAncestry.rebuild`.
+def build_ancestry(apps, schema_editor):
+    MemberGroup = apps.get_model('member', 'MemberGroup')
+    MemberGroupAncestry = apps.get_model('member', 'MemberGroupAncestry')
+
+    subgroups = {}
+    for parent_id, subgroup_id in MemberGroup.auto_subgroups.through.objects.values_list(
+        'from_membergroup_id',
+        'to_membergroup_id'
+    ):
+        subgroups.setdefault(parent_id, []).append(subgroup_id)
+
+    paths = []
+    for group_id in MemberGroup.objects.values_list('id', flat=True):
+        depths = { group_id: 0 }
+        queue = [group_id]
+        while len(queue) > 0:
+            current_id = queue.pop(0)
+            for subgroup_id in subgroups.get(current_id, []):
+                if subgroup_id not in depths:
+                    depths[subgroup_id] = depths[current_id] + 1
+                    queue.append(subgroup_id)
+
+        paths.extend([
+            MemberGroupAncestry(ancestor_id=group_id, descendant_id=descendant_id, depth=depth)
+            for descendant_id, depth in depths.items()
+        ])
+
+    MemberGroupAncestry.objects.bulk_create(paths)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('member', '0011_alter_member_email_wanted'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MemberGroupAncestry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_paths', to='member.membergroup')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_paths', to='member.membergroup')),
+            ],
+            options={
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        migrations.RunPython(build_ancestry, migrations.RunPython.noop),
+    ]
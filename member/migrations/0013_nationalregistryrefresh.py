@@ -0,0 +1,24 @@
+# Generated by Django 4.2.15 on 2026-10-18 14:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('member', '0012_membergroupancestry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NationalRegistryRefresh',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('requested', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.IntegerField(default=0)),
+                ('member', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='national_registry_refresh', to='member.member')),
+            ],
+        ),
+    ]
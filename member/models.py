@@ -3,6 +3,11 @@ import time
 
 from core import jaapi
 from django.db import models
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.conf import settings
 from django.utils import timezone
 from datetime import datetime
@@ -57,6 +62,19 @@ class Member(models.Model):
     legal_country_code = models.CharField(max_length=2, null=True)
     legal_lookup_timing = models.DateTimeField(null=True)
 
+    # Fields set by `update_from_national_registry`, so that only they need to
+    # be saved after refreshing a member's national registry information.
+    LEGAL_FIELDS = [
+        'legal_name',
+        'legal_address',
+        'legal_zip_code',
+        'legal_municipality_code',
+        'legal_municipality',
+        'legal_zone',
+        'legal_country_code',
+        'legal_lookup_timing',
+    ]
+
     temporary_web_id = models.CharField(max_length=40, unique=True, null=True)
     temporary_web_id_timing = models.DateTimeField(null=True)
 
@@ -83,18 +101,40 @@ class Member(models.Model):
     def ensure_national_registration_updated(self):
         updated = False
 
-        threshold = timezone.now() - timedelta(
-            days=settings.NATIONAL_REGISTRY_EXPIRATION_DAYS
-        )
-        if self.legal_lookup_timing is None or self.legal_lookup_timing < threshold:
+        if self.is_national_registration_outdated():
             self.update_from_national_registry()
             updated = True
 
         return updated
 
-    def update_from_national_registry(self, person_data=None):
+    def is_national_registration_outdated(self):
+        threshold = timezone.now() - timedelta(
+            days=settings.NATIONAL_REGISTRY_EXPIRATION_DAYS
+        )
+        return self.legal_lookup_timing is None or self.legal_lookup_timing < threshold
+
+    # Like `ensure_national_registration_updated`, except that outdated
+    # information is refreshed later by the `process_registry_refreshes`
+    # script, instead of making the caller wait for the national registry.
+    # Only when there is no information at all, is it looked up right away.
+    # Returns True if the information was updated.
+    def request_national_registration_update(self):
+        if self.legal_lookup_timing is None:
+            return self.ensure_national_registration_updated()
+
+        if self.is_national_registration_outdated():
+            NationalRegistryRefresh.objects.get_or_create(member=self)
+
+        return False
+
+    # The `person_data` may be given if it has already been looked up, along
+    # with the `lookup_timing` of when it was.
+    def update_from_national_registry(self, person_data=None, lookup_timing=None):
         if person_data is None:
-            person_data = jaapi.get_person(self.ssn)
+            # The data may have been looked up a while ago (see `core.jaapi`).
+            person_data, lookup_timing = jaapi.lookup_person(self.ssn)
+        if lookup_timing is None:
+            lookup_timing = timezone.now()
 
         addr = person_data['permanent_address']
 
@@ -110,17 +150,15 @@ class Member(models.Model):
         self.legal_municipality = municipality
         self.legal_zone = addr['town']['dative'] if addr['town'] else None
         self.legal_country_code = addr['country']['code']
-        self.legal_lookup_timing = timezone.now()
+        self.legal_lookup_timing = lookup_timing
 
+    # Returns the member's groups, and unless `parent_membergroups` is False,
+    # also the groups that those are automatic subgroups of, at any depth.
     def get_membergroups(self, parent_membergroups=True):
-        membergroups = set([])
-
-        for membergroup in self.membergroups.all():
-            membergroups.add(membergroup)
-            if parent_membergroups:
-                membergroups |= set(membergroup.auto_parent_membergroups.all())
+        if not parent_membergroups:
+            return set(self.membergroups.all())
 
-        return membergroups
+        return set(MemberGroup.objects.filter(descendant_paths__descendant__members=self).distinct())
 
     def email_sig(self):
         ts = '%x/' % time.time()
@@ -129,6 +167,39 @@ class Member(models.Model):
              )).hexdigest()
 
 
+class NationalRegistryRefresh(models.Model):
+    '''
+    A member whose national registry information is outdated and waits to be
+    refreshed by the `process_registry_refreshes` script. There is at most
+    one per member, no matter how often the refresh is requested.
+    '''
+    member = models.OneToOneField(Member, on_delete=models.CASCADE, related_name='national_registry_refresh')
+    requested = models.DateTimeField(default=timezone.now)
+    attempts = models.IntegerField(default=0)
+
+    '''
+    Returns numbers describing the queue: how many members are waiting
+    (`depth`), how long the one that has waited the longest has been waiting
+    (`oldest_wait`) and how old the most outdated information in the queue
+    is (`staleness`), the latter two as timedeltas or None if the queue is
+    empty.
+    '''
+    @staticmethod
+    def get_stats():
+        stats = NationalRegistryRefresh.objects.aggregate(
+            depth=models.Count('id'),
+            oldest_request=models.Min('requested'),
+            oldest_lookup=models.Min('member__legal_lookup_timing')
+        )
+
+        now = timezone.now()
+        return {
+            'depth': stats['depth'],
+            'oldest_wait': now - stats['oldest_request'] if stats['oldest_request'] else None,
+            'staleness': now - stats['oldest_lookup'] if stats['oldest_lookup'] else None,
+        }
+
+
 class Municipality(models.Model):
     code = models.CharField(max_length=4, unique=True)
     name = models.CharField(max_length=30)
@@ -165,6 +236,56 @@ class MemberGroup(models.Model):
         return self.name
 
 
+class MemberGroupAncestry(models.Model):
+    '''
+    The transitive closure of `MemberGroup.auto_subgroups`: one row for every
+    group that is an automatic subgroup of another, directly or through any
+    number of groups in between, along with the number of steps between
+    them (`depth`). Every group is also its own ancestor, at depth 0, so that
+    a group and all of its subgroups can be found with a single join.
+
+    The table is rebuilt whenever the subgroups change, which is rare (see
+    the signal receivers below).
+    '''
+    ancestor = models.ForeignKey(MemberGroup, on_delete=models.CASCADE, related_name='descendant_paths')
+    descendant = models.ForeignKey(MemberGroup, on_delete=models.CASCADE, related_name='ancestor_paths')
+    depth = models.IntegerField()
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+
+    @staticmethod
+    def rebuild():
+        subgroups = {}
+        for parent_id, subgroup_id in MemberGroup.auto_subgroups.through.objects.values_list(
+            'from_membergroup_id',
+            'to_membergroup_id'
+        ):
+            subgroups.setdefault(parent_id, []).append(subgroup_id)
+
+        paths = []
+        for group_id in MemberGroup.objects.values_list('id', flat=True):
+            # Breadth-first, so that each descendant is found at its shortest
+            # depth, and only once, even if the groups form a cycle.
+            depths = { group_id: 0 }
+            queue = [group_id]
+            while len(queue) > 0:
+                current_id = queue.pop(0)
+                for subgroup_id in subgroups.get(current_id, []):
+                    if subgroup_id not in depths:
+                        depths[subgroup_id] = depths[current_id] + 1
+                        queue.append(subgroup_id)
+
+            paths.extend([
+                MemberGroupAncestry(ancestor_id=group_id, descendant_id=descendant_id, depth=depth)
+                for descendant_id, depth in depths.items()
+            ])
+
+        with transaction.atomic():
+            MemberGroupAncestry.objects.all().delete()
+            MemberGroupAncestry.objects.bulk_create(paths)
+
+
 class Subscriber(models.Model):
     '''
     A Subscriber is only subscribed to email announcements but is not a
@@ -214,3 +335,39 @@ class MemberStat(models.Model):
 
     class Meta:
         ordering = ['timing']
+
+
+# Keep `MemberGroupAncestry` up to date. Groups loaded from fixtures (raw
+# saves) need their own row as well, since nothing else adds it for them.
+@receiver(post_save, sender=MemberGroup)
+def add_membergroup_ancestry(sender, instance, created, raw=False, **kwargs):
+    if created:
+        MemberGroupAncestry.objects.get_or_create(ancestor=instance, descendant=instance, depth=0)
+
+@receiver(m2m_changed, sender=MemberGroup.auto_subgroups.through)
+def update_membergroup_ancestry(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        MemberGroupAncestry.rebuild()
+
+@receiver(post_delete, sender=MemberGroup)
+def remove_membergroup_ancestry(sender, instance, **kwargs):
+    # Paths that went through the deleted group are gone as well.
+    MemberGroupAncestry.rebuild()
+
+# Keep the in-memory snapshots of the groups up to date (see `member.graph`).
+# Registered after the receivers above, so that the ancestry has already been
+# updated when a snapshot is reloaded.
+@receiver(post_save, sender=MemberGroup)
+@receiver(post_delete, sender=MemberGroup)
+def invalidate_membergroup_graph(sender, raw=False, **kwargs):
+    if not raw:
+        from member.graph import invalidate_graph
+        invalidate_graph()
+
+@receiver(m2m_changed, sender=MemberGroup.auto_subgroups.through)
+@receiver(m2m_changed, sender=MemberGroup.admins.through)
+@receiver(m2m_changed, sender=MemberGroup.condition_municipalities.through)
+def invalidate_membergroup_graph_relations(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        from member.graph import invalidate_graph
+        invalidate_graph()
@@ -5,7 +5,30 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import csv
+import datetime
+import io
+
+from contextlib import redirect_stdout
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test import TestCase
+from django.test import override_settings
+from django.utils import timezone
+
+from core import jaapi
+from core.models import CacheVersion
+from member.graph import VERSION_NAME
+from member.graph import get_graph
+from member.models import Member
+from member.models import MemberGroup
+from member.models import MemberGroupAncestry
+from member.models import Municipality
+from member.models import NationalRegistryRefresh
+from member.views_api import member_to_dict
 
 
 class SimpleTest(TestCase):
@@ -14,3 +37,208 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class MemberGroupAncestryTest(TestCase):
+
+    def setUp(self):
+        self.groups = [
+            MemberGroup.objects.create(name=name, techname=name, email='%s@example.com' % name)
+            for name in ('top', 'middle', 'bottom')
+        ]
+        top, middle, bottom = self.groups
+        top.auto_subgroups.add(middle)
+        middle.auto_subgroups.add(bottom)
+
+        self.member = Member.objects.create(ssn='0000000000', name='Member', email='member@example.com')
+        self.member.membergroups.add(bottom)
+
+    def test_nested_subgroups(self):
+        top, middle, bottom = self.groups
+
+        self.assertEqual(
+            MemberGroupAncestry.objects.get(ancestor=top, descendant=bottom).depth,
+            2
+        )
+        self.assertEqual(self.member.get_membergroups(), set(self.groups))
+        self.assertEqual(self.member.get_membergroups(parent_membergroups=False), set([bottom]))
+
+        # Breaking the chain in the middle removes the top group from the
+        # member's groups, and deleting a group removes paths through it.
+        top.auto_subgroups.remove(middle)
+        self.assertEqual(self.member.get_membergroups(), set([middle, bottom]))
+        top.auto_subgroups.add(middle)
+        middle.delete()
+        self.assertEqual(self.member.get_membergroups(), set([bottom]))
+
+    def test_safe(self):
+        admin = User.objects.create(username='admin')
+        self.groups[0].admins.add(admin)
+
+        self.assertEqual(list(Member.objects.safe(admin)), [self.member])
+
+
+class MemberToDictTest(TestCase):
+
+    def test_groups(self):
+        municipality = Municipality.objects.create(code='0000', name='Municipality')
+
+        groups = dict([
+            (name, MemberGroup.objects.create(name=name.title(), techname=name, email='%s@example.com' % name))
+            for name in ('top', 'middle', 'bottom', 'local', 'other')
+        ])
+        groups['top'].auto_subgroups.add(groups['middle'])
+        groups['middle'].auto_subgroups.add(groups['bottom'])
+        groups['local'].condition_municipalities.add(municipality)
+
+        member = Member.objects.create(
+            ssn='0000000000',
+            name='Member',
+            email='member@example.com',
+            legal_municipality=municipality
+        )
+        member.membergroups.add(groups['bottom'])
+        member = Member.objects.get(id=member.id)
+
+        # Once the groups have been loaded into memory, only the member's
+        # memberships are queried, no matter how many groups there are.
+        get_graph()
+        with self.assertNumQueries(1):
+            result = member_to_dict(member)
+
+        self.assertEqual(result['groups'], { 'top': 'Top', 'middle': 'Middle', 'bottom': 'Bottom' })
+        self.assertEqual(result['main_groups'], { 'bottom': 'Bottom' })
+        self.assertEqual(result['auto_groups'], { 'top': 'Top', 'middle': 'Middle' })
+        self.assertEqual(result['eligible_groups'], { 'local': 'Local' })
+
+
+class MemberGroupGraphTest(TestCase):
+
+    def test_invalidation(self):
+        admin = User.objects.create(username='admin')
+        group = MemberGroup.objects.create(name='Group', techname='group', email='group@example.com')
+
+        self.assertEqual(list(MemberGroup.objects.safe(admin)), [])
+
+        # Changes made in this process are seen right away.
+        group.admins.add(admin)
+        self.assertEqual(list(MemberGroup.objects.safe(admin)), [group])
+
+        # Changes made by other processes, which only bump the version, are
+        # seen once the version is checked again.
+        graph = get_graph()
+        MemberGroup.admins.through.objects.all().delete()
+        CacheVersion.bump(VERSION_NAME)
+        self.assertIs(get_graph(), graph)
+        with override_settings(MEMBERGROUP_GRAPH_CHECK_SECONDS=0):
+            self.assertEqual(list(MemberGroup.objects.safe(admin)), [])
+
+
+class NationalRegistryRefreshTest(TestCase):
+
+    PERSON = {
+        'type': 'person',
+        'name': 'Legal Name',
+        'permanent_address': {
+            'street': { 'dative': 'Street 1' },
+            'postal_code': '101',
+            'municipality': '0000',
+            'town': { 'dative': 'Town' },
+            'country': { 'code': 'IS' },
+        },
+    }
+
+    def test_refreshed_in_background(self):
+        outdated = timezone.now() - datetime.timedelta(days=settings.NATIONAL_REGISTRY_EXPIRATION_DAYS + 1)
+        member = Member.objects.create(
+            ssn='0101302989',
+            name='Member',
+            email='member@example.com',
+            legal_name='Old Name',
+            legal_lookup_timing=outdated
+        )
+
+        # The API answers with what it has, without waiting for the national
+        # registry, and queues a refresh, only once.
+        with mock.patch('core.jaapi.lookup_person', side_effect=AssertionError('Looked up during request')):
+            for i in range(2):
+                response = self.client.post('/member/api/get/ssn/%s/' % member.ssn, { 'json_api_key': settings.JSON_API_KEY })
+                self.assertEqual(response.json()['data']['legal_name'], 'Old Name')
+
+        self.assertEqual(NationalRegistryRefresh.get_stats()['depth'], 1)
+        self.assertGreater(NationalRegistryRefresh.get_stats()['staleness'], datetime.timedelta(days=1))
+
+        # The member's email is changed while the refresh is under way, which
+        # the refresh must not undo.
+        def lookup_person(ssn):
+            Member.objects.filter(id=member.id).update(email='changed@example.com')
+            return self.PERSON, timezone.now()
+
+        with mock.patch('core.jaapi.lookup_person', side_effect=lookup_person):
+            with redirect_stdout(io.StringIO()):
+                call_command('process_registry_refreshes')
+
+        member.refresh_from_db()
+        self.assertEqual(member.legal_name, 'Legal Name')
+        self.assertEqual(member.email, 'changed@example.com')
+        self.assertEqual(NationalRegistryRefresh.get_stats()['depth'], 0)
+
+
+@override_settings(NATIONAL_REGISTRY_LOOKUP_COST=11)
+class RefreshNationalRegistryTest(TestCase):
+
+    def lookup_person(self, ssn):
+        self.looked_up.append(ssn)
+        jaapi.count('cost', 11)
+        if ssn == '0000000002':
+            raise jaapi.PersonNotFoundException()
+        return dict(NationalRegistryRefreshTest.PERSON, name='Legal %s' % ssn), timezone.now()
+
+    def refresh(self, **options):
+        with mock.patch('core.jaapi.lookup_person', self.lookup_person):
+            with redirect_stdout(io.StringIO()):
+                call_command('refresh_national_registry', **options)
+
+    def test_budget_and_resume(self):
+        self.looked_up = []
+        for i in range(5):
+            Member.objects.create(ssn='%010d' % i, name='Member %d' % i, email='member%d@example.com' % i)
+        Member.objects.filter(ssn='0000000004').update(legal_lookup_timing=timezone.now())
+
+        self.refresh(concurrency=1, budget=22)
+        self.assertEqual(self.looked_up, ['0000000000', '0000000001'])
+
+        # Continues with those that are still outdated.
+        self.refresh(concurrency=2, batch_size=1)
+        self.assertEqual(sorted(self.looked_up[2:]), ['0000000002', '0000000003'])
+
+        self.assertEqual(
+            list(Member.objects.order_by('ssn').values_list('legal_name', flat=True)),
+            ['Legal 0000000000', 'Legal 0000000001', '', 'Legal 0000000003', '']
+        )
+
+
+class CsvExportTest(TestCase):
+
+    def test_export(self):
+        admin = User.objects.create(username='admin', is_superuser=True)
+        group = MemberGroup.objects.create(name='Group', techname='group', email='group@example.com')
+        for i in range(3):
+            member = Member.objects.create(ssn='%010d' % i, name='Member "%d", Jr.' % i, email='member%d@example.com' % i)
+        member.membergroups.add(group)
+
+        self.client.force_login(admin)
+
+        # By default, the SSNs and emails of every member.
+        response = self.client.get('/member/csv/list/')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertTrue(lines[0].startswith('#"SSN",'))
+        self.assertEqual(lines[1:], ['"%010d","member%d@example.com"' % (i, i) for i in range(3)])
+
+        response = self.client.get('/member/csv/list/group', { 'columns': 'name,groups,ssn' })
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+        self.assertEqual(len(rows[0]), 3)
+        self.assertEqual(rows[1:], [['Member "2", Jr.', 'Group', '0000000002']])
+
+        response = self.client.get('/member/csv/list/', { 'columns': 'ssn,password' })
+        self.assertEqual(response.status_code, 400)
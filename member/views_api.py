@@ -19,6 +19,7 @@ from django.views.decorators.csrf import csrf_exempt
 from icepirate.utils import json_error
 from icepirate.utils import generate_random_string
 
+from member.graph import get_graph
 from member.models import Member
 from member.models import MemberGroup
 from member.models import Subscriber
@@ -54,16 +55,17 @@ def member_to_dict(member):
         if val:
             result[key] = val
 
-    all_membergroups = member.get_membergroups()
-    main_membergroups = member.membergroups.all()
-    eligible_membergroups = []
-    if member.legal_municipality is not None:
-        eligible_membergroups = MemberGroup.objects.filter(condition_municipalities=member.legal_municipality)
+    # The member's groups are looked up in memory (see `member.graph`), so
+    # that only their direct memberships need to be queried.
+    graph = get_graph()
+    main_ids = set(member.membergroups.values_list('id', flat=True))
+    member_ids = graph.get_ancestor_ids(main_ids)
+    eligible_ids = graph.get_eligible_ids(member.legal_municipality_id) - main_ids
 
-    result['groups'] = dict([(g.techname, g.name) for g in all_membergroups])
-    result['main_groups'] = dict([(g.techname, g.name) for g in main_membergroups])
-    result['auto_groups'] = dict([(g.techname, g.name) for g in (set(all_membergroups) - set(main_membergroups))])
-    result['eligible_groups'] = dict([(g.techname, g.name) for g in (set(eligible_membergroups) - set(main_membergroups))])
+    result['groups'] = dict([(g.techname, g.name) for g in graph.get_groups(member_ids)])
+    result['main_groups'] = dict([(g.techname, g.name) for g in graph.get_groups(main_ids)])
+    result['auto_groups'] = dict([(g.techname, g.name) for g in graph.get_groups(member_ids - main_ids)])
+    result['eligible_groups'] = dict([(g.techname, g.name) for g in graph.get_groups(eligible_ids)])
 
     return result
 
@@ -86,8 +88,9 @@ def get(request, field, searchstring):
     except Member.DoesNotExist as e:
         return json_error('No such member')
 
-    # Update the national registry information if necessary.
-    if member.ensure_national_registration_updated():
+    # Outdated national registry information is refreshed in the background,
+    # so that the caller doesn't have to wait for the national registry.
+    if member.request_national_registration_update():
         member.save()
 
     response_data = {
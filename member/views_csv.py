@@ -1,53 +1,110 @@
+import csv
+
 from datetime import datetime
 
-from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.http import StreamingHttpResponse
 
 from django.contrib.auth.decorators import login_required
 from django.utils.translation import gettext as _
+from django.utils.translation import gettext_lazy
 
 from core.loggers import log_action
 
 from member.models import Member
-from member.models import MemberGroup
+
+# The columns that may be exported, as (name, header, field) tuples. Columns
+# are selected by name, in the order that they should appear in, with the
+# "columns" query string parameter, for example "?columns=ssn,name,email".
+# Groups are not a field of the member, so they are looked up separately.
+COLUMNS = [
+    ('ssn', gettext_lazy('SSN'), 'ssn'),
+    ('name', gettext_lazy('Name'), 'name'),
+    ('username', gettext_lazy('Username'), 'username'),
+    ('email', gettext_lazy('Email'), 'email'),
+    ('email_wanted', gettext_lazy('Email wanted'), 'email_wanted'),
+    ('phone', gettext_lazy('Phone'), 'phone'),
+    ('added', gettext_lazy('Added'), 'added'),
+    ('groups', gettext_lazy('Groups'), None),
+]
+
+# Exported when no columns are selected.
+DEFAULT_COLUMNS = ['ssn', 'email']
+
+# Number of members fetched from the database at a time.
+CHUNK_SIZE = 2000
+
+
+# Hands the lines written by a CSV writer right back, so that they can be
+# streamed instead of being collected into one big string.
+class Echo(object):
+    def write(self, value):
+        return value
+
+
+# Yields the CSV lines of the given members, `CHUNK_SIZE` at a time.
+def generate_lines(members, columns):
+    writer = csv.writer(Echo(), quoting=csv.QUOTE_ALL, lineterminator='\n')
+
+    yield '#%s' % writer.writerow([header for name, header, field in columns])
+
+    fields = ['id'] + [field for name, header, field in columns if field is not None]
+    with_groups = any([name == 'groups' for name, header, field in columns])
+
+    chunk = []
+    for values in members.values_list(*fields).iterator(chunk_size=CHUNK_SIZE):
+        chunk.append(values)
+        if len(chunk) == CHUNK_SIZE:
+            for line in generate_chunk_lines(writer, chunk, columns, with_groups):
+                yield line
+            chunk = []
+
+    for line in generate_chunk_lines(writer, chunk, columns, with_groups):
+        yield line
+
+
+def generate_chunk_lines(writer, chunk, columns, with_groups):
+    if with_groups:
+        group_names = {}
+        for member_id, group_name in Member.membergroups.through.objects.filter(
+            member_id__in=[values[0] for values in chunk]
+        ).order_by('membergroup__name').values_list('member_id', 'membergroup__name'):
+            group_names.setdefault(member_id, []).append(group_name)
+
+    for values in chunk:
+        member_id = values[0]
+        values = iter(values[1:])
+
+        row = []
+        for name, header, field in columns:
+            if field is None:
+                row.append(', '.join(group_names.get(member_id, [])))
+            else:
+                row.append(next(values))
+
+        yield writer.writerow(row)
+
 
 @login_required
 def list(request, group_techname=None):
 
-    members = Member.objects.safe(request.user).prefetch_related('membergroups')
+    members = Member.objects.safe(request.user).all()
 
     if group_techname:
         members = members.filter(membergroups__techname=group_techname)
-    
-    # NOTE: Apparently concatinating lists of strings is really efficient.
-    lines = []
-
-    # Construct header. Things are set up this way for easy
-    # commenting/uncommenting of particular fields, since needs are likely to
-    # change over time. Same with the values, below.
-    header_fields = [
-        _('SSN'),
-        #_('Name'),
-        #_('Username'),
-        ('Email'),
-        #_('Email wanted'),
-        #_('Phone'),
-        #_('Added'),
-        #_('Groups'),
-    ]
-    lines.append('#%s' % ','.join(['"%s"' % field for field in header_fields]))
-
-    for m in members:
-        field_values = [
-            m.ssn,
-            #m.name,
-            #m.username,
-            m.email,
-            #m.email_wanted,
-            #m.phone,
-            #m.added,
-            #u', '.join([g.name for g in m.membergroups.all()]),
-        ]
-        lines.append(','.join(['"%s"' % value for value in field_values]))
+
+    column_names = request.GET.get('columns', '').split(',')
+    if column_names == ['']:
+        column_names = DEFAULT_COLUMNS
+
+    columns_by_name = dict([(column[0], column) for column in COLUMNS])
+    unknown_names = set(column_names) - set(columns_by_name.keys())
+    if len(unknown_names) > 0:
+        return HttpResponseBadRequest('Unknown columns: %s' % ', '.join(sorted(unknown_names)))
+
+    # The headers are translated now, while the request's language is active,
+    # rather than while the response is being streamed.
+    columns = [(name, str(header), field) for name, header, field in [columns_by_name[name] for name in column_names]]
 
     timing = datetime.now().strftime('%Y-%m-%d.%H-%M-%S')
 
@@ -63,7 +120,7 @@ def list(request, group_techname=None):
         affected_members=members
     )
 
-    response = HttpResponse("\n".join(lines), content_type='text/csv; charset: utf-8')
+    response = StreamingHttpResponse(generate_lines(members, columns), content_type='text/csv; charset=utf-8')
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
 
     return response
@@ -0,0 +1,326 @@
+'''
+Benchmarks for bulk sending of messages. These are not run along with the
+tests, since they take a while and only report numbers. Run them with:
+
+    ./manage.py test message.benchmarks
+'''
+import random
+import socketserver
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.test import TransactionTestCase
+from django.test import override_settings
+
+from icepirate.utils import quick_mail
+from member.models import Member
+from member.models import MemberGroup
+from message.models import Message
+from message.models import MessageDelivery
+
+
+class SMTPStandInHandler(socketserver.StreamRequestHandler):
+    '''
+    Speaks just enough SMTP for Django's SMTP backend to deliver email. The
+    server's `connect_delay` simulates the cost of establishing a new
+    connection to a real mail server (TCP, TLS handshake and authentication)
+    and `message_delay` the time it takes the server to accept an email.
+    '''
+
+    def reply(self, line):
+        self.wfile.write(('%s\r\n' % line).encode('utf-8'))
+
+    def handle(self):
+        time.sleep(self.server.connect_delay)
+        self.reply('220 localhost SMTP stand-in')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode('utf-8').strip().upper()
+
+            if command.startswith('EHLO') or command.startswith('HELO'):
+                self.reply('250 localhost')
+            elif command.startswith('DATA'):
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                time.sleep(self.server.message_delay)
+                with self.server.lock:
+                    self.server.message_count += 1
+                self.reply('250 OK')
+            elif command.startswith('QUIT'):
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('250 OK')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, connect_delay=0.0, message_delay=0.0):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPStandInHandler)
+        self.connect_delay = connect_delay
+        self.message_delay = message_delay
+        self.message_count = 0
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class BulkSendBenchmark(TransactionTestCase):
+
+    RECIPIENT_COUNT = 200
+
+    # Roughly what a TLS handshake plus authentication costs against a
+    # remote mail server.
+    CONNECT_DELAY = 0.02
+
+    def setUp(self):
+        self.author = User.objects.create(username='benchmark')
+        Member.objects.bulk_create([
+            Member(
+                ssn='%010d' % i,
+                name='Member %d' % i,
+                email='member%d@example.com' % i,
+                email_wanted=True,
+                temporary_web_id='benchmark-%d' % i
+            ) for i in range(self.RECIPIENT_COUNT)
+        ])
+
+    def report(self, label, count, seconds):
+        print('\n%s: %d messages in %.2f seconds (%.1f messages/second)' % (
+            label,
+            count,
+            seconds,
+            count / seconds
+        ))
+
+    def test_connection_per_message(self):
+        with SMTPStandIn(connect_delay=self.CONNECT_DELAY) as server:
+            with override_settings(
+                EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                EMAIL_HOST='127.0.0.1',
+                EMAIL_PORT=server.port
+            ):
+                start = time.time()
+                for member in Member.objects.all():
+                    quick_mail(member.email, 'Benchmark', 'Benchmark body')
+                self.report('New connection per message', server.message_count, time.time() - start)
+
+    def test_send_bulk(self):
+        message = Message.objects.create(
+            author=self.author,
+            subject='Benchmark',
+            body='Benchmark body',
+            include_mailing_list=False,
+            ready_to_send=True
+        )
+
+        with SMTPStandIn(connect_delay=self.CONNECT_DELAY) as server:
+            with override_settings(
+                EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                EMAIL_HOST='127.0.0.1',
+                EMAIL_PORT=server.port
+            ):
+                start = time.time()
+                for num, count, email, success in message.send_bulk():
+                    pass
+                self.report('Message.send_bulk', server.message_count, time.time() - start)
+
+
+class ResumeBenchmark(TransactionTestCase):
+    '''
+    Measures how long it takes to resume a partially sent message, from the
+    start of `send_bulk` until the first remaining recipient gets sent to.
+    '''
+
+    RECIPIENT_COUNT = 50000
+    DELIVERED_COUNT = 35000
+
+    def test_resume(self):
+        author = User.objects.create(username='benchmark')
+        Member.objects.bulk_create([
+            Member(
+                ssn='%010d' % i,
+                name='Member %d' % i,
+                email='member%d@example.com' % i,
+                email_wanted=True,
+                temporary_web_id='benchmark-%d' % i
+            ) for i in range(self.RECIPIENT_COUNT)
+        ], batch_size=1000)
+
+        message = Message.objects.create(
+            author=author,
+            subject='Benchmark',
+            body='Benchmark body',
+            include_mailing_list=False,
+            ready_to_send=True
+        )
+        MessageDelivery.objects.bulk_create([
+            MessageDelivery(message=message, member_id=member_id)
+            for member_id in Member.objects.order_by('id').values_list('id', flat=True)[:self.DELIVERED_COUNT]
+        ], batch_size=1000)
+
+        start = time.time()
+        sending = message.send_bulk()
+        num, count, email, success = next(sending)
+        seconds = time.time() - start
+        sending.close()
+
+        print('\nResumed %d-recipient message with %d deliveries: first email after %.2f seconds, %d remaining' % (
+            self.RECIPIENT_COUNT,
+            self.DELIVERED_COUNT,
+            seconds,
+            count
+        ))
+
+
+class AsyncSendBenchmark(TransactionTestCase):
+    '''
+    Compares sending one email at a time with keeping several in flight at
+    once (see `AsyncSender`), against a mail server that takes a while to
+    accept each email, like a remote one does.
+    '''
+
+    RECIPIENT_COUNT = 200
+
+    MESSAGE_DELAY = 0.02
+
+    def setUp(self):
+        self.author = User.objects.create(username='benchmark')
+        Member.objects.bulk_create([
+            Member(
+                ssn='%010d' % i,
+                name='Member %d' % i,
+                email='member%d@example.com' % i,
+                email_wanted=True,
+                temporary_web_id='benchmark-%d' % i
+            ) for i in range(self.RECIPIENT_COUNT)
+        ])
+
+    def send(self, label, **bulk_settings):
+        message = Message.objects.create(
+            author=self.author,
+            subject='Benchmark',
+            body='Benchmark body',
+            include_mailing_list=False,
+            ready_to_send=True
+        )
+
+        with SMTPStandIn(message_delay=self.MESSAGE_DELAY) as server:
+            with override_settings(
+                EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                EMAIL_HOST='127.0.0.1',
+                EMAIL_PORT=server.port,
+                **bulk_settings
+            ):
+                start = time.time()
+                for num, count, email, success in message.send_bulk():
+                    pass
+                seconds = time.time() - start
+
+        print('\n%s: %d messages in %.2f seconds (%.1f messages/second)' % (
+            label,
+            server.message_count,
+            seconds,
+            server.message_count / seconds
+        ))
+
+    def test_sync(self):
+        self.send('One at a time', BULK_SEND_ASYNC=False)
+
+    def test_async(self):
+        for concurrency in (5, 20):
+            self.send('%d in flight' % concurrency, BULK_SEND_ASYNC=True, BULK_SEND_CONCURRENCY=concurrency)
+
+
+class RecipientQueryBenchmark(TransactionTestCase):
+    '''
+    Compares the time it takes to count and fetch the recipients of a message
+    sent to a handful of groups and their subgroups, among many members in
+    many groups, with the old query that joined every membership and removed
+    duplicates with `DISTINCT`.
+    '''
+
+    MEMBER_COUNT = 100000
+    GROUP_COUNT = 50
+    GROUPS_PER_MEMBER = 3
+
+    def setUp(self):
+        randomizer = random.Random(0)
+
+        self.author = User.objects.create(username='benchmark')
+
+        groups = MemberGroup.objects.bulk_create([
+            MemberGroup(name='Group %d' % i, techname='group-%d' % i, email='group%d@example.com' % i)
+            for i in range(self.GROUP_COUNT)
+        ])
+        # Every fifth group has the next four as its subgroups.
+        for i in range(0, self.GROUP_COUNT, 5):
+            groups[i].auto_subgroups.set(groups[i+1:i+5])
+
+        Member.objects.bulk_create([
+            Member(
+                ssn='%010d' % i,
+                name='Member %d' % i,
+                email='member%d@example.com' % i,
+                email_wanted=True
+            ) for i in range(self.MEMBER_COUNT)
+        ], batch_size=1000)
+
+        Membership = Member.membergroups.through
+        Membership.objects.bulk_create([
+            Membership(member_id=member_id, membergroup_id=group.id)
+            for member_id in Member.objects.values_list('id', flat=True)
+            for group in randomizer.sample(groups, self.GROUPS_PER_MEMBER)
+        ], batch_size=1000)
+
+        self.message = Message.objects.create(author=self.author, send_to_all=False, include_mailing_list=False)
+        self.message.membergroups.set(groups[0:25:5])
+
+    def get_old_member_recipients(self):
+        groups = MemberGroup.objects.filter(
+            Q(messages=self.message)
+            | Q(auto_parent_membergroups__messages=self.message)
+        ).distinct()
+        return Member.objects.filter(
+            Q(email_wanted=True)
+            | Q(email_wanted=None, email_unwanted=False)
+        ).filter(membergroups__in=groups).distinct()
+
+    def measure(self, label, members):
+        start = time.time()
+        count = members.count()
+        counted = time.time() - start
+
+        start = time.time()
+        fetched = len(list(members.order_by('id').values_list('id', 'email', 'temporary_web_id')))
+        seconds = time.time() - start
+
+        print('\n%s: counted %d recipients in %.2f seconds, fetched %d in %.2f seconds' % (
+            label,
+            count,
+            counted,
+            fetched,
+            seconds
+        ))
+
+    def test_recipient_query(self):
+        self.measure('DISTINCT over memberships', self.get_old_member_recipients())
+        self.measure('EXISTS', self.message.get_member_recipients())
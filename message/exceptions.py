@@ -3,3 +3,12 @@ Thrown when a bulk-send is attempted on a message already being processed.
 '''
 class MessageBeingProcessedException(Exception):
     pass
+
+
+'''
+Thrown when a bulk-send can't open a connection to the mail server, because
+it can't be reached or won't let us in. Nothing has been sent, and the
+message can be sent once the mail server is available again.
+'''
+class MailServerUnavailableException(Exception):
+    pass
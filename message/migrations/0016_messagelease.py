@@ -0,0 +1,28 @@
+# Generated by Django 4.2.15 on 2026-10-18 14:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0015_message_being_processed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient_type', models.CharField(choices=[('member', 'Member'), ('subscriber', 'Subscriber')], max_length=20)),
+                ('first_id', models.IntegerField()),
+                ('last_id', models.IntegerField()),
+                ('worker', models.CharField(max_length=200, null=True)),
+                ('expires', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('failed', models.BooleanField(default=False)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leases', to='message.message')),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.15 on 2026-10-18 14:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('member', '0011_alter_member_email_wanted'),
+        ('message', '0016_messagelease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageFailure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.CharField(max_length=200)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('permanent', models.BooleanField(default=False)),
+                ('member', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='member.member')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='failures', to='message.message')),
+                ('subscriber', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='member.subscriber')),
+            ],
+        ),
+    ]
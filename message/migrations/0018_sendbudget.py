@@ -0,0 +1,27 @@
+# Generated by Django 4.2.15 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0017_messagefailure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SendBudget',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=255)),
+                ('period', models.IntegerField()),
+                ('tokens', models.FloatField()),
+                ('updated', models.FloatField()),
+                ('version', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('scope', 'period')},
+            },
+        ),
+    ]
@@ -1,14 +1,22 @@
 import datetime
 import copy
+import os
+import socket
+import threading
 import time
 import hashlib
 
+from collections import namedtuple
+
 from markdown import markdown
 
 from django.conf import settings
 from django.db import models
 from django.db import transaction
 from django.db.models import CASCADE
+from django.db.models import Exists
+from django.db.models import F
+from django.db.models import OuterRef
 from django.db.models import PROTECT
 from django.db.models import Q
 from django.db.utils import OperationalError
@@ -19,13 +27,24 @@ from icepirate.models import SafetyManager
 from icepirate.utils import generate_random_string
 from icepirate.utils import quick_mail
 from member.models import Member
-from member.models import MemberGroup
+from member.models import MemberGroupAncestry
 from member.models import Subscriber
 from message.exceptions import MessageBeingProcessedException
+from message.sending import get_sender
+from message.sending import PreparedMail
+from message.sending import SendScheduler
+from message.sending import is_permanent_failure
+from message.sending import is_server_failure
 
 from core.loggers import log_mail
 
 
+# A lightweight stand-in for a Member or Subscriber object, used in bulk
+# sending so that only the fields actually needed are loaded from the
+# database. The `model` is either Member or Subscriber.
+Recipient = namedtuple('Recipient', ['model', 'id', 'email', 'temporary_web_id'])
+
+
 class Message(models.Model):
     objects = SafetyManager()
 
@@ -46,7 +65,8 @@ class Message(models.Model):
     sending_complete = models.DateTimeField(null=True) # Marked when processing ends
 
     # Indicates that mechanisms for bulk sending (`process_messages` script)
-    # should not process this message, because it is already being processed.
+    # should not set up this message for sending, because it is already being
+    # set up. Sending itself is coordinated with `MessageLease` objects.
     being_processed = models.BooleanField(default=False)
 
     # Number of intended recipients, before bulk send.
@@ -92,18 +112,9 @@ class Message(models.Model):
 
 
     '''
-    Returns a list of Member and Subscriber objects, collectively called
-    "recipients". Recipients are expected to have the fields `email` and
-    `temporary_web_id`.
+    Returns a queryset of the Member objects that the message is intended for.
     '''
-    def get_recipients(self):
-        # List to be returned.
-        recipients = []
-
-        ################
-        # Get members. #
-        ################
-
+    def get_member_recipients(self):
         members = Member.objects.filter(
             # NOTE: `email_wanted` is the post-GDPR field that should become
             # the only one at some point. The `email_unwanted` field is from
@@ -129,29 +140,144 @@ class Message(models.Model):
         )
 
         if not self.send_to_all:
+            # The IDs of the groups that the message is intended to.
+            group_ids = Message.membergroups.through.objects.filter(
+                message_id=self.id
+            ).values('membergroup_id')
+
+            # A member is a recipient if any of their memberships is in one
+            # of the groups. Checking for that with `EXISTS` lets the
+            # database stop at the first matching membership, instead of
+            # joining every membership and then removing duplicate members
+            # with `DISTINCT`, which is very slow with many members.
+            memberships = Member.membergroups.through.objects.filter(
+                member_id=OuterRef('id')
+            )
+
             if self.groups_include_subgroups:
                 # Find not only the groups that the message is intended to,
-                # but also the subgroups of those groups.
-                groups = MemberGroup.objects.filter(
-                    Q(messages=self)
-                    | Q(auto_parent_membergroups__messages=self)
-                ).distinct()
+                # but also the subgroups of those groups, at any depth. The
+                # groups themselves are included directly, as well, in case
+                # they were created without their own row in the ancestry,
+                # such as with `bulk_create`.
+                subgroup_ids = MemberGroupAncestry.objects.filter(
+                    ancestor_id__in=group_ids
+                ).values('descendant_id')
+                memberships = memberships.filter(
+                    Q(membergroup_id__in=group_ids) | Q(membergroup_id__in=subgroup_ids)
+                )
             else:
-                groups = MemberGroup.objects.filter(messages=self)
+                memberships = memberships.filter(membergroup_id__in=group_ids)
+
+            members = members.filter(Exists(memberships))
+
+        return members
+
+
+    '''
+    Returns a queryset of the Subscriber objects that the message is intended
+    for, which are none unless the mailing list is included.
+    '''
+    def get_subscriber_recipients(self):
+        if not self.include_mailing_list:
+            return Subscriber.objects.none()
+
+        return Subscriber.objects.filter(email_verified=True)
+
+
+    '''
+    Returns a list of Member and Subscriber objects, collectively called
+    "recipients". Recipients are expected to have the fields `email` and
+    `temporary_web_id`.
+    '''
+    def get_recipients(self):
+        return list(self.get_member_recipients()) + list(self.get_subscriber_recipients())
+
 
-            members = members.filter(membergroups__in=groups).distinct()
+    '''
+    Returns the number of recipients, without loading them from the database.
+    '''
+    def get_recipient_count(self):
+        return self.get_member_recipients().count() + self.get_subscriber_recipients().count()
+
+
+    '''
+    Returns the Member and Subscriber querysets of those recipients that have
+    not yet received the message, which is the case when a bulk sending has
+    been cancelled or failed before completing. Excluding them is left to the
+    database, which is much faster at it than comparing lists of objects.
+
+    Recipients that sending has failed for are left out as well, if the
+    failure was permanent or they are not yet due for another attempt (see
+    `MessageFailure`).
+    '''
+    def get_undelivered_recipients(self):
+        failures = self.failures.filter(Q(permanent=True) | Q(next_attempt__gt=timezone.now()))
 
-        recipients += members
+        members = self.get_member_recipients().exclude(
+            id__in=self.deliveries.exclude(member=None).values('member_id')
+        ).exclude(
+            id__in=failures.exclude(member=None).values('member_id')
+        )
+        subscribers = self.get_subscriber_recipients().exclude(
+            id__in=self.deliveries.exclude(subscriber=None).values('subscriber_id')
+        ).exclude(
+            id__in=failures.exclude(subscriber=None).values('subscriber_id')
+        )
+        return members, subscribers
 
-        ####################
-        # Get Subscribers. #
-        ####################
 
-        # Add subscribers if requested.
-        if self.include_mailing_list:
-            recipients += Subscriber.objects.filter(email_verified=True)
+    '''
+    Returns the failures of those recipients that the message could not be
+    delivered to, and won't be retried.
+    '''
+    def get_undeliverable(self):
+        return self.failures.filter(permanent=True).order_by('email')
 
-        return recipients
+
+    '''
+    Iterates through the recipients that have not yet received the message,
+    in chunks of `Recipient` records. Only one chunk is held in memory at a
+    time, no matter how many recipients there are. Chunks are fetched by the
+    recipients' IDs (keyset pagination), so fetching a chunk costs the same
+    regardless of how far into the list it is.
+
+    If a `lease` is given, only the recipients within it are iterated through.
+    '''
+    def get_undelivered_recipient_chunks(self, chunk_size=None, lease=None):
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'BULK_SEND_CHUNK_SIZE', 500)
+
+        members, subscribers = self.get_undelivered_recipients()
+
+        for model, recipients in ((Member, members), (Subscriber, subscribers)):
+            if lease is not None:
+                if lease.get_recipient_model() is not model:
+                    continue
+                recipients = recipients.filter(id__lte=lease.last_id)
+                last_id = lease.first_id - 1
+            else:
+                last_id = 0
+
+            while True:
+                chunk = [
+                    Recipient(model, *values) for values in recipients.filter(
+                        id__gt=last_id
+                    ).order_by(
+                        'id'
+                    ).values_list(
+                        'id',
+                        'email',
+                        'temporary_web_id'
+                    )[:chunk_size]
+                ]
+
+                if len(chunk) == 0:
+                    break
+
+                yield chunk
+
+                last_id = chunk[-1].id
 
 
     '''
@@ -159,18 +285,238 @@ class Message(models.Model):
     already sent to, so that sending can be stopped and resumed at will and
     continued on failure. Also makes sure that every target has a
     `temporary_web_id` for identification when communicating back.
+
+    The recipients are divided into ranges that are leased to whoever is
+    sending (see `MessageLease`), so that any number of processes or threads,
+    each identified by a unique `worker` name, may send the same message at
+    the same time, each to their own recipients. A worker that dies loses its
+    lease when it expires, after which another worker picks it up.
+
+    Recipients that sending fails for are retried on later runs, with an
+    exponentially growing delay between attempts, until it either succeeds
+    or turns out to be hopeless (see `MessageFailure`). The message is
+    complete once every recipient has either received it or been given up on.
+
+    Sending is paced by a `scheduler` (see `SendScheduler`), which by default
+    is shared by everything sending in the process. The emails are sent by a
+    `sender` (see `Sender`), which is the one configured by default. An
+    already open sender may be given, which is then left open afterwards.
+    If the default sender can't connect to the mail server, nothing is sent
+    and `MailServerUnavailableException` is raised.
+    '''
+    def send_bulk(self, worker=None, scheduler=None, sender=None):
+
+        if worker is None:
+            worker = '%s:%d:%s' % (socket.gethostname(), os.getpid(), threading.current_thread().name)
+
+        # The first worker to arrive sets up the leases. Others either use
+        # them, or if there are none yet, conclude that the message is
+        # already being set up by somebody else.
+        if not self.setup_bulk() and not self.leases.exists():
+            raise MessageBeingProcessedException()
+
+        # Needed because the setup may have happened in another process.
+        self.refresh_from_db()
+
+        # Nothing to do if another worker completed sending while we were
+        # getting ready.
+        if self.sending_complete is not None:
+            return
+
+        # Number of recipients left. This is different from
+        # `recipient_count`, which describes the total number of recipients
+        # intended altogether. Some recipients may already have been sent to
+        # in a previous run, or by other workers, and this number takes that
+        # into account.
+        members, subscribers = self.get_undelivered_recipients()
+        recipient_count_remaining = members.count() + subscribers.count()
+
+        # The message is rendered only once, with only the unsubscription
+        # links differing between recipients.
+        prepared = self.prepare()
+
+        if scheduler is None:
+            scheduler = SendScheduler.get_shared()
+
+        # Deliveries are recorded in the database in batches, every
+        # `flush_count` recipients or `flush_seconds` seconds, whichever comes
+        # first, instead of after every single recipient. Pending deliveries
+        # are also recorded when sending stops for any reason, including the
+        # caller stopping the iteration. Only if the process is killed
+        # outright, may up to `flush_count` recipients that were sent to
+        # during the last `flush_seconds` seconds go unrecorded, and so
+        # receive the message again when sending is resumed.
+        flush_count = getattr(settings, 'BULK_SEND_FLUSH_COUNT', 50)
+        flush_seconds = getattr(settings, 'BULK_SEND_FLUSH_SECONDS', 5)
+        last_flush = time.time()
+
+        # Recipients that have been sent to, but not yet recorded as such in
+        # the database.
+        pending_deliveries = []
+
+        # Connections to the mail server are kept open for the entire bulk
+        # send, instead of connecting anew for every single email.
+        own_sender = sender is None
+        if own_sender:
+            sender = get_sender()
+
+        lease = None
+
+        try:
+            if own_sender:
+                sender.open()
+
+            i = 0
+            lease = MessageLease.acquire(self, worker)
+            if lease is None and self.leases.filter(finished=None).exists():
+                # Every unfinished lease is held by other workers.
+                raise MessageBeingProcessedException()
+
+            while lease is not None:
+
+                # If sending to any recipient fails, this will be switched to
+                # True and the lease will be marked as failed. Once all the
+                # leases are complete, an attempt will be made on future runs
+                # of this function to send to those recipients who we
+                # previously failed sending to, once they're due for another
+                # attempt. Only when every recipient has either received the
+                # message or been given up on, do we mark the processing of
+                # the message as complete, then applying clean-up measures.
+                something_failed = False
+
+                # Switched to True if any recipient is skipped because the
+                # scheduler defers them for being over budget. They are then
+                # sent to on future runs, just like those who failed, except
+                # that it doesn't count as a failure.
+                something_deferred = False
+
+                # Switched to False if the lease expired and was taken over
+                # by another worker, in which case we leave it to them.
+                lease_held = True
+
+                for recipients in self.get_undelivered_recipient_chunks(lease=lease):
+
+                    # The unsubscription links for every recipient in the
+                    # chunk are created all at once, instead of one database
+                    # insert per recipient.
+                    links = {}
+                    if prepared.unsubscription:
+                        links = prepared.unsubscription.produce_bulk_link_urls(
+                            [recipient.temporary_web_id for recipient in recipients]
+                        )
+
+                    # Called by the sender, possibly from another thread, so
+                    # it must not touch the database.
+                    def send(recipient, connection):
+                        return self.attempt_send(
+                            recipient,
+                            connection=connection,
+                            prepared=prepared,
+                            links=links.get(recipient.temporary_web_id)
+                        )
+
+                    deferred = []
+                    deliveries = sender.deliver(self.schedule(recipients, scheduler, deferred), send)
+
+                    try:
+                        for recipient, error in deliveries:
+                            success = error is None
+
+                            # Note the results for determining when the
+                            # message has been successfully processed.
+                            if success:
+                                pending_deliveries.append(recipient)
+
+                                if len(pending_deliveries) >= flush_count or time.time() - last_flush >= flush_seconds:
+                                    self.record_deliveries(pending_deliveries)
+                                    pending_deliveries = []
+                                    last_flush = time.time()
+
+                                    lease_held = lease.renew()
+                            else:
+                                something_failed = True
+                                self.record_failure(recipient, error)
+
+                            # Report back the status to a calling function.
+                            i += 1
+                            yield i, recipient_count_remaining, recipient.email, success
+
+                            if not lease_held:
+                                break
+
+                    finally:
+                        # Emails still in flight when we stopped are sent
+                        # anyway, and need to be recorded.
+                        deliveries.close()
+                        pending_deliveries += self.take_delivered(sender)
+
+                    if len(deferred) > 0:
+                        something_deferred = True
+
+                    if not lease_held:
+                        break
+
+                self.record_deliveries(pending_deliveries)
+                pending_deliveries = []
+
+                if lease_held:
+                    lease.finish(failed=something_failed or something_deferred)
+
+                lease = MessageLease.acquire(self, worker)
+
+            self.finish_bulk()
+
+        finally:
+            try:
+                # Record whatever was sent before sending was stopped.
+                self.record_deliveries(pending_deliveries)
+            finally:
+                if own_sender:
+                    sender.close()
+
+                # Let other workers take over whatever we didn't finish.
+                if lease is not None:
+                    lease.release()
+
+
+    '''
+    Iterates through the given `Recipient`s as the `scheduler` allows sending
+    to them, waiting as needed. Those that it defers are skipped and added to
+    the `deferred` list instead, so that they can be sent to on a later run.
     '''
-    def send_bulk(self):
+    def schedule(self, recipients, scheduler, deferred):
+        for recipient in recipients:
+            if scheduler.wait(recipient.email):
+                yield recipient
+            else:
+                deferred.append(recipient)
+
 
-        # Receive a lock on the message processing by setting
-        # `being_processed` to True. In order to prevent a race condition,
-        # where a check for being_processed=False might be read just before it
-        # is updated to True in another process, we update the value using a
-        # filter that tells us whether the row was found in the state of
+    '''
+    Returns the recipients that the sender delivered to after sending was
+    stopped, which need to be recorded like any other deliveries.
+    '''
+    def take_delivered(self, sender):
+        return [recipient for recipient, error in sender.take_unreported() if error is None]
+
+
+    '''
+    Prepares the message for bulk sending by dividing the recipients that
+    have not received it yet into leases (see `MessageLease`). Returns False
+    if another worker is already doing so, but otherwise True, including when
+    there turns out to be nothing to do.
+    '''
+    def setup_bulk(self):
+
+        # Receive a lock on the setup by setting `being_processed` to True.
+        # In order to prevent a race condition, where a check for
+        # being_processed=False might be read just before it is updated to
+        # True in another process, we update the value using a filter that
+        # tells us whether the row was found in the state of
         # being_processed=False at the exact time of updating. If no such row
         # was found, it means that the being_processed field was already set
-        # to True, and we should skip this bulk send. If the row to be updated
-        # was found, it means that it was indeed at False when we updated,
+        # to True, and we should skip the setup. If the row to be updated was
+        # found, it means that it was indeed at False when we updated,
         # meaning we should have an exclusive lock.
         try:
             rows_found = Message.objects.filter(
@@ -180,106 +526,58 @@ class Message(models.Model):
                 being_processed=True
             )
             if rows_found == 0:
-                raise MessageBeingProcessedException()
+                return False
         except OperationalError:
             # This will occasionally happen because of a database deadlock
-            # resulting from the constant saving of new information into the
-            # message below (`self.save()`). This is a symptom of another
-            # script working on the same message, so it will also induce a
-            # `MessageBeingProcessedException`.
-            raise MessageBeingProcessedException()
+            # resulting from the saving of new information into the message
+            # (`record_deliveries`). This is a symptom of another script
+            # working on the same message.
+            return False
 
         try:
             # Needed because otherwise the `being_processed=False` state will
             # be resubmitted to database on `Message.save`.
             self.refresh_from_db()
 
-            # Get the Member and Subscriber objects we'll be sending to.
-            recipients = self.get_recipients()
+            # Already set up by another worker, or already sent.
+            if self.sending_complete is not None or self.leases.exists():
+                return True
 
             # We'll be reporting this back to the calling function so that an
             # iterating caller may know how much is left. This must be figured
             # out before we remove recipients already delivered to.
-            self.recipient_count = len(recipients)
+            self.recipient_count = self.get_recipient_count()
 
             # Declare that we've started the show.
             self.sending_started = timezone.now()
-            self.save()
+            self.save(update_fields=['recipient_count', 'sending_started'])
 
-            # Remove recipients that have already received the message, which
-            # may happen if a bulk sending is cancelled or fails before completing.
-            for delivery in self.deliveries.select_related('member', 'subscriber'):
-                if delivery.member is not None and delivery.member in recipients:
-                    recipients.remove(delivery.member)
-                elif delivery.subscriber is not None and delivery.subscriber in recipients:
-                    recipients.remove(delivery.subscriber)
+            members, subscribers = self.get_undelivered_recipients()
 
             # Make sure that any Member and Subscriber have `temporary_web_id`
             # values for communicating back. It is very rare that they are
             # lacking and basically might only affect very old memberships or
             # if someone is registered manually by an administrator.
-            # Recipients are either Member or Subscriber models and are
-            # expected to have both an `email` and `temporary_web_id` field.
-            for recipient in recipients:
-                if recipient.temporary_web_id is None:
-                    recipient.temporary_web_id = generate_random_string()
-                    recipient.save()
-
-            # Number of recipients left. This is different from
-            # `recipient_count`, which describes the total number of
-            # recipients intended altogether. Some recipients may already have
-            # been sent to in a previous run and this number takes that into
-            # account. This and `recipient_count` will be the same if this is
-            # the first attempt at running the bulk send.
-            recipient_count_remaining = len(recipients)
-
-            # If sending to any recipient fails, this will be switched to True
-            # and the message will not be marked as complete. On future runs
-            # of this function, an attempt will be made to send to those
-            # recipients who we previously failed sending to. Only when we've
-            # successfully sent to the entire list of recipients with this
-            # still remaining False afterwards, do we mark the processing of
-            # the message as complete, then applying clean-up measures.
-            something_failed = False
-
-            for i, recipient in enumerate(recipients):
-
-                # Attempt to send the message.
-                success = self.send(recipient)
-
-                # Note the results for determining when the message has been
-                # successfully processed.
-                if success:
-                    with transaction.atomic():
-                        delivery = MessageDelivery(message=self)
-                        if type(recipient) is Member:
-                            delivery.member = recipient
-                        elif type(recipient) is Subscriber:
-                            delivery.subscriber = recipient
-                        delivery.save()
-
-                        # We'll also keep track of this so that the web
-                        # interface can keep track of progress. Heavier on the
-                        # script, but easier on the interface, and we care
-                        # more about the user experience than making sure that
-                        # emails get completed some microseconds sooner. Bulk
-                        # sending must be assumed to take a while anyway.
-                        self.recipient_count_complete += 1
-                        self.save()
-                else:
-                    something_failed = True
-
-                # Report back the status to a calling function.
-                yield i+1, recipient_count_remaining, recipient.email, success
-
-            # Clean up, if everything seems to have worked.
-            if not something_failed:
-                self.sending_complete = timezone.now()
-
-                # No more need for delivery objects.
-                MessageDelivery.objects.filter(message=self).delete()
-
-            self.save()
+            for recipients in (members, subscribers):
+                for recipient_id in recipients.filter(temporary_web_id=None).values_list('id', flat=True):
+                    recipients.model.objects.filter(id=recipient_id).update(
+                        temporary_web_id=generate_random_string()
+                    )
+
+            # Divide the recipients into leases. All of them are created at
+            # once so that other workers never see only some of them.
+            leases = []
+            lease_size = getattr(settings, 'BULK_SEND_LEASE_SIZE', 1000)
+            for recipients in self.get_undelivered_recipient_chunks(chunk_size=lease_size):
+                leases.append(MessageLease(
+                    message=self,
+                    recipient_type=MessageLease.RECIPIENT_TYPES_BY_MODEL[recipients[0].model],
+                    first_id=recipients[0].id,
+                    last_id=recipients[-1].id
+                ))
+            MessageLease.objects.bulk_create(leases)
+
+            return True
 
         finally:
             # Release lock we received in beginning of function.
@@ -292,40 +590,183 @@ class Message(models.Model):
 
 
     '''
-    Sends the message to a single email address, taking care of
-    unsubscribe-links and logging. Bulk sending is managed by `send_bulk()`.
+    Marks the message as completely sent if every lease has been finished
+    without failure and no recipient is waiting to be retried. Otherwise, the
+    leases are all removed so that the next bulk send divides the remaining
+    recipients anew. Does nothing while other workers are still sending.
+    '''
+    def finish_bulk(self):
+        if self.leases.filter(finished=None).exists():
+            return
+
+        if self.leases.filter(failed=True).exists() or self.failures.filter(permanent=False).exists():
+            self.leases.all().delete()
+            return
+
+        # Only one worker gets to complete the message.
+        sending_complete = timezone.now()
+        if Message.objects.filter(id=self.id, sending_complete=None).update(sending_complete=sending_complete):
+            self.sending_complete = sending_complete
+
+            # No more need for delivery or lease objects. The failures that
+            # remain are those of the recipients that were given up on.
+            MessageDelivery.objects.filter(message=self).delete()
+            self.leases.all().delete()
+
 
-    Takes the single argument `recipient`, which is expected to have `email`
-    and `temporary_web_id` fields, like Member or Subscriber objects.
     '''
-    def send(self, recipient, testsend=False):
-        body = self.body
+    Records that the given `Recipient`s have received the message, so that
+    they won't receive it again if sending is resumed. Also keeps track of
+    progress for the web interface. Done in one bulk insert and one update,
+    for any number of recipients.
+    '''
+    def record_deliveries(self, recipients):
+        if len(recipients) == 0:
+            return
+
+        deliveries = []
+        for recipient in recipients:
+            delivery = MessageDelivery(message=self)
+            if recipient.model is Member:
+                delivery.member_id = recipient.id
+            elif recipient.model is Subscriber:
+                delivery.subscriber_id = recipient.id
+            deliveries.append(delivery)
+
+        with transaction.atomic():
+            MessageDelivery.objects.bulk_create(deliveries)
+
+            # Those that failed before have now been retried successfully.
+            self.failures.filter(
+                Q(member_id__in=[r.id for r in recipients if r.model is Member])
+                | Q(subscriber_id__in=[r.id for r in recipients if r.model is Subscriber])
+            ).delete()
+
+            # Counted by the database, so that the count stays correct no
+            # matter what else has updated it meanwhile.
+            Message.objects.filter(id=self.id).update(
+                recipient_count_complete=F('recipient_count_complete') + len(recipients)
+            )
+
+        self.recipient_count_complete += len(recipients)
+
+
+    '''
+    Records that sending to the given `Recipient` failed with the given
+    exception, and when to try again, unless the failure is permanent or the
+    recipient has been tried `settings.BULK_SEND_MAX_ATTEMPTS` times. The
+    delay before the next attempt starts at `settings.BULK_SEND_RETRY_DELAY`
+    seconds and doubles with every failed attempt. Failures of the mail server
+    rather than the recipient (see `is_server_failure`) are retried after the
+    initial delay, without counting as an attempt.
+    '''
+    def record_failure(self, recipient, ex):
+        max_attempts = getattr(settings, 'BULK_SEND_MAX_ATTEMPTS', 5)
+        retry_delay = getattr(settings, 'BULK_SEND_RETRY_DELAY', 300)
+
+        if recipient.model is Member:
+            lookup = { 'member_id': recipient.id }
+        else:
+            lookup = { 'subscriber_id': recipient.id }
+
+        failure = self.failures.filter(**lookup).first()
+        if failure is None:
+            failure = MessageFailure(message=self, **lookup)
+
+        failure.email = recipient.email
+        failure.error = ex.__class__.__name__
 
-        # Append the portion of the email that offers the user to unsubscribe,
-        # if that message ("reject_email_messages") has been configured and a
-        # temporary web ID is provided to fill the link.
-        if recipient.temporary_web_id is not None:
+        if is_server_failure(ex):
+            failure.next_attempt = timezone.now() + datetime.timedelta(seconds=retry_delay)
+        else:
+            failure.attempts += 1
+            failure.permanent = is_permanent_failure(ex) or failure.attempts >= max_attempts
+            failure.next_attempt = timezone.now() + datetime.timedelta(
+                seconds=retry_delay * 2 ** (failure.attempts - 1)
+            )
+
+        failure.save()
+
+
+    '''
+    Renders the message for sending, once for any number of recipients (see
+    `PreparedMail`). Unless `unsubscription` is False, the portion of the
+    email that offers the user to unsubscribe is appended, if that message
+    ("reject_email_messages") has been configured.
+    '''
+    def prepare(self, unsubscription=True):
+        footer = None
+        link_names = ()
+
+        if unsubscription:
             unsubscription = InteractiveMessage.objects.filter(
                 interactive_type='reject_email_messages'
             ).first()
 
             if unsubscription:
-                body += '\n\n---\n'
-                body += unsubscription.produce_links(recipient.temporary_web_id)
+                footer = unsubscription.body
+                link_names = InteractiveMessage.INTERACTIVE_TYPES_DETAILS[
+                    unsubscription.interactive_type]['links']
+
+        prepared = PreparedMail(
+            self.subject,
+            self.body,
+            from_email=self.from_address,
+            footer=footer,
+            link_names=link_names
+        )
+        prepared.unsubscription = unsubscription or None
+
+        return prepared
+
+
+    '''
+    Sends the message to a single email address, taking care of
+    unsubscribe-links and logging. Bulk sending is managed by `send_bulk()`.
+
+    Takes the single argument `recipient`, which is expected to have `email`
+    and `temporary_web_id` fields, like Member, Subscriber or Recipient
+    objects. An already open `connection` to the mail server may be provided,
+    which is how `send_bulk()` avoids connecting anew for every recipient,
+    and likewise an already `prepared` message (see `prepare()`) and the
+    recipient's unsubscription `links`, if they've already been made.
+
+    Returns True on success and False on failure.
+    '''
+    def send(self, recipient, testsend=False, connection=None, prepared=None, links=None):
+        return self.attempt_send(
+            recipient,
+            testsend=testsend,
+            connection=connection,
+            prepared=prepared,
+            links=links
+        ) is None
+
+
+    '''
+    Works like `send()`, except that it returns None on success and the
+    exception that sending failed with on failure, so that the caller can
+    tell what kind of failure it was.
+    '''
+    def attempt_send(self, recipient, testsend=False, connection=None, prepared=None, links=None):
+
+        # The unsubscription links can only be filled if a temporary web ID
+        # is provided.
+        if prepared is None or (recipient.temporary_web_id is None and prepared.unsubscription):
+            prepared = self.prepare(unsubscription=recipient.temporary_web_id is not None)
+
+        if links is None:
+            links = {}
+            if prepared.unsubscription:
+                links = prepared.unsubscription.produce_link_urls(recipient.temporary_web_id)
 
         try:
             # Actually send.
-            quick_mail(
-                to=recipient.email,
-                subject=self.subject,
-                body=body,
-                from_email=self.from_address,
-                subject_prefix=None
-            )
+            prepared.make(recipient.email, links, connection=connection).send(fail_silently=False)
 
             # Log and notify calling function of success.
             log_mail(recipient.email, self, testsend=testsend)
-            return True
+            return None
 
         except Exception as ex:
             # Log and notify calling function of failure.
@@ -346,9 +787,9 @@ class Message(models.Model):
             # This is done by checking for the very specific error that
             # communicates this scenario.
             if 'Recipient address rejected: piratar.is' in str(ex.args):
-                return True
+                return None
 
-            return False
+            return ex
 
     class Meta:
         ordering = ['added']
@@ -361,6 +802,143 @@ class MessageDelivery(models.Model):
     timing = models.DateTimeField(default=timezone.now)
 
 
+class MessageFailure(models.Model):
+    '''
+    A recipient that sending a message to has failed, during bulk sending.
+    Failed recipients are retried on later runs, no sooner than at
+    `next_attempt`, until sending either succeeds, in which case the failure
+    is removed, or it becomes `permanent`, either because the mail server
+    refused the recipient outright or because it was tried too many times.
+
+    Permanent failures are kept after sending is complete, as the list of
+    addresses that the message could not be delivered to.
+    '''
+    message = models.ForeignKey(Message, on_delete=CASCADE, related_name='failures')
+    member = models.ForeignKey('member.Member', null=True, on_delete=CASCADE)
+    subscriber = models.ForeignKey('member.Subscriber', null=True, on_delete=CASCADE)
+    email = models.EmailField()
+
+    attempts = models.IntegerField(default=0)
+    # Class name of the exception that the last attempt failed with.
+    error = models.CharField(max_length=200)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    permanent = models.BooleanField(default=False)
+
+
+class MessageLease(models.Model):
+    '''
+    A range of a message's recipients, given by their IDs, which is leased to
+    one worker at a time during bulk sending. This is what allows several
+    processes or threads to send the same message at the same time without
+    sending to the same recipients.
+
+    A lease expires unless its worker renews it, which happens as the worker
+    records its deliveries. When a worker dies, its lease will expire and
+    then be taken over by another worker, who will only send to those
+    recipients that haven't already received the message.
+    '''
+
+    RECIPIENT_TYPES = (
+        ('member', 'Member'),
+        ('subscriber', 'Subscriber'),
+    )
+
+    RECIPIENT_TYPES_BY_MODEL = {
+        Member: 'member',
+        Subscriber: 'subscriber',
+    }
+
+    message = models.ForeignKey(Message, on_delete=CASCADE, related_name='leases')
+    recipient_type = models.CharField(max_length=20, choices=RECIPIENT_TYPES)
+    first_id = models.IntegerField()
+    last_id = models.IntegerField()
+
+    worker = models.CharField(max_length=200, null=True)
+    expires = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    # True when not every recipient in the lease got the message, because
+    # sending to them either failed or was deferred.
+    failed = models.BooleanField(default=False)
+
+    @staticmethod
+    def get_duration():
+        return datetime.timedelta(seconds=getattr(settings, 'BULK_SEND_LEASE_SECONDS', 300))
+
+    '''
+    Leases an unfinished range of recipients of the given message to the
+    given worker, or returns None if there are none available. A worker may
+    re-acquire its own lease, for example after having stopped sending.
+    '''
+    @staticmethod
+    def acquire(message, worker):
+        while True:
+            now = timezone.now()
+            available = Q(expires=None) | Q(expires__lt=now) | Q(worker=worker)
+
+            lease = message.leases.filter(available, finished=None).order_by('id').first()
+            if lease is None:
+                return None
+
+            # Another worker may get to the same lease between us finding it
+            # and updating it, in which case we try again.
+            expires = now + MessageLease.get_duration()
+            if MessageLease.objects.filter(available, id=lease.id, finished=None).update(worker=worker, expires=expires):
+                lease.worker = worker
+                lease.expires = expires
+                return lease
+
+    def get_recipient_model(self):
+        return {
+            'member': Member,
+            'subscriber': Subscriber,
+        }[self.recipient_type]
+
+    # Extends the lease. Returns False if it has been lost to another worker.
+    def renew(self):
+        self.expires = timezone.now() + MessageLease.get_duration()
+        return MessageLease.objects.filter(id=self.id, worker=self.worker).update(expires=self.expires) > 0
+
+    def finish(self, failed=False):
+        self.finished = timezone.now()
+        self.failed = failed
+        MessageLease.objects.filter(id=self.id, worker=self.worker).update(
+            finished=self.finished,
+            failed=self.failed
+        )
+
+    # Makes an unfinished lease available to other workers right away.
+    def release(self):
+        MessageLease.objects.filter(id=self.id, worker=self.worker, finished=None).update(
+            worker=None,
+            expires=None
+        )
+
+
+class SendBudget(models.Model):
+    '''
+    The state of one of the budgets that bulk sending is paced by (see
+    `SendScheduler`), kept in the database so that every process sending
+    email shares it, instead of each having a whole budget of its own. A
+    budget is a `TokenBucket` allowing a number of emails per `period`
+    seconds, either overall or to addresses at the domain given by `scope`.
+
+    Budgets are created as they are first used, starting out full. Since
+    several processes update them at once, they are only ever updated if the
+    `version` is the same as when they were read.
+    '''
+    # The recipient domain, or an empty string for the overall budget.
+    scope = models.CharField(max_length=255)
+    period = models.IntegerField()
+
+    tokens = models.FloatField()
+    # When `tokens` was last updated, in seconds since the epoch.
+    updated = models.FloatField()
+    version = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('scope', 'period')
+
+
 class InteractiveMessage(models.Model):
 
     INTERACTIVE_TYPES = (
@@ -436,6 +1014,21 @@ class InteractiveMessage(models.Model):
             except Member.DoesNotExist:
                 member = None
 
+        except Exception as ex:
+            # Log the failure.
+            log_mail(email, self, ex)
+            return
+
+        self.deliver(email, body)
+
+    '''
+    Sends an already prepared body (see `produce_links`) to the designated
+    email, while handling delivery logging. Returns the exception that
+    sending failed with, or None if it succeeded. Doesn't use the database,
+    so it may be called from other threads.
+    '''
+    def deliver(self, email, body):
+        try:
             # Actually send the prepared message.
             quick_mail(email, self.subject, body)
 
@@ -445,11 +1038,24 @@ class InteractiveMessage(models.Model):
         except Exception as ex:
             # Log the failure.
             log_mail(email, self, ex)
+            return ex
+
+        return None
 
 
     def produce_links(self, random_string):
         result = self.body
 
+        for link_name, link in self.produce_link_urls(random_string).items():
+            result = result.replace('{{%s}}' % link_name, '<%s>' % link)
+
+        return result
+
+    # Returns a dictionary of the URLs that the links in the message template
+    # should lead to, keyed by link name.
+    def produce_link_urls(self, random_string):
+        links = {}
+
         for link_name in InteractiveMessage.INTERACTIVE_TYPES_DETAILS[
                 self.interactive_type]['links']:
             short_link = ShortURL(url='%s/message/mailcommand/%s/%s/%s/' % (
@@ -458,9 +1064,36 @@ class InteractiveMessage(models.Model):
                 link_name,
                 random_string))
             short_link.save()
-            link = str(short_link)
-            link = '<%s>' % link
-            result = result.replace('{{%s}}' % link_name, link)
+            links[link_name] = str(short_link)
+
+        return links
+
+    # Like `produce_link_urls`, but for many recipients at once, with all of
+    # the short URLs created in a single bulk insert. Returns a dictionary of
+    # link dictionaries, keyed by the random strings given.
+    def produce_bulk_link_urls(self, random_strings):
+        result = {}
+        short_links = []
+
+        for random_string in random_strings:
+            links = {}
+            for link_name in InteractiveMessage.INTERACTIVE_TYPES_DETAILS[
+                    self.interactive_type]['links']:
+                short_link = ShortURL(url='%s/message/mailcommand/%s/%s/%s/' % (
+                    settings.SITE_URL,
+                    self.interactive_type,
+                    link_name,
+                    random_string))
+
+                # Short URLs are only stored when they're actually shorter
+                # (see `ShortURL.save`).
+                if short_link.short_length() < len(short_link.url):
+                    short_links.append(short_link)
+
+                links[link_name] = str(short_link)
+            result[random_string] = links
+
+        ShortURL.objects.bulk_create(short_links, batch_size=500)
 
         return result
 
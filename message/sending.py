@@ -0,0 +1,564 @@
+import asyncio
+import os
+import smtplib
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+
+from icepirate.utils import assemble_mail
+from icepirate.utils import generate_random_string
+from icepirate.utils import render_mail
+
+from message.exceptions import MailServerUnavailableException
+
+
+class PersistentConnection(object):
+    '''
+    A mail connection that stays open for the lifetime of a bulk send, so
+    that every email doesn't have to pay for a new connection, TLS handshake
+    and authentication with the mail server.
+
+    It quacks like a Django email backend, so that it can be given as the
+    `connection` of an email (see `icepirate.utils.quick_mail`). The
+    underlying backend is whatever `EMAIL_BACKEND` is configured.
+
+    If the mail server drops the connection, which they do when they've been
+    idle for too long or have received a certain number of emails over the
+    same connection, we reconnect and try again, transparently to the caller.
+    To stay below the limits that mail servers commonly place on the number
+    of emails per connection, we also reconnect on our own after every
+    `settings.BULK_MAIL_MESSAGES_PER_CONNECTION` emails.
+
+    Usage:
+        with PersistentConnection() as connection:
+            for recipient in recipients:
+                quick_mail(..., connection=connection)
+    '''
+
+    # Errors that indicate that the connection itself is broken, as opposed
+    # to the server refusing a particular email.
+    CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError)
+
+    # SMTP code for "Service not available, closing transmission channel".
+    SERVICE_CLOSING = 421
+
+    def __init__(self, messages_per_connection=None, retries=1):
+        if messages_per_connection is None:
+            messages_per_connection = getattr(settings, 'BULK_MAIL_MESSAGES_PER_CONNECTION', 100)
+
+        self.messages_per_connection = messages_per_connection
+        self.retries = retries
+
+        self.backend = get_connection(fail_silently=False)
+        self.sent_on_connection = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        self.backend.open()
+        self.sent_on_connection = 0
+
+    def close(self):
+        try:
+            self.backend.close()
+        except Exception:
+            # The connection may already be gone, which is fine, since
+            # closing it is what we wanted anyway.
+            pass
+
+    def reconnect(self):
+        self.close()
+        self.open()
+
+    @classmethod
+    def is_connection_error(cls, ex):
+        if isinstance(ex, cls.CONNECTION_ERRORS):
+            return True
+        if isinstance(ex, smtplib.SMTPResponseException) and ex.smtp_code == cls.SERVICE_CLOSING:
+            return True
+        return False
+
+    def send_messages(self, email_messages):
+        if self.messages_per_connection and self.sent_on_connection >= self.messages_per_connection:
+            self.reconnect()
+
+        attempt = 0
+        while True:
+            try:
+                sent = self.backend.send_messages(email_messages)
+                self.sent_on_connection += len(email_messages)
+                return sent
+            except Exception as ex:
+                if attempt >= self.retries or not self.is_connection_error(ex):
+                    raise
+                attempt += 1
+                self.reconnect()
+
+
+class Sender(object):
+    '''
+    Sends bulk email one recipient at a time, over a single connection to the
+    mail server. This is the default way of sending, but see `AsyncSender`.
+
+    Senders are used by `Message.send_bulk` and are given the recipients to
+    send to along with a `send` function, which sends to a single recipient
+    over a given connection and returns None on success or the exception that
+    sending failed with. They yield each recipient with the result of sending
+    to them, in the order that sending completes.
+
+    Usage:
+        with get_sender() as sender:
+            for recipient, error in sender.deliver(recipients, send):
+                ...
+    '''
+
+    def __init__(self, connection=None):
+        if connection is None:
+            connection = PersistentConnection()
+        self.connection = connection
+
+        # Results that were not yielded because the caller stopped iterating
+        # before receiving them. Sending completes before its result is
+        # yielded, so there are never any here.
+        self.unreported = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Failing to connect and the mail server refusing us are both `OSError`s,
+    # which `smtplib.SMTPException` is a kind of.
+    def open(self):
+        try:
+            self.connection.open()
+        except OSError as ex:
+            raise MailServerUnavailableException(ex) from ex
+
+    def close(self):
+        self.connection.close()
+
+    def deliver(self, recipients, send):
+        for recipient in recipients:
+            yield recipient, send(recipient, self.connection)
+
+    # Returns and forgets the results that were never yielded.
+    def take_unreported(self):
+        unreported = self.unreported
+        self.unreported = []
+        return unreported
+
+
+class AsyncSender(Sender):
+    '''
+    Sends bulk email to many recipients at once, so that the time spent
+    waiting for the mail server to accept each email overlaps, instead of
+    adding up. Up to `concurrency` emails are in flight at a time, each over
+    its own connection from a pool of as many connections, which defaults to
+    `settings.BULK_SEND_CONCURRENCY`. Used instead of `Sender` when
+    `settings.BULK_SEND_ASYNC` is True.
+
+    Sending is coordinated by an asyncio event loop, which is only run while
+    waiting for sending to complete, so that results can be yielded from an
+    ordinary generator. The SMTP transactions themselves are carried out by
+    the configured `EMAIL_BACKEND`, which blocks, in a thread for each
+    connection.
+
+    If the caller stops iterating, emails that are in flight are still sent,
+    and their results are kept in `unreported` so that they can be recorded.
+    '''
+
+    def __init__(self, concurrency=None):
+        if concurrency is None:
+            concurrency = getattr(settings, 'BULK_SEND_CONCURRENCY', 10)
+
+        self.concurrency = concurrency
+        self.connections = [PersistentConnection() for i in range(concurrency)]
+        self.unreported = []
+
+        self.loop = None
+        self.executor = None
+        self.pool = None
+
+    def open(self):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(self.concurrency)
+        self.pool = asyncio.Queue()
+        for connection in self.connections:
+            try:
+                connection.open()
+            except OSError as ex:
+                raise MailServerUnavailableException(ex) from ex
+            self.pool.put_nowait(connection)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.loop is not None:
+            self.loop.close()
+
+    async def send_one(self, recipient, send):
+        connection = await self.pool.get()
+        try:
+            return recipient, await self.loop.run_in_executor(self.executor, send, recipient, connection)
+        finally:
+            self.pool.put_nowait(connection)
+
+    # Runs the event loop until at least one email in flight has been sent,
+    # or all of them if `wait_for_all` is True. Returns the results of those
+    # that have been sent and those that remain in flight.
+    def complete(self, in_flight, wait_for_all=False):
+        done, in_flight = self.loop.run_until_complete(asyncio.wait(
+            in_flight,
+            return_when=asyncio.ALL_COMPLETED if wait_for_all else asyncio.FIRST_COMPLETED
+        ))
+        return [task.result() for task in done], in_flight
+
+    def deliver(self, recipients, send):
+        in_flight = set()
+        completed = []
+
+        try:
+            for recipient in recipients:
+                in_flight.add(self.loop.create_task(self.send_one(recipient, send)))
+
+                if len(in_flight) >= self.concurrency:
+                    results, in_flight = self.complete(in_flight)
+                    completed.extend(results)
+
+                while len(completed) > 0:
+                    yield completed.pop(0)
+
+            while len(in_flight) > 0:
+                results, in_flight = self.complete(in_flight)
+                completed.extend(results)
+
+                while len(completed) > 0:
+                    yield completed.pop(0)
+
+        finally:
+            if len(in_flight) > 0:
+                results, in_flight = self.complete(in_flight, wait_for_all=True)
+                completed.extend(results)
+            self.unreported.extend(completed)
+
+
+# Returns the sender configured for bulk sending (see `Sender`).
+def get_sender():
+    if getattr(settings, 'BULK_SEND_ASYNC', False):
+        return AsyncSender()
+    return Sender()
+
+
+class PreparedMail(object):
+    '''
+    An email that is rendered from Markdown into plain text and HTML, with
+    its CSS inlined, only once, no matter how many recipients it is sent to.
+
+    The `footer` may contain links in the form of `{{link_name}}` for each
+    name in `link_names`, which differ between recipients, like the
+    unsubscription links in an InteractiveMessage. Before rendering, they are
+    replaced with unique placeholder URLs which are rendered like any other
+    link, so that each recipient's email can be made by simply replacing the
+    placeholders in the rendered result with the actual links.
+
+    Usage:
+        prepared = PreparedMail(subject, body, footer=footer, link_names=('reject_link',))
+        for recipient in recipients:
+            email = prepared.make(recipient.email, { 'reject_link': link })
+            email.send()
+    '''
+
+    def __init__(self, subject, body, from_email=None, subject_prefix=None, footer=None, link_names=()):
+        self.subject = subject
+        self.from_email = from_email
+        self.subject_prefix = subject_prefix
+
+        # The placeholders look like the actual links so that they get
+        # rendered in precisely the same way.
+        token = generate_random_string()
+        self.placeholders = dict([
+            (link_name, '%s/%s/%s' % (settings.SITE_URL, token, link_name)) for link_name in link_names
+        ])
+
+        if footer is not None:
+            for link_name, placeholder in self.placeholders.items():
+                footer = footer.replace('{{%s}}' % link_name, '<%s>' % placeholder)
+            body += '\n\n---\n'
+            body += footer
+
+        self.text, self.html, self.images = render_mail(body)
+
+    def make(self, to, links={}, connection=None):
+        text = self.text
+        html = self.html
+        for link_name, link in links.items():
+            text = text.replace(self.placeholders[link_name], link)
+            html = html.replace(self.placeholders[link_name], link)
+
+        return assemble_mail(
+            to,
+            self.subject,
+            text,
+            html,
+            self.images,
+            from_email=self.from_email,
+            subject_prefix=self.subject_prefix,
+            connection=connection
+        )
+
+
+class TokenBucket(object):
+    '''
+    Allows `rate` events per `period` seconds. The bucket starts out full,
+    holding `rate` tokens, and is refilled evenly over the period. Each event
+    takes a token, so once the bucket has been emptied, events are paced
+    evenly at the given rate. The bucket may be given the `tokens` that it
+    held at the time `updated`, in seconds since the epoch.
+    '''
+
+    def __init__(self, rate, period, tokens=None, updated=None):
+        self.capacity = float(rate)
+        self.tokens = self.capacity if tokens is None else min(tokens, self.capacity)
+        self.refill_rate = float(rate) / period
+        self.updated = time.time() if updated is None else updated
+
+    def refill(self, now):
+        # The clocks of different hosts may disagree slightly.
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_rate)
+        self.updated = now
+
+    # Seconds until a token will be available.
+    def delay(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.refill_rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+
+# Raised when a budget is updated by someone else between us reading it and
+# taking from it, in which case we read it again.
+class BudgetChanged(Exception):
+    pass
+
+
+class SendScheduler(object):
+    '''
+    Paces bulk sending so that it stays within the budgets of the mail
+    server, as configured in `settings.BULK_SEND_RATE_LIMITS`, for example:
+
+        BULK_SEND_RATE_LIMITS = {
+            'per_minute': 300,
+            'per_hour': 10000,
+            'domains': {
+                'gmail.com': { 'per_minute': 60 },
+            },
+        }
+
+    The overall limits apply to all emails, and the limits of a domain to the
+    emails sent to addresses at that domain, in addition to the overall ones.
+
+    When a budget is exhausted, the scheduler waits until it allows another
+    email, but if that would take longer than `settings.BULK_SEND_MAX_WAIT`
+    seconds, the email is deferred instead, meaning that it should be sent in
+    a later run rather than counted as a failure.
+
+    The budgets are kept in the database (see `SendBudget`), so that they are
+    shared by every thread and process sending email, however many workers
+    are sending at once.
+    '''
+
+    PERIODS = {
+        'per_second': 1,
+        'per_minute': 60,
+        'per_hour': 3600,
+        'per_day': 86400,
+    }
+
+    shared = None
+    shared_lock = threading.Lock()
+
+    def __init__(self, limits=None, max_wait=None):
+        if limits is None:
+            limits = getattr(settings, 'BULK_SEND_RATE_LIMITS', {})
+        if max_wait is None:
+            max_wait = getattr(settings, 'BULK_SEND_MAX_WAIT', 60)
+
+        self.max_wait = max_wait
+
+        # Threads in the same process take turns, so that they don't keep
+        # getting in each other's way when updating the budgets.
+        self.lock = threading.Lock()
+
+        # As (scope, rate, period) tuples, where the scope is the domain that
+        # the limit applies to, or an empty string for all emails.
+        self.limits = self.make_limits('', limits)
+        self.domain_limits = dict([
+            (domain.lower(), self.make_limits(domain.lower(), domain_limits))
+            for domain, domain_limits in limits.get('domains', {}).items()
+        ])
+
+    def make_limits(self, scope, limits):
+        return [
+            (scope, limits[period_name], period)
+            for period_name, period in self.PERIODS.items()
+            if limits.get(period_name)
+        ]
+
+    # Returns the scheduler shared by everything sending in this process.
+    @classmethod
+    def get_shared(cls):
+        with cls.shared_lock:
+            if cls.shared is None:
+                cls.shared = cls()
+            return cls.shared
+
+    '''
+    Waits until an email may be sent to the given address and returns True,
+    or returns False right away if the email should be deferred instead.
+    '''
+    def wait(self, email):
+        domain = email.rsplit('@', 1)[-1].lower()
+        limits = self.limits + self.domain_limits.get(domain, [])
+        if len(limits) == 0:
+            return True
+
+        while True:
+            with self.lock:
+                try:
+                    delay = self.take(limits)
+                except (BudgetChanged, IntegrityError):
+                    continue
+
+            if delay == 0:
+                return True
+
+            if delay > self.max_wait:
+                return False
+
+            # Others may take the tokens while we sleep, in which case we'll
+            # just have to wait some more.
+            time.sleep(delay)
+
+    # Takes a token from each of the budgets of the given limits and returns
+    # 0, or if any of them is exhausted, takes nothing and returns the number
+    # of seconds until it won't be.
+    def take(self, limits):
+        from message.models import SendBudget
+
+        with transaction.atomic():
+            budgets = dict([
+                ((budget.scope, budget.period), budget)
+                for budget in SendBudget.objects.filter(scope__in=set([scope for scope, rate, period in limits]))
+            ])
+
+            now = time.time()
+            buckets = []
+            for scope, rate, period in limits:
+                budget = budgets.get((scope, period))
+                if budget is None:
+                    budget = SendBudget(scope=scope, period=period)
+                    bucket = TokenBucket(rate, period, updated=now)
+                else:
+                    bucket = TokenBucket(rate, period, budget.tokens, budget.updated)
+                buckets.append((budget, bucket))
+
+            delay = max([bucket.delay(now) for budget, bucket in buckets])
+            if delay > 0:
+                return delay
+
+            for budget, bucket in buckets:
+                bucket.take(now)
+                if budget.id is None:
+                    SendBudget.objects.create(scope=budget.scope, period=budget.period, tokens=bucket.tokens, updated=now)
+                elif SendBudget.objects.filter(id=budget.id, version=budget.version).update(
+                    tokens=bucket.tokens,
+                    updated=now,
+                    version=F('version') + 1
+                ) == 0:
+                    # Undoes the budgets that were already taken from.
+                    raise BudgetChanged()
+
+            return 0
+
+
+# File touched whenever a message becomes ready to send, so that a running
+# `process_messages --daemon` notices right away instead of at its next poll.
+def get_notification_filename():
+    return getattr(
+        settings,
+        'BULK_SEND_NOTIFICATION_FILE',
+        os.path.join(settings.LOG_DIR, 'messages-ready-to-send')
+    )
+
+def notify_ready_to_send():
+    try:
+        with open(get_notification_filename(), 'a'):
+            os.utime(get_notification_filename(), None)
+    except (IOError, OSError):
+        # The daemon will still find the message at its next poll.
+        pass
+
+# Returns the time of the last notification, or None if there has been none.
+def get_last_notification():
+    try:
+        return os.path.getmtime(get_notification_filename())
+    except (IOError, OSError):
+        return None
+
+
+'''
+Tells whether a failure to send an email is permanent, meaning that trying
+again won't help, as opposed to a temporary failure, like the mail server
+being unavailable or greylisting the recipient. Only the recipient being
+refused with an SMTP reply in the 5xx range is permanent. Other errors, such
+as connection errors or the sender being refused, have nothing to do with
+the recipient and are considered temporary.
+'''
+def is_permanent_failure(ex):
+    if isinstance(ex, smtplib.SMTPRecipientsRefused):
+        # Bulk emails have a single recipient, but should there be more, the
+        # failure is only permanent if every one of them was refused
+        # permanently.
+        codes = [code for code, message in ex.recipients.values()]
+        return len(codes) > 0 and min(codes) >= 500
+    if isinstance(ex, smtplib.SMTPDataError):
+        return ex.smtp_code >= 500
+    return False
+
+
+'''
+Tells whether a failure to send an email is the fault of the mail server or
+our connection to it, such as the connection being lost or refused, or the
+server refusing to accept mail from us at all. Such failures say nothing
+about the recipient, so they don't count as attempts at sending to them.
+'''
+def is_server_failure(ex):
+    if PersistentConnection.is_connection_error(ex):
+        return True
+    return isinstance(ex, (
+        smtplib.SMTPSenderRefused,
+        smtplib.SMTPHeloError,
+        smtplib.SMTPAuthenticationError,
+    ))
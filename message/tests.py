@@ -1,3 +1,663 @@
+import datetime
+import io
+import os
+import signal
+import smtplib
+import tempfile
+
+from contextlib import redirect_stdout
+
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from icepirate.management.commands.process_messages import Command as ProcessMessagesCommand
+from icepirate.utils import make_mail
+from member.models import Member
+from member.models import MemberGroup
+from member.models import MemberGroupAncestry
+from message.exceptions import MailServerUnavailableException
+from message.models import InteractiveMessage
+from message.models import Message
+from message.models import MessageDelivery
+from message.models import MessageLease
+from message.models import ShortURL
+from message.sending import PersistentConnection
+from message.sending import PreparedMail
+from message.sending import SendScheduler
+
+
+class DroppingBackend(EmailBackend):
+    '''
+    Email backend that drops the connection on the first attempt at sending
+    after being opened, like a mail server that has closed an idle connection.
+    '''
+    opened = 0
+
+    def open(self):
+        DroppingBackend.opened += 1
+        self.dropped = False
+
+    def send_messages(self, messages):
+        if not self.dropped and DroppingBackend.opened == 1:
+            self.dropped = True
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return super(DroppingBackend, self).send_messages(messages)
+
+
+class RefusingBackend(EmailBackend):
+    '''
+    Email backend that refuses the recipients in `refused`, with the SMTP
+    reply code given for each of them.
+    '''
+    refused = {}
+
+    def send_messages(self, messages):
+        for message in messages:
+            for recipient in message.to:
+                if recipient in RefusingBackend.refused:
+                    code = RefusingBackend.refused[recipient]
+                    raise smtplib.SMTPRecipientsRefused({ recipient: (code, b'Refused') })
+        return super(RefusingBackend, self).send_messages(messages)
+
+
+class UnreachableBackend(EmailBackend):
+    '''
+    Email backend that fails to connect to the mail server.
+    '''
+
+    def open(self):
+        raise ConnectionRefusedError('Connection refused')
+
+
+class DisconnectedBackend(EmailBackend):
+    '''
+    Email backend whose connection is always dropped when sending, like a
+    mail server that has gone down.
+    '''
+
+    def send_messages(self, messages):
+        raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+
+class StoppingBackend(EmailBackend):
+    '''
+    Email backend that asks `command` to stop once `stop_after` emails have
+    been sent, like a service manager stopping it in the middle of sending.
+    '''
+    command = None
+    stop_after = 0
+
+    def send_messages(self, messages):
+        sent = super(StoppingBackend, self).send_messages(messages)
+        if len(mail.outbox) >= StoppingBackend.stop_after:
+            StoppingBackend.command.stopping = True
+        return sent
+
+
+@override_settings(EMAIL_BACKEND='message.tests.DroppingBackend')
+class PersistentConnectionTest(TestCase):
+
+    def test_reconnects_when_dropped(self):
+        DroppingBackend.opened = 0
+
+        with PersistentConnection() as connection:
+            sent = connection.send_messages([make_mail('someone@example.com', 'Subject', 'Body')])
+
+        self.assertEqual(sent, 1)
+        self.assertEqual(DroppingBackend.opened, 2)
+
+
+class PreparedMailTest(TestCase):
+
+    def test_same_as_rendering_per_recipient(self):
+        body = '# Heading\n\nSome *text* and a [link](https://example.com/).'
+        footer = 'Unsubscribe here: {{reject_link}}'
+        link = 'https://something.example.com/r/0123456789abcdef'
+
+        prepared = PreparedMail('Subject', body, footer=footer, link_names=('reject_link',))
+        email = prepared.make('someone@example.com', { 'reject_link': link })
+
+        expected = make_mail(
+            'someone@example.com',
+            'Subject',
+            body + '\n\n---\n' + footer.replace('{{reject_link}}', '<%s>' % link),
+            subject_prefix=None
+        )
+
+        self.assertEqual(email.subject, expected.subject)
+        self.assertEqual(email.body, expected.body)
+        self.assertEqual(email.alternatives, expected.alternatives)
+
+
+class SendBulkTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create(username='author')
+        InteractiveMessage.objects.create(
+            interactive_type='reject_email_messages',
+            author=self.author,
+            body='Unsubscribe here: {{reject_link}}'
+        )
+
+    def add_members(self, count):
+        start = Member.objects.count()
+        for i in range(start, start + count):
+            Member.objects.create(
+                ssn='%010d' % i,
+                name='Member %d' % i,
+                email='member%d@example.com' % i,
+                email_wanted=True,
+                temporary_web_id='web-id-%d' % i
+            )
+
+    def count_send_bulk_queries(self):
+        message = Message.objects.create(
+            author=self.author,
+            body='Hello.',
+            include_mailing_list=False,
+            ready_to_send=True
+        )
+        with CaptureQueriesContext(connection) as context:
+            results = list(message.send_bulk())
+
+        self.assertTrue(all(success for num, count, email, success in results))
+        return len(results), len(context.captured_queries)
+
+    @override_settings(BULK_SEND_FLUSH_COUNT=100)
+    def test_queries_per_recipient(self):
+        self.add_members(5)
+        few_recipients, few_queries = self.count_send_bulk_queries()
+
+        self.add_members(15)
+        many_recipients, many_queries = self.count_send_bulk_queries()
+
+        # Deliveries are recorded in batches, so with everyone fitting in one
+        # batch, the number of queries doesn't depend on the recipient count.
+        self.assertEqual(few_queries, many_queries)
+
+    def test_unsubscription_links(self):
+        self.add_members(3)
+        self.count_send_bulk_queries()
+
+        self.assertEqual(len(mail.outbox), 3)
+        for email, member in zip(mail.outbox, Member.objects.order_by('ssn')):
+            code = email.body.split('/r/')[1].split('>')[0]
+            self.assertTrue(ShortURL.objects.get(code=code).url.endswith(
+                '/message/mailcommand/reject_email_messages/reject_link/%s/' % member.temporary_web_id
+            ))
+
+    def test_undelivered_recipient_chunks(self):
+        self.add_members(7)
+        message = Message.objects.create(author=self.author, body='Hello.', include_mailing_list=False)
+        delivered = Member.objects.order_by('?').first()
+        MessageDelivery.objects.create(message=message, member=delivered)
+
+        chunks = list(message.get_undelivered_recipient_chunks(chunk_size=3))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3])
+        self.assertEqual(
+            sorted(recipient.email for chunk in chunks for recipient in chunk),
+            sorted(Member.objects.exclude(id=delivered.id).values_list('email', flat=True))
+        )
+        self.assertEqual(message.get_recipient_count(), 7)
+
+    @override_settings(BULK_SEND_FLUSH_COUNT=3)
+    def test_stopped_mid_batch(self):
+        self.add_members(10)
+        message = Message.objects.create(author=self.author, body='Hello.', include_mailing_list=False)
+
+        # The caller stops iterating in the middle of a batch.
+        sending = message.send_bulk()
+        for i in range(5):
+            next(sending)
+        sending.close()
+
+        self.assertEqual(message.deliveries.count(), 5)
+
+        list(message.send_bulk())
+
+        sent_to = [email.to[0] for email in mail.outbox]
+        self.assertEqual(len(sent_to), 10)
+        self.assertEqual(len(set(sent_to)), 10)
+
+        message.refresh_from_db()
+        self.assertEqual(message.recipient_count_complete, 10)
+        self.assertIsNotNone(message.sending_complete)
+
+    @override_settings(BULK_SEND_FLUSH_COUNT=3)
+    def test_killed_mid_batch(self):
+        self.add_members(10)
+        message = Message.objects.create(author=self.author, body='Hello.', include_mailing_list=False)
+
+        # Simulate the process being killed in the middle of a batch, by the
+        # recording of deliveries failing after the first batch.
+        record_deliveries = Message.record_deliveries
+        def crash(message, recipients):
+            if message.deliveries.count() > 0 and len(recipients) > 0:
+                raise KeyboardInterrupt()
+            record_deliveries(message, recipients)
+
+        with mock.patch.object(Message, 'record_deliveries', crash):
+            sending = message.send_bulk()
+            with self.assertRaises(KeyboardInterrupt):
+                for i in range(5):
+                    next(sending)
+                sending.close()
+
+        list(message.send_bulk())
+
+        # Those sent to after the last recorded batch get the message again,
+        # but never more than a batch's worth of them.
+        sent_to = [email.to[0] for email in mail.outbox]
+        self.assertEqual(len(set(sent_to)), 10)
+        self.assertLessEqual(len(sent_to) - 10, 3)
+
+    @override_settings(BULK_SEND_LEASE_SIZE=3)
+    def test_concurrent_workers(self):
+        self.add_members(10)
+        message = Message.objects.create(author=self.author, body='Hello.', include_mailing_list=False)
+
+        workers = [
+            Message.objects.get(id=message.id).send_bulk(worker='a'),
+            Message.objects.get(id=message.id).send_bulk(worker='b'),
+        ]
+        while len(workers) > 0:
+            for worker in list(workers):
+                try:
+                    next(worker)
+                except StopIteration:
+                    workers.remove(worker)
+
+        sent_to = [email.to[0] for email in mail.outbox]
+        self.assertEqual(len(sent_to), 10)
+        self.assertEqual(len(set(sent_to)), 10)
+
+        message.refresh_from_db()
+        self.assertIsNotNone(message.sending_complete)
+        self.assertEqual(message.recipient_count_complete, 10)
+        self.assertFalse(message.leases.exists())
+
+    @override_settings(BULK_SEND_LEASE_SIZE=3, BULK_SEND_FLUSH_COUNT=1)
+    def test_crashed_worker_lease_reclaimed(self):
+        self.add_members(10)
+        message = Message.objects.create(author=self.author, body='Hello.', include_mailing_list=False)
+
+        # Worker "a" gets a lease and then stops responding.
+        crashed = message.send_bulk(worker='a')
+        next(crashed)
+
+        # Other workers send to everyone else, but can't take over the lease
+        # until it expires.
+        list(Message.objects.get(id=message.id).send_bulk(worker='b'))
+        self.assertEqual(len(mail.outbox), 8)
+        self.assertEqual(MessageLease.objects.filter(finished=None).count(), 1)
+
+        MessageLease.objects.filter(worker='a').update(
+            expires=timezone.now() - datetime.timedelta(seconds=1)
+        )
+        list(Message.objects.get(id=message.id).send_bulk(worker='c'))
+
+        sent_to = [email.to[0] for email in mail.outbox]
+        self.assertEqual(len(sent_to), 10)
+        self.assertEqual(len(set(sent_to)), 10)
+
+        message.refresh_from_db()
+        self.assertIsNotNone(message.sending_complete)
+
+    @override_settings(BULK_SEND_ASYNC=True, BULK_SEND_CONCURRENCY=3, BULK_SEND_FLUSH_COUNT=100)
+    def test_async_sender(self):
+        self.add_members(10)
+        message = Message.objects.create(author=self.author, body='Hello.', include_mailing_list=False)
+
+        # Emails still in flight when the caller stops are sent anyway, and
+        # recorded as delivered.
+        sending = message.send_bulk()
+        for i in range(4):
+            next(sending)
+        sending.close()
+
+        sent_count = len(mail.outbox)
+        self.assertGreaterEqual(sent_count, 4)
+        self.assertEqual(message.deliveries.count(), sent_count)
+
+        results = list(message.send_bulk())
+
+        self.assertEqual(len(results), 10 - sent_count)
+        self.assertEqual(len(set(email.to[0] for email in mail.outbox)), 10)
+        self.assertEqual(len(mail.outbox), 10)
+
+        message.refresh_from_db()
+        self.assertIsNotNone(message.sending_complete)
+
+    @override_settings(EMAIL_BACKEND='message.tests.RefusingBackend')
+    def test_failures_retried(self):
+        self.add_members(5)
+        message = Message.objects.create(author=self.author, body='Hello.', include_mailing_list=False)
+
+        RefusingBackend.refused = {
+            'member1@example.com': 550,
+            'member2@example.com': 451,
+        }
+        list(message.send_bulk())
+        self.assertEqual(len(mail.outbox), 3)
+
+        # Nothing is sent until the temporary failure is due for a retry.
+        list(message.send_bulk())
+        self.assertEqual(len(mail.outbox), 3)
+        message.refresh_from_db()
+        self.assertIsNone(message.sending_complete)
+
+        RefusingBackend.refused = {}
+        message.failures.update(next_attempt=timezone.now())
+        list(message.send_bulk())
+
+        # The permanently refused recipient is not retried, but the message
+        # is complete with them listed as undeliverable.
+        self.assertEqual([email.to[0] for email in mail.outbox[3:]], ['member2@example.com'])
+        message.refresh_from_db()
+        self.assertIsNotNone(message.sending_complete)
+        self.assertEqual(
+            [(failure.email, failure.attempts, failure.error) for failure in message.get_undeliverable()],
+            [('member1@example.com', 1, 'SMTPRecipientsRefused')]
+        )
+
+    @override_settings(BULK_SEND_MAX_ATTEMPTS=2)
+    def test_server_failures_not_attempts(self):
+        self.add_members(2)
+        message = Message.objects.create(author=self.author, body='Hello.', include_mailing_list=False)
+
+        # The mail server being down doesn't use up the recipients' attempts.
+        with override_settings(EMAIL_BACKEND='message.tests.DisconnectedBackend'):
+            for i in range(3):
+                message.failures.update(next_attempt=timezone.now())
+                list(message.send_bulk())
+
+        self.assertEqual(
+            sorted(message.failures.values_list('email', 'attempts', 'permanent', 'error')),
+            [
+                ('member0@example.com', 0, False, 'SMTPServerDisconnected'),
+                ('member1@example.com', 0, False, 'SMTPServerDisconnected'),
+            ]
+        )
+        message.refresh_from_db()
+        self.assertIsNone(message.sending_complete)
+
+        message.failures.update(next_attempt=timezone.now())
+        list(message.send_bulk())
+
+        message.refresh_from_db()
+        self.assertIsNotNone(message.sending_complete)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(list(message.get_undeliverable()), [])
+
+    def test_mail_server_unavailable(self):
+        self.add_members(3)
+        message = Message.objects.create(
+            author=self.author,
+            body='Hello.',
+            include_mailing_list=False,
+            ready_to_send=True
+        )
+
+        with override_settings(EMAIL_BACKEND='message.tests.UnreachableBackend'):
+            with self.assertRaises(MailServerUnavailableException):
+                list(message.send_bulk())
+
+            # The script carries on, leaving the message to the next run.
+            with redirect_stdout(io.StringIO()), mock.patch('signal.signal'):
+                call_command('process_messages')
+
+        message.refresh_from_db()
+        self.assertIsNone(message.sending_complete)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertFalse(message.leases.exclude(worker=None).exists())
+
+        with redirect_stdout(io.StringIO()), mock.patch('signal.signal'):
+            call_command('process_messages')
+
+        message.refresh_from_db()
+        self.assertIsNotNone(message.sending_complete)
+        self.assertEqual(len(mail.outbox), 3)
+
+
+class ProcessMessagesTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create(username='author', is_superuser=True, is_staff=True)
+        for i in range(5):
+            Member.objects.create(
+                ssn='%010d' % i,
+                name='Member %d' % i,
+                email='member%d@example.com' % i,
+                email_wanted=True
+            )
+
+        self.command = ProcessMessagesCommand()
+        self.command.senders = {}
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.notification_file = os.path.join(directory.name, 'messages-ready-to-send')
+
+    def test_wakes_up_when_notified(self):
+        self.client.force_login(self.author)
+
+        # Marks a message as ready to send in the web interface, while the
+        # script is waiting.
+        def add_message(seconds):
+            self.client.post('/message/add/', {
+                'from_address': 'from@example.com',
+                'subject': 'Subject',
+                'body': 'Hello.',
+                'send_to_all': 'on',
+                'ready_to_send': 'on',
+            })
+
+        with override_settings(BULK_SEND_NOTIFICATION_FILE=self.notification_file), \
+                redirect_stdout(io.StringIO()):
+            self.command.process(1)
+
+            with mock.patch('time.sleep', side_effect=add_message) as sleep:
+                self.command.wait(60)
+            self.assertEqual(sleep.call_count, 1)
+
+            self.command.process(1)
+
+        message = Message.objects.get()
+        self.assertIsNotNone(message.sending_complete)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_interrupted(self):
+        # Ctrl-C is only taken over when running as a daemon.
+        for daemon, handled in ((False, [signal.SIGTERM]), (True, [signal.SIGTERM, signal.SIGINT])):
+            with redirect_stdout(io.StringIO()), \
+                    mock.patch('signal.signal') as set_handler, \
+                    mock.patch.object(ProcessMessagesCommand, 'wait', side_effect=lambda poll_interval: setattr(self.command, 'stopping', True)):
+                self.command.stopping = False
+                self.command.handle(workers=1, daemon=daemon, poll_interval=60)
+            self.assertEqual([call[0][0] for call in set_handler.call_args_list], handled)
+
+        # Pressing it once stops gracefully, but pressing it again stops
+        # right away.
+        self.command.stopping = False
+        with redirect_stdout(io.StringIO()):
+            self.command.stop(signal.SIGINT, None)
+        self.assertTrue(self.command.stopping)
+        with self.assertRaises(KeyboardInterrupt):
+            self.command.stop(signal.SIGINT, None)
+
+    # Deliveries are recorded in batches larger than the number of recipients,
+    # so those sent to before stopping are all still pending when it stops.
+    @override_settings(EMAIL_BACKEND='message.tests.StoppingBackend', BULK_SEND_FLUSH_COUNT=50)
+    def test_stopped_mid_send(self):
+        message = Message.objects.create(
+            author=self.author,
+            body='Hello.',
+            include_mailing_list=False,
+            ready_to_send=True
+        )
+
+        StoppingBackend.command = self.command
+        StoppingBackend.stop_after = 2
+
+        with redirect_stdout(io.StringIO()):
+            self.assertFalse(self.command.send(message))
+
+        # The deliveries that were pending are recorded, and the lease is
+        # released for the next run.
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(
+            sorted(message.deliveries.values_list('member__email', flat=True)),
+            sorted(email.to[0] for email in mail.outbox)
+        )
+        self.assertFalse(message.leases.exclude(worker=None).exists())
+        message.refresh_from_db()
+        self.assertIsNone(message.sending_complete)
+
+        # Resuming sends to the rest, and to nobody twice.
+        self.command.stopping = False
+        StoppingBackend.stop_after = 10
+        with redirect_stdout(io.StringIO()):
+            self.assertTrue(self.command.send(message))
+
+        self.assertEqual(
+            sorted(email.to[0] for email in mail.outbox),
+            ['member%d@example.com' % i for i in range(5)]
+        )
+        message.refresh_from_db()
+        self.assertIsNotNone(message.sending_complete)
+
+
+class RecipientQueryTest(TestCase):
+
+    def setUp(self):
+        self.author = User.objects.create(username='author')
+
+        self.parent = MemberGroup.objects.create(name='Parent', techname='parent', email='parent@example.com')
+        self.child = MemberGroup.objects.create(name='Child', techname='child', email='child@example.com')
+        self.grandchild = MemberGroup.objects.create(name='Grandchild', techname='grandchild', email='grandchild@example.com')
+        self.other = MemberGroup.objects.create(name='Other', techname='other', email='other@example.com')
+        self.parent.auto_subgroups.add(self.child)
+        self.child.auto_subgroups.add(self.grandchild)
+
+        self.members = {}
+        for name, groups in (
+            ('parent', [self.parent]),
+            ('child', [self.child]),
+            ('both', [self.parent, self.child]),
+            ('grandchild', [self.grandchild]),
+            ('other', [self.other]),
+        ):
+            member = Member.objects.create(ssn=name, name=name, email='%s@example.com' % name, email_wanted=True)
+            member.membergroups.set(groups)
+            self.members[name] = member
+
+    def get_recipient_names(self, groups_include_subgroups):
+        message = Message.objects.create(
+            author=self.author,
+            send_to_all=False,
+            groups_include_subgroups=groups_include_subgroups
+        )
+        message.membergroups.add(self.parent)
+        return sorted(message.get_member_recipients().values_list('name', flat=True))
+
+    def test_groups(self):
+        self.assertEqual(self.get_recipient_names(True), ['both', 'child', 'grandchild', 'parent'])
+        self.assertEqual(self.get_recipient_names(False), ['both', 'parent'])
+
+    def test_groups_created_without_signals(self):
+        # Loaded from a fixture, which saves without the usual signals.
+        loaded = MemberGroup(name='Loaded', techname='loaded', email='loaded@example.com')
+        loaded.save_base(raw=True)
+        self.assertTrue(MemberGroupAncestry.objects.filter(ancestor=loaded, descendant=loaded, depth=0).exists())
+
+        # Created in bulk, without any signals at all.
+        bulk = MemberGroup.objects.bulk_create([
+            MemberGroup(name='Bulk', techname='bulk', email='bulk@example.com')
+        ])[0]
+
+        self.members['other'].membergroups.add(loaded)
+        self.members['parent'].membergroups.add(bulk)
+
+        message = Message.objects.create(author=self.author, send_to_all=False, groups_include_subgroups=True)
+        message.membergroups.add(loaded, bulk)
+        self.assertEqual(
+            sorted(message.get_member_recipients().values_list('name', flat=True)),
+            ['other', 'parent']
+        )
+
+    def test_query_plan(self):
+        message = Message.objects.create(author=self.author, send_to_all=False)
+        message.membergroups.add(self.parent)
+        members = message.get_member_recipients()
+
+        self.assertNotIn('DISTINCT', str(members.query))
+
+        # The plan should not involve removing duplicates or otherwise going
+        # through a temporary table.
+        plan = members.explain()
+        if connection.vendor == 'sqlite':
+            self.assertNotIn('TEMP B-TREE FOR DISTINCT', plan)
+        elif connection.vendor == 'mysql':
+            self.assertNotIn('Using temporary', plan)
+        else:
+            self.skipTest('No expectations for the query plan on %s.' % connection.vendor)
+
+
+class SendSchedulerTest(TestCase):
+
+    def test_paces_and_defers(self):
+        scheduler = SendScheduler({
+            'per_second': 100,
+            'domains': {
+                'example.com': { 'per_minute': 2 },
+            },
+        }, max_wait=1)
+
+        self.assertTrue(scheduler.wait('someone@example.com'))
+        self.assertTrue(scheduler.wait('someone.else@EXAMPLE.com'))
+
+        # The domain's budget is exhausted and won't allow another email for
+        # half a minute, but other domains are unaffected.
+        self.assertFalse(scheduler.wait('third@example.com'))
+        self.assertTrue(scheduler.wait('someone@example.org'))
+
+    def test_shared_between_processes(self):
+        # Every process sending has a scheduler of its own, but they all draw
+        # on the same budgets.
+        limits = { 'domains': { 'example.com': { 'per_minute': 3 } } }
+        first = SendScheduler(limits, max_wait=1)
+        second = SendScheduler(limits, max_wait=1)
+
+        self.assertTrue(first.wait('one@example.com'))
+        self.assertTrue(second.wait('two@example.com'))
+        self.assertTrue(first.wait('three@example.com'))
+        self.assertFalse(second.wait('four@example.com'))
+        self.assertFalse(first.wait('four@example.com'))
+
+    @override_settings(BULK_SEND_RATE_LIMITS={ 'domains': { 'example.com': { 'per_hour': 3 } } })
+    def test_send_bulk_defers(self):
+        author = User.objects.create(username='author')
+        for i in range(5):
+            Member.objects.create(ssn='%010d' % i, name='Member', email='member%d@example.com' % i, email_wanted=True)
+        message = Message.objects.create(author=author, body='Hello.', include_mailing_list=False)
+
+        scheduler = SendScheduler()
+        results = list(message.send_bulk(scheduler=scheduler))
 
-# Create your tests here.
+        # Deferred recipients are neither sent to nor count as failures, but
+        # the message is not complete until they've been sent to.
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(success for num, count, email, success in results))
+        message.refresh_from_db()
+        self.assertIsNone(message.sending_complete)
+        self.assertEqual(message.recipient_count_complete, 3)
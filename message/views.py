@@ -17,6 +17,7 @@ from message.forms import InteractiveMessageForm
 from message.forms import MessageForm
 from message.models import InteractiveMessage
 from message.models import Message, ShortURL
+from message.sending import notify_ready_to_send
 
 @login_required
 def add(request):
@@ -28,6 +29,8 @@ def add(request):
             form.instance.author = request.user
             form.instance.ready_to_send = len(request.POST.get('ready_to_send', '')) > 0
             message = form.save()
+            if message.ready_to_send:
+                notify_ready_to_send()
             return HttpResponseRedirect('/message/view/%d' % message.id)
 
     else:
@@ -53,6 +56,8 @@ def edit(request, message_id):
             form.instance.author = request.user
             form.instance.ready_to_send = len(request.POST.get('ready_to_send', '')) > 0
             message = form.save()
+            if message.ready_to_send:
+                notify_ready_to_send()
             return HttpResponseRedirect('/message/view/%d/' % message.id)
 
     else: